@@ -8,4 +8,94 @@ AUTH_ON_EJECT = False
 SECURE_FINGERPRINT_COMMS = False
 
 # Enable the graphical user interface
-GUI = True
\ No newline at end of file
+GUI = True
+
+# Number of processes used to encrypt and decrypt the drive image (one per core on a Raspberry Pi 4)
+ENCRYPTION_WORKERS = 4
+
+# Seconds that the unsealed drive key is kept in memory after mounting, so that ejecting does not need to unseal it again
+KEY_CACHE_TTL = 3600
+
+# Only encrypt the parts of the drive image that the exFAT filesystem is using (free clusters are stored as holes)
+# the allocation bitmap must be up to date, so the host should have ejected the drive before it is encrypted
+EXFAT_AWARE_ENCRYPTION = False
+
+# Compression applied to each chunk of the drive image before it is encrypted ("none", "zlib" or "lzma")
+# trades CPU time for fewer bytes written to the SD card, it only helps if the drive holds compressible files
+IMAGE_COMPRESSION = "none"
+
+# Number of chunk buffers for each stage of the pipeline that encrypts and decrypts the drive image
+# (at least 2, so that each stage can work on one chunk while the next stage takes the previous one)
+PIPELINE_BUFFERS = 4
+
+# Mount the drive straight away, decrypting each part of the image the first time the host reads it
+# (served through a network block device, which needs the nbd kernel module and nbd-client)
+LAZY_MOUNT = False
+
+# Block devices used to serve the drives when they are mounted lazily, numbered in the order of the drive profiles
+NBD_DEVICE_PREFIX = "/dev/nbd"
+
+# Size of the ramdisk holding the plaintext drive image while it is mounted (limited by the RAM on the Pi)
+RAMDISK_SIZE = "1024M"
+
+# If set, a lazily mounted drive is served from a cache of this many bytes of decrypted chunks in RAM instead of the ramdisk
+# changed chunks are written back into the encrypted image as they are evicted, so the drive can be larger than the RAM
+CHUNK_CACHE_SIZE = None
+
+# Bytes of the encrypted image read ahead into the page cache while the user is authenticating a mount (0 to disable)
+# kept below the free RAM, so the start of the image is not evicted again before it is decrypted
+PREFETCH_SIZE = 256 * 1024 * 1024
+
+# Seconds between checkpoints of the mounted drive, which re-encrypt the chunks changed since the last one
+# in the background, so eject has less to do and at most this much is lost if power is lost (0 to disable)
+CHECKPOINT_INTERVAL = 300
+
+# Seconds the host must have stopped writing to the drive before a checkpoint continues
+CHECKPOINT_IDLE_TIME = 2
+
+# Seconds between the passes of a key rotation over the mounted drive (started from the "Rotate key" menu)
+# after the first pass re-encrypts every chunk under the new key, each one catches up with the chunks the host changed since
+ROTATION_INTERVAL = 60
+
+# Number of earlier versions of the drive kept as snapshots, one taken on each eject (0 to disable)
+# a snapshot only stores the chunks that have changed since, and can be rolled back to with "python3 -m encryption.snapshots"
+SNAPSHOT_RETENTION = 5
+
+# Keep the image that a full rewrite replaces (e.g. on a size change or an upgrade), with its snapshots, rather than deleting
+# the snapshots, which no longer apply to the new image (it is kept until the next full rewrite, and takes its own space)
+KEEP_PREVIOUS_IMAGE = True
+
+# Directory of the store that saved drive images keep their chunks in, each distinct chunk stored once for all of them
+CHUNK_STORE_PATH = "./storage/chunks"
+
+# Seconds the TPM server is given to start (answering on its ports and starting the TPM) before it is reported as failed
+TPM_START_TIMEOUT = 10
+
+# Reset the TPM by restoring a snapshot of its state taken after the first reset (cleared, with the storage key provisioned)
+# rather than clearing it and generating the storage key again each time
+# the keys for communicating with the fingerprint sensor are still new on every reset (taken from the key pool when it has them)
+TPM_RESET_SNAPSHOT = True
+
+# Number of RSA keys generated ahead of time and kept ready for the fingerprint communication keys on reset (0 to disable)
+# the keys are only usable until the TPM is cleared, so they mostly help resets that restore the snapshot above
+KEY_POOL_DEPTH = 4
+
+# Seconds the TPM must have gone unused before the next key for the pool is generated (at most one is generated every interval)
+KEY_POOL_REFILL_INTERVAL = 30
+
+# Directory the keys of the pool are parked in (as key blobs, which only the TPM can load)
+KEY_POOL_PATH = "./storage/key_pool"
+
+# Size in bytes of the drive created for each profile on reset
+# new drives are formatted as exFAT, and only the filesystem's metadata is encrypted, the rest of the image is holes that
+# take no space until they are written to (a drive larger than RAMDISK_SIZE must be mounted lazily, through the chunk cache)
+DRIVE_SIZE = 64 * 1024 * 1024
+
+# Named drive profiles, each with its own encrypted image
+# every profile the user is authorized for is mounted at once, each as a separate LUN of the USB gadget
+# the address is where the key of a drive set up before keyrings is sealed in the TPM (see encryption.keyring)
+DRIVE_PROFILES = {"fs": "0x81010001"}
+
+# Persistent addresses in the TPM of the key sealed for each user, which unwraps the data keys of the drives they may use
+# (0x81010002 and 0x81010003 hold the keys for communicating with the fingerprint sensor)
+USER_KEY_ADDRS = ["0x81010010", "0x81010011", "0x81010012", "0x81010013", "0x81010014", "0x81010015", "0x81010016", "0x81010017"]
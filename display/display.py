@@ -10,6 +10,9 @@ import display.button
 W, H = (128, 64)
 FONT_SIZE = 12
 
+# Number of menu entries that fit below the title, the menu scrolls to show the rest
+MENU_LINES = (H - 2 - FONT_SIZE) // FONT_SIZE
+
 class Display():
     def __init__(self):
         self.start()
@@ -68,9 +71,12 @@ class Display():
                     border = 0
                     draw.line((border, 14, W-border, 14), fill="white")
 
+                    # The entries shown start far enough down for the selected entry to be on screen
+                    first = max(0, selected - MENU_LINES + 1)
+
                     i = 0
-                    for entry in menu.keys():
-                        if i == selected:
+                    for entry in list(menu.keys())[first:first + MENU_LINES]:
+                        if i + first == selected:
                             entry = "> " + entry
 
                         self.draw_centred_text(draw, entry, x_pos=border, y_pos=(i*FONT_SIZE) + 2 + FONT_SIZE)
@@ -0,0 +1,24 @@
+import contextlib
+import threading
+
+# Counts the heavy work in progress on the drives (full encrypts and decrypts, checkpoints and key rotations)
+# which use the Pi's CPU and SD card for a long time, so that optional background work (e.g. refilling the key pool)
+# can wait until there is none, rather than competing with it
+lock = threading.Lock()
+running = 0
+
+# Mark the work done in the with block as in progress
+@contextlib.contextmanager
+def working():
+    global running
+    with lock:
+        running += 1
+
+    try:
+        yield
+    finally:
+        with lock:
+            running -= 1
+
+def busy():
+    return running > 0
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Measures the throughput of the drive image encryption engine
+# usage (from the repository root): python3 -m encryption.benchmark [image size in MB] [max workers] [SD card write MB/s]
+
+import os
+import sys
+import tempfile
+import time
+
+import config
+from encryption import image_format
+from encryption.engine import StreamEngine, derive_chunk_key
+
+MB = 1024 * 1024
+
+# Write an image of random data, which is the worst case for the engine
+def create_test_image(path, size):
+    with open(path, "wb") as f:
+        for i in range(size // MB):
+            f.write(os.urandom(MB))
+
+# Write an image of text that compresses about as well as documents and logs do
+def create_compressible_test_image(path, size):
+    words = [os.urandom(4).hex().encode() for i in range(4096)]
+
+    with open(path, "wb") as f:
+        for i in range(size // MB):
+            line = bytearray()
+            while len(line) < MB:
+                line += b" ".join(words[b % len(words)] for b in os.urandom(12)) + b"\n"
+            f.write(line[:MB])
+
+# Bytes actually allocated to a (sparse) file on disk
+def allocated_size(path):
+    return os.stat(path).st_blocks * 512
+
+# Encrypt and decrypt the same image with 1 up to max_workers worker processes
+def benchmark_workers(directory, size, max_workers):
+    plaintext_path = os.path.join(directory, "fs.img")
+    encrypted_path = os.path.join(directory, "fs.img.encrypted")
+    decrypted_path = os.path.join(directory, "fs.img.decrypted")
+
+    create_test_image(plaintext_path, size)
+    aes_key = os.urandom(32).hex().encode()
+
+    results = []
+    for workers in range(1, max_workers + 1):
+        engine = StreamEngine(workers=workers)
+        encrypt_rate = engine.encrypt_image(aes_key, plaintext_path, encrypted_path)
+        decrypt_rate = engine.decrypt_image(aes_key, encrypted_path, decrypted_path)
+
+        results.append((workers, encrypt_rate, decrypt_rate))
+
+    print()
+    print(f"# {size // MB} MB image")
+    print("workers  encrypt MB/s  decrypt MB/s  encrypt speedup  decrypt speedup")
+    for workers, encrypt_rate, decrypt_rate in results:
+        print(f"{workers:7}  {encrypt_rate / MB:12.1f}  {decrypt_rate / MB:12.1f}  {encrypt_rate / results[0][1]:15.2f}  {decrypt_rate / results[0][2]:15.2f}")
+
+# Encrypt and decrypt a compressible image with each compression setting, using the workers of a 4 core Pi
+# the time to write the encrypted image to the SD card is modeled from sd_write_rate, as the tmpfs used here is far faster
+def benchmark_compression(directory, size, sd_write_rate, workers=4):
+    plaintext_path = os.path.join(directory, "fs.img")
+    encrypted_path = os.path.join(directory, "fs.img.encrypted")
+    decrypted_path = os.path.join(directory, "fs.img.decrypted")
+
+    create_compressible_test_image(plaintext_path, size)
+    aes_key = os.urandom(32).hex().encode()
+
+    results = []
+    for compression in image_format.COMPRESSIONS:
+        engine = StreamEngine(workers=workers, compression=compression)
+        encrypt_rate = engine.encrypt_image(aes_key, plaintext_path, encrypted_path)
+        decrypt_rate = engine.decrypt_image(aes_key, encrypted_path, decrypted_path)
+        stored = allocated_size(encrypted_path)
+
+        results.append((compression, encrypt_rate, decrypt_rate, stored))
+
+    print()
+    print(f"# {size // MB} MB compressible image, {workers} workers, SD card writing at {sd_write_rate / MB:.0f} MB/s")
+    print("compression  encrypt MB/s  decrypt MB/s  stored MB  ratio  encrypt s  SD write s  eject s")
+    for compression, encrypt_rate, decrypt_rate, stored in results:
+        encrypt_time = size / encrypt_rate
+        write_time = stored / sd_write_rate
+        print(f"{compression:11}  {encrypt_rate / MB:12.1f}  {decrypt_rate / MB:12.1f}  {stored / MB:9.1f}  {size / stored:5.2f}  {encrypt_time:9.2f}  {write_time:10.2f}  {encrypt_time + write_time:7.2f}")
+
+# Time deriving the chunk key with the key schedule of each image version
+# (version 1 runs the same PBKDF2 that "openssl enc -pbkdf2" did on every mount and eject)
+def benchmark_key_schedule(repeats=20):
+    aes_key = os.urandom(32).hex().encode()
+
+    print()
+    print("version  key derivation ms")
+    for version in image_format.VERSIONS:
+        header = image_format.Header(0, version=version)
+
+        start = time.perf_counter()
+        for i in range(repeats):
+            derive_chunk_key(aes_key, header)
+        elapsed = (time.perf_counter() - start) / repeats
+
+        print(f"{version:7}  {elapsed * 1000:17.3f}")
+
+def main():
+    size = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 64 * MB
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else config.ENCRYPTION_WORKERS
+    sd_write_rate = float(sys.argv[3]) * MB if len(sys.argv) > 3 else 20 * MB
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmark_workers(directory, size, max_workers)
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmark_compression(directory, size, sd_write_rate)
+
+    benchmark_key_schedule()
+
+if __name__ == "__main__":
+    main()
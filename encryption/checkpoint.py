@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+import config
+from encryption import activity
+
+# Raised inside a checkpoint when the checkpointer is stopped, which abandons the checkpoint
+# (its journal is never committed, so the image is left as it was after the previous checkpoint)
+class CheckpointCancelled(Exception):
+    pass
+
+# Periodically re-encrypts the chunks of the mounted drive that have changed, in the background
+# checkpoint(throttle) does a single checkpoint, calling throttle before each chunk,
+# and last_activity() returns the time the host last used the drive
+# a checkpoint is only crash-consistent: the image holds the drive as it was at one moment when the host was not writing
+# to it (see Drive.checkpoint), as if the power had been cut then, but writes still cached by the host are not in it
+class Checkpointer:
+    def __init__(self, checkpoint, last_activity, interval=config.CHECKPOINT_INTERVAL, idle_time=config.CHECKPOINT_IDLE_TIME):
+        self.checkpoint = checkpoint
+        self.last_activity = last_activity
+        self.interval = interval
+        self.idle_time = idle_time
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stop checkpointing, abandoning a checkpoint in progress (eject encrypts whatever it had not finished)
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Wait while the host is using the drive, so checkpoints only use the SD card and CPU when it is idle
+    def throttle(self):
+        while True:
+            if self.stopped.is_set():
+                raise CheckpointCancelled()
+
+            idle = time.time() - self.last_activity()
+            if idle >= self.idle_time:
+                return
+
+            self.stopped.wait(self.idle_time - idle)
+
+    def run(self):
+        # Run at the lowest CPU priority, so the drive stays responsive while a checkpoint runs
+        # (threads started by the checkpoint inherit the priority)
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+
+        while not self.stopped.wait(self.interval):
+            try:
+                self.throttle()
+
+                start = time.monotonic()
+                with activity.working():
+                    self.checkpoint(self.throttle)
+                print(f"# Checkpoint completed in {time.monotonic() - start:.2f}s")
+            except CheckpointCancelled:
+                print("# Checkpoint cancelled")
+            except (OSError, ValueError) as e:
+                print(f"# Checkpoint failed ({e})")
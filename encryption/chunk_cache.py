@@ -0,0 +1,130 @@
+import collections
+import threading
+import time
+
+import config
+from encryption.image_file import ImageFile
+
+# Serves the plaintext of a chunked image from a fixed size cache of decrypted chunks in RAM
+# chunks are decrypted from the image on a miss, and the least recently used chunk is evicted when the cache is full
+# changed chunks are encrypted and written back into the image when they are evicted or flushed,
+# so the drive can be far larger than the RAM on the Pi (or the ramdisk) and RAM use is set by the cache size
+# each write back is a single atomic update of the image (see ImageFile.write_chunks), of the evicted chunk,
+# or of every changed chunk when the cache is flushed
+class ChunkCache:
+    def __init__(self, aes_key, encrypted_path, cache_size=config.CHUNK_CACHE_SIZE):
+        self.image = ImageFile(aes_key, encrypted_path, writable=True)
+        self.header = self.image.header
+        self.size = self.header.image_size
+
+        # Number of chunks held at once (at least one, so every request can be served)
+        self.capacity = max(1, cache_size // self.header.chunk_size)
+
+        # Plaintext of each cached chunk, ordered from least to most recently used
+        self.chunks = collections.OrderedDict()
+        self.dirty = set()
+
+        # Counters for sizing the cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+
+        # Time of the last request from the host, so background work can wait for it to be idle
+        self.last_access = 0
+
+        self.lock = threading.Lock()
+
+    # Indexes of the chunks holding length bytes starting at offset
+    def chunk_range(self, offset, length):
+        return range(offset // self.header.chunk_size, (offset + length - 1) // self.header.chunk_size + 1)
+
+    # Get the plaintext of a chunk, decrypting it on a miss
+    # a chunk that is about to be overwritten completely does not need decrypting, so it starts as zeros
+    def get_chunk(self, index, overwrite=False):
+        chunk = self.chunks.get(index)
+        if chunk is not None:
+            self.hits += 1
+            self.chunks.move_to_end(index)
+            return chunk
+
+        self.misses += 1
+        if overwrite:
+            chunk = bytearray(self.header.chunk_length(index))
+        else:
+            plaintext = self.image.read_chunk(index)
+            chunk = bytearray(plaintext) if plaintext is not None else bytearray(self.header.chunk_length(index))
+
+        # Make room for the chunk, writing back the least recently used chunks if they have changed
+        while len(self.chunks) >= self.capacity:
+            self.evict()
+        self.chunks[index] = chunk
+
+        return chunk
+
+    # Evict the least recently used chunk, writing it back if it has changed
+    def evict(self):
+        index = next(iter(self.chunks))
+        if index in self.dirty:
+            self.write_back([index])
+
+        self.chunks.popitem(last=False)
+        self.evictions += 1
+
+    # Write back changed chunks (every one, if no indexes are given), keeping them cached
+    def write_back(self, indexes=None):
+        indexes = sorted(self.dirty) if indexes is None else indexes
+        if not indexes:
+            return
+
+        self.image.write_chunks((index, self.chunks[index]) for index in indexes)
+        self.write_backs += len(indexes)
+        self.dirty.difference_update(indexes)
+
+    def read(self, offset, length):
+        data = bytearray()
+
+        with self.lock:
+            self.last_access = time.time()
+            for index in self.chunk_range(offset, length):
+                start = index * self.header.chunk_size
+                chunk = self.get_chunk(index)
+                data += chunk[max(offset - start, 0):offset + length - start]
+
+        return bytes(data)
+
+    def write(self, offset, data):
+        view = memoryview(data)
+
+        with self.lock:
+            self.last_access = time.time()
+            for index in self.chunk_range(offset, len(data)):
+                start = index * self.header.chunk_size
+                end = start + self.header.chunk_length(index)
+
+                chunk = self.get_chunk(index, offset <= start and end <= offset + len(data))
+                chunk_start = max(offset, start)
+                chunk_end = min(offset + len(data), end)
+                chunk[chunk_start - start:chunk_end - start] = view[chunk_start - offset:chunk_end - offset]
+
+                self.dirty.add(index)
+
+    # Write back every changed chunk, after which they are durable on the SD card
+    def flush(self):
+        with self.lock:
+            self.write_back()
+
+    def report(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests > 0 else 0
+        print(f"# Chunk cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {self.evictions} evictions, {self.write_backs} write backs")
+
+    # Chunks that have been evicted are already in the image, so the rest are always written back
+    # rather than leaving the image with only some of the host's changes
+    def close(self):
+        self.flush()
+        self.report()
+
+        with self.lock:
+            self.image.close()
+            self.chunks.clear()
@@ -0,0 +1,180 @@
+import collections
+import concurrent.futures
+import lzma
+import threading
+import zlib
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from encryption import image_format
+
+# AES block size in bytes
+BLOCK_SIZE = 16
+
+# Extra output space that update_into requires beyond the input length
+OUTPUT_MARGIN = 32
+
+# Build the cipher for a single chunk
+# CBC chunks use the random IV from the chunk table, XTS chunks are tweaked by their index
+# (an XTS chunk rewritten in place reuses its tweak, the usual trade-off for disk encryption)
+def chunk_cipher(cipher, chunk_key, index, iv):
+    if cipher == image_format.CIPHER_AES_256_XTS:
+        return Cipher(algorithms.AES(chunk_key), modes.XTS(index.to_bytes(16, "little")))
+    else:
+        return Cipher(algorithms.AES(chunk_key), modes.CBC(iv))
+
+# Compress a chunk, padding the result with zeros to a whole number of cipher blocks
+# (the decompressor stops at the end of the compressed stream, so it ignores the padding)
+def compress_chunk(compression, view):
+    if compression == image_format.COMPRESSION_ZLIB:
+        data = zlib.compress(view, 1)
+    else:
+        data = lzma.compress(view, preset=1)
+
+    return data + bytes(-len(data) % BLOCK_SIZE)
+
+# Decompress a chunk, which should expand to exactly max_length bytes
+def decompress_chunk(compression, view, max_length):
+    if compression == image_format.COMPRESSION_ZLIB:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = lzma.LZMADecompressor()
+
+    data = decompressor.decompress(view, max_length)
+    if len(data) != max_length:
+        raise ValueError("corrupt compressed chunk")
+
+    return data
+
+# Encrypt a single chunk, compressing it first if the image is compressed and that makes it smaller
+# returns the chunk flags and the number of bytes written to the output
+def encrypt_chunk(cipher, chunk_key, compression, index, iv, in_view, out_view):
+    flags = 0
+
+    if compression != image_format.COMPRESSION_NONE:
+        compressed = compress_chunk(compression, in_view)
+        if len(compressed) < len(in_view):
+            in_view = compressed
+            flags |= image_format.CHUNK_COMPRESSED
+
+    encryptor = chunk_cipher(cipher, chunk_key, index, iv).encryptor()
+    m = encryptor.update_into(in_view, out_view)
+    encryptor.finalize()
+
+    return flags, m
+
+# Decrypt (and if needed decompress) a single chunk, returning the number of bytes written to the output
+def decrypt_chunk(cipher, chunk_key, compression, chunk_size, index, iv, flags, in_view, out_view):
+    decryptor = chunk_cipher(cipher, chunk_key, index, iv).decryptor()
+    m = decryptor.update_into(in_view, out_view)
+    decryptor.finalize()
+
+    if flags & image_format.CHUNK_COMPRESSED:
+        out_view[:chunk_size] = decompress_chunk(compression, out_view[:m], chunk_size)
+        m = chunk_size
+
+    return m
+
+# The chunks are encrypted or decrypted by a pool of worker processes that is started the first time it is needed,
+# then kept for the life of the program (so each transform and checkpoint pass does not wait for processes to start)
+# as the pool is shared by every image, the layout and key are sent with each chunk rather than when the pool starts
+def encrypt_worker(cipher, chunk_key, compression, index, iv, data):
+    out = bytearray(len(data) + OUTPUT_MARGIN)
+    flags, m = encrypt_chunk(cipher, chunk_key, compression, index, iv, data, out)
+    del out[m:]
+
+    return flags, out
+
+def decrypt_worker(cipher, chunk_key, compression, chunk_size, index, iv, flags, data):
+    out = bytearray(max(len(data), chunk_size) + OUTPUT_MARGIN)
+    m = decrypt_chunk(cipher, chunk_key, compression, chunk_size, index, iv, flags, data, out)
+    del out[m:]
+
+    return out
+
+# The pools that have been started, by number of workers
+pools = {}
+pools_lock = threading.Lock()
+
+# The pool with the given number of workers, starting it if it is not running
+def shared_pool(workers):
+    with pools_lock:
+        if workers not in pools:
+            pools[workers] = ChunkPool(workers)
+
+        return pools[workers]
+
+# Stop a pool whose workers have died, so the next pass starts a new one
+def discard_pool(pool):
+    with pools_lock:
+        if pools.get(pool.workers) is pool:
+            del pools[pool.workers]
+
+    pool.close()
+
+# Stop every pool (when the program exits)
+def shutdown_pools():
+    with pools_lock:
+        stopped = list(pools.values())
+        pools.clear()
+
+    for pool in stopped:
+        pool.close()
+
+# Spreads the chunks of an image across a pool of worker processes, one per core
+class ChunkPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+        # Number of chunks in flight at once, enough to keep every worker busy
+        # without reading the whole image into memory ahead of the writer
+        # (each image being transformed has its own window, so images transformed at once share the workers)
+        self.window = workers * 2
+
+    # Encrypt or decrypt (index, entry, data) jobs of an image, yielding (index, entry, result) in the order they were given
+    # when encrypting, the flags of the entry are updated to say whether the chunk was compressed
+    # jobs with no data are holes, which are passed straight through with no result
+    # the data of each job is copied when it is submitted, then passed to release so its buffer can be reused straight away
+    def map(self, encrypt, header, chunk_key, jobs, release=None):
+        pending = collections.deque()
+        try:
+            for index, entry, data in jobs:
+                if data is None:
+                    future = None
+                elif encrypt:
+                    future = self.executor.submit(encrypt_worker, header.cipher, chunk_key, header.compression, index, entry.iv, bytes(data))
+                else:
+                    future = self.executor.submit(decrypt_worker, header.cipher, chunk_key, header.compression, header.chunk_size, index, entry.iv, entry.flags, bytes(data))
+                pending.append((index, entry, future))
+
+                if data is not None and release is not None:
+                    release(data)
+
+                if len(pending) >= self.window:
+                    yield self.result(encrypt, pending.popleft())
+
+            while pending:
+                yield self.result(encrypt, pending.popleft())
+        finally:
+            # The pool outlives this image, so chunks it no longer wants are not left to run
+            for index, entry, future in pending:
+                if future is not None:
+                    future.cancel()
+
+    def result(self, encrypt, job):
+        index, entry, future = job
+
+        if future is None:
+            return index, entry, None
+
+        if encrypt:
+            flags, result = future.result()
+            entry.flags |= flags
+        else:
+            result = future.result()
+
+        return index, entry, result
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
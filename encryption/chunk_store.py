@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# A store of encrypted chunks shared by every saved drive image, where each distinct chunk is only stored once
+# usage (from the repository root): python3 -m encryption.chunk_store [list | copy name new_name | delete name | gc]
+# (saving and restoring an image needs its key, so it is done from the "Save image" and "Restore image" menu items)
+# only saved images are deduplicated, never the live image of a drive, and as each drive has its own data key
+# (which the chunk ids are keyed by) chunks are only ever shared between the saved images of the same drive
+
+import collections
+import hmac
+import os
+import sys
+
+import config
+from encryption import chunk_crypto
+from encryption import image_format
+from encryption import journal
+from encryption import snapshots
+from encryption.engine import derive_chunk_key, fsync_directory, key_check_value, write_all
+from encryption.image_file import ImageFile
+
+# A manifest is the header of the image it was saved from, followed by the id of each of its chunks
+MANIFEST_MAGIC = b"PIUSBMAN"
+MANIFEST_SUFFIX = ".manifest"
+
+# Chunks are identified by a keyed hash of their plaintext, so the same plaintext saved under different keys
+# has unrelated ids (and the store does not reveal which images share data unless they share a key)
+ID_SIZE = 32
+ID_KEY_INFO = b"piusb chunk store id"
+
+# Holes are all zeros, so nothing is stored for them
+HOLE_ID = bytes(ID_SIZE)
+
+# Key for the chunk ids of an image, derived from its chunk key
+def id_key(chunk_key):
+    return hmac.new(chunk_key, ID_KEY_INFO, "sha256").digest()
+
+def chunk_id(key, view):
+    return hmac.new(key, view, "sha256").digest()
+
+# The id of a stored chunk from the name of its file, or None if the file is not a stored chunk
+def parse_chunk_id(name):
+    try:
+        object_id = bytes.fromhex(name)
+    except ValueError:
+        return None
+
+    return object_id if len(object_id) == ID_SIZE else None
+
+# The XTS tweak of a stored chunk comes from its id rather than its index in an image,
+# as the same stored chunk may be at any index in any number of images
+def chunk_tweak(object_id):
+    return int.from_bytes(object_id[:16], "little")
+
+class ChunkStore:
+    def __init__(self, directory=config.CHUNK_STORE_PATH):
+        self.directory = directory
+        self.objects_directory = os.path.join(directory, "objects")
+        self.manifests_directory = os.path.join(directory, "manifests")
+
+    # Stored chunks are spread over 256 directories by the first byte of their id
+    def object_path(self, object_id):
+        name = object_id.hex()
+        return os.path.join(self.objects_directory, name[:2], name)
+
+    def manifest_path(self, name):
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError(f"invalid image name {name}")
+
+        return os.path.join(self.manifests_directory, name + MANIFEST_SUFFIX)
+
+    # Names of the saved images
+    def list(self):
+        if not os.path.isdir(self.manifests_directory):
+            return []
+
+        return sorted(name[:-len(MANIFEST_SUFFIX)] for name in os.listdir(self.manifests_directory) if name.endswith(MANIFEST_SUFFIX))
+
+    # Write a file so that it only appears once it is complete
+    def write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    def write_manifest(self, name, header, ids):
+        self.write_file(self.manifest_path(name), MANIFEST_MAGIC + header.pack() + b"".join(ids))
+
+    # Read a manifest as the header of the image and the id of each chunk
+    def read_manifest(self, name):
+        path = self.manifest_path(name)
+        if not os.path.exists(path):
+            raise ValueError(f"there is no saved image {name}")
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if not data.startswith(MANIFEST_MAGIC):
+            raise ValueError(f"{name} is not a manifest")
+
+        header = image_format.Header.unpack(data[len(MANIFEST_MAGIC):])
+        ids_offset = len(MANIFEST_MAGIC) + image_format.HEADER_SIZE
+        if len(data) != ids_offset + header.chunk_count * ID_SIZE:
+            raise ValueError(f"manifest of {name} is truncated")
+
+        return header, [data[offset:offset + ID_SIZE] for offset in range(ids_offset, len(data), ID_SIZE)]
+
+    # Store a chunk unless it is already stored, returning whether it was new
+    # each stored chunk is its table entry followed by its ciphertext
+    def put_chunk(self, header, chunk_key, object_id, plaintext):
+        path = self.object_path(object_id)
+        if os.path.exists(path):
+            return False
+
+        if header.cipher == image_format.CIPHER_AES_256_CBC:
+            iv = os.urandom(image_format.IV_SIZE)
+        else:
+            iv = bytes(image_format.IV_SIZE)
+
+        out_buffer = bytearray(header.chunk_size + chunk_crypto.OUTPUT_MARGIN)
+        flags, m = chunk_crypto.encrypt_chunk(header.cipher, chunk_key, header.compression, chunk_tweak(object_id), iv, plaintext, memoryview(out_buffer))
+
+        self.write_file(path, image_format.ChunkEntry(iv, flags, m).pack() + out_buffer[:m])
+        return True
+
+    # Decrypt a stored chunk, checking that it still has the plaintext its id was made from
+    def get_chunk(self, header, chunk_key, key, object_id):
+        with open(self.object_path(object_id), "rb") as f:
+            data = f.read()
+
+        entry = image_format.ChunkEntry.unpack(data)
+        if entry.length != len(data) - image_format.ENTRY_SIZE or entry.length > header.chunk_size:
+            raise ValueError("corrupt stored chunk")
+
+        out_buffer = bytearray(header.chunk_size + chunk_crypto.OUTPUT_MARGIN)
+        m = chunk_crypto.decrypt_chunk(header.cipher, chunk_key, header.compression, header.chunk_size, chunk_tweak(object_id), entry.iv, entry.flags, memoryview(data)[image_format.ENTRY_SIZE:], memoryview(out_buffer))
+
+        plaintext = memoryview(out_buffer)[:m]
+        if not hmac.compare_digest(chunk_id(key, plaintext), object_id):
+            raise ValueError("corrupt stored chunk")
+
+        return plaintext
+
+    # Save a chunked image under a name, storing only the chunks that are not already in the store
+    def save_image(self, aes_key, image_path, name):
+        # A saved image is never replaced, so a second save under the same name cannot lose the first
+        if os.path.exists(self.manifest_path(name)):
+            raise ValueError(f"an image is already saved as {name}")
+
+        image = ImageFile(aes_key, image_path)
+        try:
+            key = id_key(image.chunk_key)
+
+            ids = []
+            stored = 0
+            for index in range(image.header.chunk_count):
+                plaintext = image.read_chunk(index)
+                if plaintext is None:
+                    ids.append(HOLE_ID)
+                    continue
+
+                # The last chunk is padded with zeros to a whole chunk, as it is when it is encrypted into an image
+                plaintext = plaintext.tobytes() + bytes(image.header.chunk_size - len(plaintext))
+                if plaintext == bytes(image.header.chunk_size):
+                    ids.append(HOLE_ID)
+                    continue
+
+                object_id = chunk_id(key, plaintext)
+                if self.put_chunk(image.header, image.chunk_key, object_id, plaintext):
+                    stored += 1
+                ids.append(object_id)
+
+            # The manifest is written last, so the image is only listed once all of its chunks are stored
+            self.write_manifest(name, image.header, ids)
+        finally:
+            image.close()
+
+        print(f"# Saved image {name}, {stored} of {len(ids)} chunks were not already stored")
+
+    # Rebuild a chunked image from a saved one, replacing the image once it is complete
+    def restore_image(self, aes_key, name, image_path):
+        header, ids = self.read_manifest(name)
+
+        chunk_key = derive_chunk_key(aes_key, header)
+        if not hmac.compare_digest(key_check_value(chunk_key), header.key_check):
+            raise ValueError("bad decrypt")
+        key = id_key(chunk_key)
+
+        partial_path = image_path + ".partial"
+        entries = []
+        with open(partial_path, "wb", buffering=0) as fout:
+            fout.truncate(header.file_size())
+
+            out_buffer = bytearray(header.chunk_size + chunk_crypto.OUTPUT_MARGIN)
+            for index, object_id in enumerate(ids):
+                if object_id == HOLE_ID:
+                    entries.append(image_format.ChunkEntry(bytes(image_format.IV_SIZE), image_format.CHUNK_HOLE, 0))
+                    continue
+
+                plaintext = self.get_chunk(header, chunk_key, key, object_id)
+
+                # As in the engine, every chunk written into an image gets a fresh random IV
+                iv = os.urandom(image_format.IV_SIZE)
+
+                # The chunk is encrypted again for its index in the image
+                flags, m = chunk_crypto.encrypt_chunk(header.cipher, chunk_key, header.compression, index, iv, plaintext, memoryview(out_buffer))
+                fout.seek(header.chunk_offset(index))
+                write_all(fout, memoryview(out_buffer)[:m])
+
+                entries.append(image_format.ChunkEntry(iv, flags, m))
+
+            image_format.write_header_and_table(fout, header, entries)
+            os.fsync(fout.fileno())
+
+        # The journal and snapshots of the old image do not apply to the restored one, so they are kept with it
+        snapshots.keep_previous(image_path)
+        journal.Journal(image_path).discard()
+        os.replace(partial_path, image_path)
+        fsync_directory(image_path)
+
+        print(f"# Restored image {name}")
+
+    # Copying a saved image only copies its manifest, as the copy shares every chunk
+    def copy_image(self, name, new_name):
+        if os.path.exists(self.manifest_path(new_name)):
+            raise ValueError(f"there is already a saved image {new_name}")
+
+        with open(self.manifest_path(name), "rb") as f:
+            self.write_file(self.manifest_path(new_name), f.read())
+
+    # Deleting a saved image only deletes its manifest, its chunks are freed by gc once nothing refers to them
+    def delete_image(self, name):
+        os.remove(self.manifest_path(name))
+
+    # Number of references to each stored chunk from the manifests
+    def reference_counts(self):
+        counts = collections.Counter()
+        for name in self.list():
+            header, ids = self.read_manifest(name)
+            counts.update(object_id for object_id in ids if object_id != HOLE_ID)
+
+        return counts
+
+    # Delete the stored chunks that no manifest refers to, returning the number of bytes freed
+    # (must not run while an image is being saved, as its chunks are stored before its manifest)
+    def gc(self):
+        counts = self.reference_counts()
+
+        deleted = 0
+        freed = 0
+        if os.path.isdir(self.objects_directory):
+            for prefix in os.listdir(self.objects_directory):
+                for name in os.listdir(os.path.join(self.objects_directory, prefix)):
+                    path = os.path.join(self.objects_directory, prefix, name)
+
+                    # Temporary files are left by saves that were interrupted (anything else that is not a chunk is left alone)
+                    object_id = parse_chunk_id(name)
+                    if name.endswith(".tmp") or (object_id is not None and counts[object_id] == 0):
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+                        deleted += 1
+
+        print(f"# Deleted {deleted} unreferenced chunks, freeing {freed} bytes")
+        return freed
+
+def main():
+    store = ChunkStore()
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    if command == "list":
+        counts = store.reference_counts()
+        print("name                  chunks  shared")
+        for name in store.list():
+            header, ids = store.read_manifest(name)
+            stored = [object_id for object_id in ids if object_id != HOLE_ID]
+            shared = sum(1 for object_id in stored if counts[object_id] > 1)
+            print(f"{name:20}  {len(stored):6}  {shared:6}")
+    elif command == "copy":
+        store.copy_image(sys.argv[2], sys.argv[3])
+    elif command == "delete":
+        store.delete_image(sys.argv[2])
+        store.gc()
+    elif command == "gc":
+        store.gc()
+    else:
+        print(f"unknown command {command}")
+
+if __name__ == "__main__":
+    main()
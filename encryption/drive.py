@@ -0,0 +1,267 @@
+import hmac
+import os
+
+import config
+from encryption import image_format
+from encryption.engine import StreamEngine, derive_chunk_key, key_check_value
+from encryption.key_cache import KeyCache
+from encryption.checkpoint import Checkpointer, CheckpointCancelled
+from encryption.chunk_cache import ChunkCache
+from encryption.image_file import ImageFile
+from encryption.lazy_image import LazyImage
+from encryption.prefetch import Prefetcher
+from encryption.rotation import KeyRotation
+from encryption.snapshots import SnapshotStore
+
+# A named drive profile (see config.DRIVE_PROFILES), with its own encrypted image and data key
+# every profile the user is authorized for is mounted at once, each as a separate LUN of the USB gadget
+class Drive:
+    def __init__(self, name, key_addr, number):
+        self.name = name
+
+        # The persistent memory address within the TPM where the key of the drive is sealed, if it has no keyring
+        self.key_addr = key_addr
+
+        # Location of the encrypted file system image, and of its plaintext copy in the ramdisk while mounted
+        self.encrypted_image_path = f"./storage/images/{name}.img.encrypted"
+        self.image_path = f"./storage/ramdisk/{name}.img"
+
+        # Block device the drive is served through when it is mounted lazily
+        self.nbd_device = f"{config.NBD_DEVICE_PREFIX}{number}"
+
+        # Digest of each plaintext chunk as it was when the drive was decrypted
+        # so that only the chunks the host has changed are re-encrypted on eject
+        self.chunk_digests = None
+
+        # The unsealed key of the mounted drive, kept for the session so that eject does not have to unseal it again
+        self.key_cache = KeyCache()
+
+        # The user who unlocked the mounted drive, and their unsealed key (which a key rotation wraps the new data key under)
+        self.user_addr = None
+        self.user_key_cache = KeyCache()
+
+        # The plaintext of the mounted drive when it is mounted lazily, which decrypts each chunk as it is first used
+        # (a LazyImage in the ramdisk, or a ChunkCache in RAM if config.CHUNK_CACHE_SIZE is set)
+        self.lazy_image = None
+
+        # Reads the encrypted image into the page cache while the user authenticates a mount
+        self.prefetcher = None
+
+        # Re-encrypts the changed chunks of the mounted drive in the background
+        self.checkpointer = None
+
+        # Re-encrypts the image of the mounted drive under a new data key in the background
+        self.rotation = None
+
+    def exists(self):
+        return os.path.exists(self.encrypted_image_path)
+
+    # File backing the LUN of the mounted drive (an absolute path, as the gadget does not share our working directory)
+    def gadget_file(self):
+        if self.lazy_image is not None:
+            return self.nbd_device
+
+        return os.path.abspath(self.image_path)
+
+    # Replace the image of the drive with a new one under its data key, holding the empty filesystem on the ramdisk
+    # (see storage.create_fs_image), and forgetting any key rotation of the old image
+    def create(self, aes_key):
+        KeyRotation(self.encrypted_image_path, aes_key, self.last_activity, None).discard()
+        StreamEngine().create_image(aes_key, self.encrypted_image_path, os.path.getsize(self.image_path), self.image_path)
+
+    # Decrypts the file system of the drive with its unsealed key
+    # returns False if it could not be (e.g. the key is wrong, the image is corrupt, or the ramdisk is full)
+    def decrypt(self, aes_key):
+        print(f"# STARTED decrypting drive {self.name}")
+        self.chunk_digests = None
+
+        try:
+            if config.LAZY_MOUNT and ImageFile.supports(self.encrypted_image_path):
+                if config.CHUNK_CACHE_SIZE:
+                    self.lazy_image = ChunkCache(aes_key, self.encrypted_image_path)
+                else:
+                    self.lazy_image = LazyImage(aes_key, self.encrypted_image_path, self.image_path)
+
+                # The lazy image records the digest of each chunk as it is decrypted
+                if isinstance(self.lazy_image, LazyImage):
+                    self.chunk_digests = self.lazy_image.chunk_digests
+                self.key_cache.store(aes_key)
+                print(f"# FINISHED opening drive {self.name} for decryption on demand")
+
+                return True
+
+            chunk_digests = []
+            # Images in the legacy format are still read, and are converted to the chunked format on the next encrypt
+            StreamEngine().decrypt_any_image(aes_key, self.encrypted_image_path, self.image_path, chunk_digests)
+        except ValueError as e:
+            print(f"# Bad decrypt of drive {self.name} ({e})")
+            return False
+        except OSError as e:
+            print(f"# Could not decrypt drive {self.name} ({e})")
+            return False
+        self.chunk_digests = chunk_digests
+        self.key_cache.store(aes_key)
+        print(f"# FINISHED decrypting drive {self.name}")
+
+        return True
+
+    # The newest of the data keys reached through a keyring (oldest first) that the image is under
+    # this is the newest key, unless power was lost while a key rotation was replacing the image
+    # (a corrupt image gets the newest key, and decrypting it then reports it)
+    def current_key(self, keys):
+        try:
+            if len(keys) > 1 and ImageFile.supports(self.encrypted_image_path):
+                with open(self.encrypted_image_path, "rb") as f:
+                    header, entries = image_format.read_header_and_table(f)
+
+                for aes_key in reversed(keys):
+                    if hmac.compare_digest(key_check_value(derive_chunk_key(aes_key, header)), header.key_check):
+                        return aes_key
+        except (OSError, ValueError):
+            pass
+
+        return keys[-1]
+
+    # Encrypts the file system of the drive from the ramdisk (or from the chunk cache) into its image
+    # returns False if it could not be (e.g. the SD card is full), leaving the plaintext for another attempt
+    def encrypt(self, aes_key):
+        print(f"# STARTED encrypting drive {self.name}")
+        try:
+            if isinstance(self.lazy_image, ChunkCache):
+                # Changed chunks are encrypted into the image as they leave the cache, so only the ones still cached are left
+                # (the cache reports its counters once, when it is closed)
+                self.lazy_image.flush()
+            else:
+                StreamEngine().encrypt_image(aes_key, self.image_path, self.encrypted_image_path, self.chunk_digests)
+        except (OSError, ValueError) as e:
+            print(f"# Could not encrypt drive {self.name} ({e})")
+            return False
+        print(f"# FINISHED encrypting drive {self.name}")
+
+        # The rotated image replaces the old one before the snapshot is taken, as it has none of the old chunks
+        self.finish_rotation()
+
+        try:
+            self.snapshot()
+        except (OSError, ValueError) as e:
+            print(f"# Could not snapshot drive {self.name} ({e})")
+        return True
+
+    # Keep the version of the drive that was just encrypted as a snapshot, deleting the oldest beyond the retention
+    def snapshot(self):
+        store = SnapshotStore(self.encrypted_image_path)
+        if config.SNAPSHOT_RETENTION > 0:
+            print(f"# Created snapshot {store.create()} of drive {self.name}")
+
+        store.gc()
+
+    # Start reading the encrypted image ahead of decrypting it, before the user has authenticated
+    def start_prefetch(self, limit):
+        self.stop_prefetch()
+
+        self.prefetcher = Prefetcher(self.encrypted_image_path, limit)
+        self.prefetcher.start()
+
+    def stop_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    # Start checkpointing the mounted drive in the background, using the key cached when it was mounted
+    def start_checkpoints(self):
+        self.stop_checkpoints()
+
+        self.checkpointer = Checkpointer(self.checkpoint, self.last_activity)
+        self.checkpointer.start()
+
+    # Stop checkpointing (before the drive is encrypted on eject, so the two never run at once)
+    def stop_checkpoints(self):
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
+
+    # Encrypt the chunks changed since the last checkpoint into the image
+    def checkpoint(self, throttle):
+        # The chunk cache writes back its changed chunks itself
+        if isinstance(self.lazy_image, ChunkCache):
+            self.lazy_image.flush()
+            return
+
+        aes_key = self.key_cache.get()
+        if aes_key is None or not self.chunk_digests:
+            print(f"# Skipped checkpoint of drive {self.name}, it can only be encrypted on eject")
+            return
+
+        # The chunks are read one at a time while the host may still be writing, so the checkpoint is abandoned
+        # (before the image refers to any of its chunks) if the host writes to the drive before it is committed
+        # otherwise the image could get some chunks from before a write and some from after it
+        activity = self.last_activity()
+
+        def unchanged():
+            if self.last_activity() != activity:
+                raise CheckpointCancelled()
+
+        def quiesced_throttle():
+            unchanged()
+            throttle()
+
+        # A single worker is used, as checkpoints are not in a hurry
+        if StreamEngine(workers=1, throttle=quiesced_throttle).update_image(aes_key, self.image_path, self.encrypted_image_path, self.chunk_digests, unchanged) is None:
+            print(f"# Skipped checkpoint of drive {self.name}, its image can only be encrypted in full on eject")
+
+    # Start rotating the data key of the mounted drive, or resume the rotation in progress, from the key it was mounted with
+    # record_key(new_key) records the new key in the keyring once the rotation has replaced the image
+    def start_rotation(self, aes_key, record_key):
+        self.stop_rotation()
+
+        rotation = KeyRotation(self.encrypted_image_path, aes_key, self.last_activity, record_key)
+        if not rotation.begin():
+            print(f"# Key rotation of drive {self.name} had already finished")
+            return
+
+        self.rotation = rotation
+        self.rotation.start()
+        print(f"# STARTED rotating the key of drive {self.name}")
+
+    # Pause the rotation (before the drive is encrypted on eject), keeping it to be finished afterwards
+    def stop_rotation(self):
+        if self.rotation is not None:
+            self.rotation.stop()
+
+    # Finish the rotation if every chunk has been re-encrypted under the new key, otherwise it resumes on the next mount
+    def finish_rotation(self):
+        if self.rotation is None:
+            return
+
+        rotation, self.rotation = self.rotation, None
+        try:
+            if rotation.finish() is None:
+                print(f"# Key rotation of drive {self.name} will resume on the next mount ({rotation.percent_done()}% done)")
+            else:
+                print(f"# FINISHED rotating the key of drive {self.name}")
+        except (OSError, ValueError) as e:
+            print(f"# Key rotation of drive {self.name} failed ({e}), it will resume on the next mount")
+
+    # Percentage of the image re-encrypted by the rotation in progress, or None if the key is not being rotated
+    def rotation_progress(self):
+        if self.rotation is None:
+            return None
+
+        return self.rotation.percent_done()
+
+    # Time the host last used the mounted drive
+    def last_activity(self):
+        if isinstance(self.lazy_image, ChunkCache):
+            return self.lazy_image.last_access
+
+        # The host's writes (and lazily decrypted chunks) change the plaintext image
+        return os.path.getmtime(self.image_path)
+
+    # Close the lazily mounted drive (once it has been encrypted, or if the program stops)
+    # a key rotation that was not finished by then is dropped too, to be resumed on the next mount
+    def close_lazy_image(self):
+        self.rotation = None
+
+        if self.lazy_image is not None:
+            self.lazy_image.close()
+            self.lazy_image = None
@@ -1,36 +1,159 @@
+import hashlib
 import os
 import random
 import string
-
-import utils
+import time
+import concurrent.futures
+
+import config
+from encryption import activity
+from encryption import chunk_crypto
+from encryption import tpm_client
+from encryption.chunk_store import ChunkStore
+from encryption.drive import Drive
+from encryption.image_file import ImageFile
+from encryption.key_pool import KeyPool
+from encryption import keyring
+from encryption import policy
+from encryption.keyring import Keyring
+from encryption.rotation import KeyRotation, rotation_path
+from encryption.tpm_client import TPMClient, TPMError
 
 class Encryption:
     # The persistent memory adresses within the TPM where the keys are stored
+    # (the keys of the users are stored at the addresses in config.USER_KEY_ADDRS, see encryption.keyring)
     RASPBERRY_KEY_ADDR = "0x81010002"
     FINGERPRINT_KEY_ADDR = "0x81010003"
 
+    # The persistent address of the storage key, which the other keys are created under
+    STORAGE_KEY_ADDR = "0x81000001"
+
+    # The PCR that the passcode and the fingerprint message are extended into, which the sealed keys' policy is bound to
+    POLICY_PCR = 23
+
+    # Connection to the TPM simulator, shared by every TPM operation
+    tpm = TPMClient()
+
+    # Name of the fingerprint sensor's signing key, once it has been read from the TPM
+    fingerprint_key_name_cache = None
+
+    # RSA keys generated in the background, ready for the keys for communicating with the fingerprint sensor
+    key_pool = KeyPool(tpm, lambda: Encryption.storage_key())
+
+    # The drive profiles, in the order of their LUNs in the USB gadget
+    drives = [Drive(name, key_addr, number) for number, (name, key_addr) in enumerate(config.DRIVE_PROFILES.items())]
+
+    # The drives that are mounted, which are the ones the user was authorized for
+    mounted_drives = []
+
+    # Data keys of the drives, unlocked by an existing user while a new user is enrolled
+    enroll_keys = {}
+
+    # Names of the drives that the last save or restore of their images failed for
+    # (saving and restoring return whether the user was authorized, so the failures are shown afterwards)
+    failed_drives = []
+
+    # Find a drive profile by name, the first profile if no name is given
+    def find_drive(name=None):
+        for drive in Encryption.drives:
+            if name is None or drive.name == name:
+                return drive
+
+        raise ValueError(f"there is no drive profile {name}")
+
+    # The digests the PCR is extended with, of the passcode and the fingerprint message
+    # (the passcode is hashed with a trailing newline, as it was when it was echoed into tpm2_hash)
+    def policy_measurements(rfid_passcode, fingerprint_message):
+        return [policy.sha256(rfid_passcode.encode("utf-8") + b"\n"), policy.sha256(fingerprint_message)]
+
+    # The name of the fingerprint sensor's signing key, which the policy of the sealed keys names
+    # it is kept once known, as it only changes when the keys for communicating with the fingerprint sensor are generated again
+    def fingerprint_key_name():
+        if Encryption.fingerprint_key_name_cache is None:
+            public = Encryption.tpm.read_public(int(Encryption.FINGERPRINT_KEY_ADDR, 16))
+            Encryption.fingerprint_key_name_cache = policy.object_name(public)
+
+        return Encryption.fingerprint_key_name_cache
+
+    # The policy the keys are sealed with, computed on the host (see encryption.policy)
+    # it is satisfied by the PCR holding the passcode and the fingerprint message, and by the fingerprint sensor's signature
+    def seal_policy(rfid_passcode, fingerprint_message):
+        pcr_value = policy.pcr_value(Encryption.policy_measurements(rfid_passcode, fingerprint_message))
+        digest = policy.policy_pcr(policy.empty_policy(), Encryption.POLICY_PCR, pcr_value)
+        return policy.policy_signed(digest, Encryption.fingerprint_key_name())
+
+    # Start a policy session satisfied by the passcode and the fingerprint sensor's signature
+    # the PCR is extended with the hash of each, the policy is bound to its value, then the PCR is reset for the next session
+    def start_policy_session(rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        tpm = Encryption.tpm
+        try:
+            for digest in Encryption.policy_measurements(rfid_passcode, fingerprint_message):
+                tpm.pcr_extend(Encryption.POLICY_PCR, digest)
+
+            session = tpm.start_auth_session(tpm_client.TPM_SE_POLICY)
+            try:
+                tpm.policy_pcr(session, Encryption.POLICY_PCR)
+                tpm.policy_signed(session, int(Encryption.FINGERPRINT_KEY_ADDR, 16), fingerprint_message_signature)
+            except:
+                tpm.flush_context(session)
+                raise
+        finally:
+            tpm.pcr_reset(Encryption.POLICY_PCR)
+
+        return session
+
     # Generates a new random AES key using the TPM
-    # then store it within the TPM, sealed against the RFID card passcode
-    def generate_and_seal_key(rfid_passcode, fingerprint_message, fingerprint_message_signature):
-        # Create temporary data and signature files
-        Encryption.create_temporary_file("message", fingerprint_message)
-        Encryption.create_temporary_file("signature", fingerprint_message_signature)
+    # then store it within the TPM at key_addr, sealed against the RFID card passcode
+    def generate_and_seal_key(key_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        tpm = Encryption.tpm
 
         print("# STARTED generate and seal AES key")
-        stdout = utils.execute_command(["./encryption/scripts/generate_and_seal_key", rfid_passcode, Encryption.FINGERPRINT_KEY_ADDR, Encryption.get_temporary_file_path("message"), Encryption.get_temporary_file_path("signature")])
+        try:
+            with tpm.lock:
+                seal_policy = Encryption.seal_policy(rfid_passcode, fingerprint_message)
+                aes_key = tpm.get_random(32)
+
+                # The sealing key is created under the storage key, then made persistent at key_addr (replacing any key there)
+                storage_key = Encryption.storage_key()
+                private, public = tpm.create(storage_key, tpm_client.sealed_data_template(seal_policy), aes_key)
+                sealing_key = tpm.load(storage_key, private, public)
+
+                try:
+                    Encryption.evict_key(key_addr)
+                    tpm.evict_control(sealing_key, int(key_addr, 16))
+                finally:
+                    tpm.flush_context(sealing_key)
+        except TPMError as e:
+            print(f"# Could not seal AES key ({e})")
+            return False
         print("# FINISHED generate and seal AES key")
 
-        Encryption.delete_temporary_file("message")
-        Encryption.delete_temporary_file("signature")
-
         return True
 
-    # Creates a new AES key and then encrypts the drive with it
+    # Creates a key for the first user, and a new data key for every drive wrapped under it
+    # then creates the image of each drive under its data key, from the empty filesystem on the ramdisk
     def encrypt_new(rfid_passcode, fingerprint_message, fingerprint_message_signature):
-        Encryption.generate_and_seal_key(rfid_passcode, fingerprint_message, fingerprint_message_signature)
-        result = Encryption.encrypt(rfid_passcode, fingerprint_message, fingerprint_message_signature)
+        user_addr = config.USER_KEY_ADDRS[0]
+        Encryption.generate_and_seal_key(user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+
+        user_key = Encryption.unseal_key(user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+        if not user_key:
+            return False
+
+        for drive in Encryption.drives:
+            data_key = keyring.generate_data_key()
 
-        return result
+            drive_keyring = Keyring(drive.encrypted_image_path)
+            drive_keyring.add(user_addr, user_key, data_key)
+            drive_keyring.save()
+
+            try:
+                drive.create(data_key)
+            except OSError as e:
+                print(f"# Could not create the image of drive {drive.name} ({e})")
+                return False
+
+        return True
 
     # Generates a new passcode to be stored on the RFID card
     def generate_card_passcode():
@@ -43,121 +166,554 @@ class Encryption:
         print("# Generated new passcode")
         return passcode
 
-    # Unseal the AES key from the TPM
-    def unseal_key(rfid_passcode, fingerprint_message, fingerprint_message_signature):
-        # Create temporary data and signature files
-        Encryption.create_temporary_file("message", fingerprint_message)
-        Encryption.create_temporary_file("signature", fingerprint_message_signature)
+    # Unseal the AES key stored at key_addr from the TPM
+    def unseal_key(key_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        tpm = Encryption.tpm
 
         print("# STARTED unsealing key")
-        stdout = utils.execute_command(["./encryption/scripts/unseal_key", rfid_passcode, Encryption.FINGERPRINT_KEY_ADDR, Encryption.get_temporary_file_path("message"), Encryption.get_temporary_file_path("signature")])
+        try:
+            with tpm.lock:
+                session = Encryption.start_policy_session(rfid_passcode, fingerprint_message, fingerprint_message_signature)
+                try:
+                    aes_key = tpm.unseal(int(key_addr, 16), session)
+                except:
+                    # The session is only closed by a successful unseal
+                    tpm.flush_context(session)
+                    raise
+        except TPMError as e:
+            # A policy check fails if the authorization values are wrong (or there may be nothing stored at the address)
+            print(f"# Could not unseal key ({e})")
+            return False
         print("# FINISHED unsealing key")
 
-        if "a policy check failed" in stdout.decode("utf-8"):
+        # Anything else means there was no key to unseal (e.g. some other object is stored at the address)
+        if len(aes_key) != 32:
             return False
-        else:
-            aes_key = stdout.split(b"\n")[-2]
-            return aes_key
 
-    # Decrypts the file system
+        return aes_key.hex().encode("utf-8")
+
+    # Unseal the key at key_addr, unless it has already been tried with these authorization values
+    # user_keys holds the result of each address tried so far
+    def unseal_user_key(user_keys, key_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        if key_addr not in user_keys:
+            user_keys[key_addr] = Encryption.unseal_key(key_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+
+        return user_keys[key_addr]
+
+    # Unseal the data key of each of the drives, returning the keys of the drives the user is authorized for
+    # a drive with a keyring is unlocked by the key of any of its users, otherwise by the key sealed for the drive itself
+    # the keys are unsealed one at a time, as each unseal extends and resets the same PCR
+    # (and each user key is only unsealed once, however many drives it unlocks)
+    # if users is given, the (address, key) of the user who unlocked each drive with a keyring is added to it
+    def unseal_keys(drives, rfid_passcode, fingerprint_message, fingerprint_message_signature, users=None):
+        user_keys = {}
+        keys = {}
+        for drive in drives:
+            drive_keyring = Keyring(drive.encrypted_image_path)
+            try:
+                has_keyring = drive_keyring.load()
+            except ValueError as e:
+                print(f"# Keyring of drive {drive.name} is corrupt ({e})")
+                continue
+
+            if not has_keyring:
+                aes_key = Encryption.unseal_user_key(user_keys, drive.key_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+                if aes_key:
+                    keys[drive] = aes_key
+                continue
+
+            # The user keys already unsealed are tried first, then the ones not tried yet
+            users_of_drive = drive_keyring.users()
+            for user_addr in [addr for addr in users_of_drive if user_keys.get(addr)] + [addr for addr in users_of_drive if addr not in user_keys]:
+                user_key = Encryption.unseal_user_key(user_keys, user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+                if user_key:
+                    try:
+                        drive_keys = drive_keyring.unwrap(user_addr, user_key)
+                    except ValueError:
+                        print(f"# Keyring of drive {drive.name} is corrupt")
+                        break
+
+                    # A user who has not unlocked the drive since its key was rotated has the new key sealed for them
+                    if user_addr in drive_keyring.pending:
+                        generation, sealed_key = drive_keyring.pending[user_addr]
+                        pending_key = Encryption.unseal_sealed_key(sealed_key, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+                        if pending_key:
+                            drive_keys.append(pending_key)
+
+                    # A rotation that replaced the image but lost power before recording its key is finished now
+                    try:
+                        recovered_key = KeyRotation.recover_key(drive.encrypted_image_path, drive_keys)
+                    except (OSError, ValueError):
+                        recovered_key = None
+                    if recovered_key is not None:
+                        Encryption.record_rotated_key(drive, user_addr, user_key, recovered_key)
+                        os.remove(rotation_path(drive.encrypted_image_path))
+                        keys[drive] = recovered_key
+                        print(f"# Recorded the new key of the key rotation of drive {drive.name}")
+                    else:
+                        keys[drive] = drive.current_key(drive_keys)
+
+                        # A user whose entry is from before a key rotation has it wrapped under the current key
+                        # (only once the image is under the newest key, as the older keys are no longer reachable from it)
+                        if len(drive_keys) > 1 and keys[drive] == drive_keys[-1]:
+                            drive_keyring.add(user_addr, user_key, keys[drive])
+                            drive_keyring.prune()
+                            drive_keyring.save()
+
+                    if users is not None:
+                        users[drive] = (user_addr, user_key)
+                    break
+
+        return keys
+
+    # Seal a data key for a user, under the same policy as their sealed key, returning the key blobs of the sealed object
+    # (the policy is read from the user's sealed key, so their authorization values are not needed)
+    def seal_for_user(user_addr, data_key):
+        tpm = Encryption.tpm
+
+        with tpm.lock:
+            policy_digest = tpm_client.auth_policy(tpm.read_public(int(user_addr, 16)))
+            private, public = tpm.create(Encryption.storage_key(), tpm_client.sealed_data_template(policy_digest), bytes.fromhex(data_key.decode("utf-8")))
+
+        return tpm_client.tpm2b(private) + tpm_client.tpm2b(public)
+
+    # Unseal a data key sealed by seal_for_user, returning False if these authorization values are not the user's
+    def unseal_sealed_key(sealed_key, rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        tpm = Encryption.tpm
+
+        with tpm.lock:
+            try:
+                reader = tpm_client.ResponseReader(sealed_key)
+                handle = tpm.load(Encryption.storage_key(), reader.tpm2b(), reader.tpm2b())
+            except (ValueError, TPMError) as e:
+                print(f"# Could not load sealed key ({e})")
+                return False
+
+            try:
+                return Encryption.unseal_key(f"0x{handle:08x}", rfid_passcode, fingerprint_message, fingerprint_message_signature)
+            finally:
+                tpm.flush_context(handle)
+
+    # Record the new data key of a drive whose key has been rotated by a user
+    # it is wrapped under that user's key, and sealed in the TPM for each of the other users until they next unlock the drive
+    def record_rotated_key(drive, user_addr, user_key, data_key):
+        drive_keyring = Keyring(drive.encrypted_image_path)
+        drive_keyring.load()
+
+        try:
+            sealed = {addr: Encryption.seal_for_user(addr, data_key) for addr in drive_keyring.users() if addr != user_addr}
+        except TPMError as e:
+            raise ValueError(f"could not seal the new key for the other users ({e})")
+
+        drive_keyring.rotate(user_addr, user_key, data_key, sealed)
+        drive_keyring.save()
+
+    # Start rotating the key of a drive, from its data key, for the user (address, key) who unlocked it
+    def start_rotation(drive, aes_key, user):
+        user_addr, user_key = user
+        drive.start_rotation(aes_key, lambda new_key: Encryption.record_rotated_key(drive, user_addr, user_key, new_key))
+
+    # Run an operation on several drives at once, returning whether it succeeded for each of them
+    def run_on_drives(action, drives):
+        if not drives:
+            return []
+
+        with activity.working(), concurrent.futures.ThreadPoolExecutor(len(drives)) as pool:
+            return list(pool.map(action, drives))
+
+    # Decrypts the file system of every drive the user is authorized for, in parallel
+    # (drives with no image yet have nothing to decrypt, and no key to unseal)
     def decrypt(rfid_passcode, fingerprint_message, fingerprint_message_signature):
-        aes_key = Encryption.unseal_key(rfid_passcode, fingerprint_message, fingerprint_message_signature)
+        drives = [drive for drive in Encryption.drives if drive.exists()]
+        users = {}
+        keys = Encryption.unseal_keys(drives, rfid_passcode, fingerprint_message, fingerprint_message_signature, users)
 
-        if not aes_key:
+        if not keys:
             return False
-        
+
+        # The user who unlocked each drive is kept, for a key rotation to wrap the new key under
+        for drive, (user_addr, user_key) in users.items():
+            drive.user_addr = user_addr
+            drive.user_key_cache.store(user_key)
+
+        # The prefetched images are now read from the page cache, without the prefetchers competing for the SD card
+        Encryption.stop_prefetch()
+
         print("# STARTED decrypting file system")
-        stdout = utils.execute_command(["./encryption/scripts/decrypt", aes_key])
-        print("# FINISHED decrypting file system")
+        results = Encryption.run_on_drives(lambda drive: drive.decrypt(keys[drive]), list(keys))
+        Encryption.mounted_drives = [drive for drive, result in zip(keys, results) if result]
+        print(f"# FINISHED decrypting file system ({len(Encryption.mounted_drives)} drives)")
 
-        if "bad decrypt" in stdout.decode("utf-8"):
-            return False
+        return len(Encryption.mounted_drives) > 0
 
-        return True
+    # Encrypts the file system of every mounted drive, in parallel
+    # the keys cached when the drives were mounted are used if use_cached_key is set,
+    # otherwise (or if a cache has timed out) the keys are unsealed, which also checks the authorization values
+    def encrypt(rfid_passcode, fingerprint_message, fingerprint_message_signature, use_cached_key=False):
+        keys = {}
+        for drive in Encryption.mounted_drives:
+            keys[drive] = drive.key_cache.get() if use_cached_key else None
 
-    # Encrypts the file system and stores it in the ramdisk
-    def encrypt(rfid_passcode, fingerprint_message, fingerprint_message_signature):
-        aes_key = Encryption.unseal_key(rfid_passcode, fingerprint_message, fingerprint_message_signature)
+        missing = [drive for drive, aes_key in keys.items() if aes_key is None]
+        keys.update(Encryption.unseal_keys(missing, rfid_passcode, fingerprint_message, fingerprint_message_signature))
 
-        if not aes_key:
+        # Every mounted drive must be encrypted, so the user must be authorized for all of them
+        if any(not aes_key for aes_key in keys.values()):
             return False
 
         print("# STARTED encrypting file system")
-        stdout = utils.execute_command(["./encryption/scripts/encrypt", aes_key])
+        results = Encryption.run_on_drives(lambda drive: drive.encrypt(keys[drive]), list(keys))
         print("# FINISHED encrypting file system")
 
-        if "bad decrypt" in stdout.decode("utf-8"):
+        return all(results)
+
+    # Start reading the encrypted images ahead of decrypting them, before the user has authenticated
+    # (each gets an equal share of the prefetch size, as the images are all in the page cache at once)
+    def start_prefetch():
+        drives = [drive for drive in Encryption.drives if drive.exists()]
+        for drive in drives:
+            drive.start_prefetch(config.PREFETCH_SIZE // len(drives))
+
+    def stop_prefetch():
+        for drive in Encryption.drives:
+            drive.stop_prefetch()
+
+    # Start checkpointing the mounted drives in the background, using the keys cached when they were mounted
+    def start_checkpoints():
+        for drive in Encryption.mounted_drives:
+            drive.start_checkpoints()
+
+    # Stop checkpointing (before the drives are encrypted on eject, so the two never run at once)
+    def stop_checkpoints():
+        for drive in Encryption.drives:
+            drive.stop_checkpoints()
+
+    # Start rotating the data key of every mounted drive, which re-encrypts each image under a new key in the background
+    # the old key stays in use until the rotation is finished on eject, and a rotation left unfinished resumes on the next mount
+    def rotate_key(rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        users = {}
+        keys = Encryption.unseal_keys(Encryption.mounted_drives, rfid_passcode, fingerprint_message, fingerprint_message_signature, users)
+
+        if not keys:
             return False
-        
+
+        for drive, aes_key in keys.items():
+            # The new key is recorded in the keyring, and only chunked images can be re-encrypted a chunk at a time
+            if not Keyring(drive.encrypted_image_path).load():
+                print(f"# Not rotating the key of drive {drive.name}, it has no keyring (enrolling a user gives it one)")
+            elif not ImageFile.supports(drive.encrypted_image_path):
+                print(f"# Not rotating the key of drive {drive.name}, its image is in an older format")
+            elif drive.rotation is None:
+                Encryption.start_rotation(drive, aes_key, users[drive])
+
+        return True
+
+    # Resume the key rotations that had not finished when the drives were last ejected
+    # using the keys cached when they were mounted (the new key is wrapped for the user who mounted the drive)
+    def resume_rotations():
+        for drive in Encryption.mounted_drives:
+            aes_key = drive.key_cache.get()
+            user_key = drive.user_key_cache.get()
+            if aes_key is not None and user_key is not None and KeyRotation.pending(drive.encrypted_image_path):
+                Encryption.start_rotation(drive, aes_key, (drive.user_addr, user_key))
+
+    # Pause the key rotations (before the drives are encrypted on eject, which then finishes them)
+    def stop_rotations():
+        for drive in Encryption.drives:
+            drive.stop_rotation()
+
+    # Progress of the key rotation of each mounted drive whose key is being rotated, as {name: percent}
+    def rotation_progress():
+        progress = {}
+        for drive in Encryption.mounted_drives:
+            percent = drive.rotation_progress()
+            if percent is not None:
+                progress[drive.name] = percent
+
+        return progress
+
+    # Zeroize the cached keys of every drive
+    def clear_keys():
+        for drive in Encryption.drives:
+            drive.key_cache.clear()
+            drive.user_key_cache.clear()
+            drive.user_addr = None
+
+        Encryption.clear_enroll_keys()
+
+    # Forget the data keys unlocked for enrolling a user (once they are enrolled, or if enrolling them does not finish)
+    def clear_enroll_keys():
+        Encryption.enroll_keys = {}
+
+    # Close the drives once they have been encrypted (or if the program stops), after which none are mounted
+    def close_drives():
+        for drive in Encryption.drives:
+            drive.close_lazy_image()
+
+        Encryption.mounted_drives = []
+
+    # Name that an image of a drive is saved under in the chunk store, from the time it was saved (so the names sort by age)
+    # down to the microsecond, so saves in the same second do not share a name
+    def saved_image_name(drive):
+        now = time.time()
+        return f"{drive.name}@{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now * 1000000) % 1000000:06d}"
+
+    # Names of the saved images of a drive, oldest first
+    def saved_images(drive):
+        return [name for name in ChunkStore().list() if name.startswith(f"{drive.name}@")]
+
+    # Save the encrypted image of every drive in the chunk store, which only stores the chunks it does not already have
+    # (each drive's chunks are under its own data key, so only the saved images of the same drive share chunks)
+    def save_images(rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        drives = [drive for drive in Encryption.drives if drive.exists()]
+        keys = Encryption.unseal_keys(drives, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+
+        if not keys:
+            return False
+
+        Encryption.failed_drives = []
+        for drive, aes_key in keys.items():
+            try:
+                ChunkStore().save_image(aes_key, drive.encrypted_image_path, Encryption.saved_image_name(drive))
+            except (OSError, ValueError) as e:
+                print(f"# Could not save the image of drive {drive.name} ({e})")
+                Encryption.failed_drives.append(drive.name)
+
+        return True
+
+    # Replace the encrypted image of every drive that has a saved image with the newest one (while the drives are not mounted)
+    # the image it replaces is kept as the previous image (see snapshots.keep_previous)
+    def restore_images(rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        drives = [drive for drive in Encryption.drives if Encryption.saved_images(drive)]
+        keys = Encryption.unseal_keys(drives, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+
+        if not keys:
+            return False
+
+        Encryption.failed_drives = []
+        for drive, aes_key in keys.items():
+            name = Encryption.saved_images(drive)[-1]
+            try:
+                ChunkStore().restore_image(aes_key, name, drive.encrypted_image_path)
+            except (OSError, ValueError) as e:
+                print(f"# Could not restore image {name} ({e})")
+                Encryption.failed_drives.append(drive.name)
+
+        return True
+
+    # Addresses of the user keys that any drive's keyring refers to
+    def enrolled_users():
+        users = set()
+        for drive in Encryption.drives:
+            drive_keyring = Keyring(drive.encrypted_image_path)
+            try:
+                if drive_keyring.load():
+                    users.update(drive_keyring.users())
+            except ValueError as e:
+                print(f"# Keyring of drive {drive.name} is corrupt ({e})")
+
+        return users
+
+    # Address for the key of a new user, or None if every address in config.USER_KEY_ADDRS is in use
+    def free_user_addr():
+        enrolled = Encryption.enrolled_users()
+        for user_addr in config.USER_KEY_ADDRS:
+            if user_addr not in enrolled:
+                return user_addr
+
+        return None
+
+    # Number of the user with a key at user_addr (which is also the id of their saved fingerprint)
+    def user_number(user_addr):
+        return config.USER_KEY_ADDRS.index(user_addr)
+
+    # Unlock every drive with the authorization values of an existing user, ready to enroll a new user
+    # drives without a keyring are given one first, wrapping their data key under a new key sealed for this user
+    def unlock_for_enroll(rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        drives = [drive for drive in Encryption.drives if drive.exists()]
+        keys = Encryption.unseal_keys(drives, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+
+        if not keys:
+            return False
+
+        legacy_drives = [drive for drive in keys if not Keyring(drive.encrypted_image_path).load()]
+        if legacy_drives:
+            user_addr = Encryption.free_user_addr()
+            Encryption.generate_and_seal_key(user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+            user_key = Encryption.unseal_key(user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+            if not user_key:
+                return False
+
+            for drive in legacy_drives:
+                drive_keyring = Keyring(drive.encrypted_image_path)
+                drive_keyring.add(user_addr, user_key, keys[drive])
+                drive_keyring.save()
+
+                # The data key is now only reachable through the keyring
+                Encryption.evict_key(drive.key_addr)
+
+        Encryption.enroll_keys = keys
+        return True
+
+    # Enroll a new user (whose card and fingerprint have just been set up) for every drive unlocked by unlock_for_enroll
+    # this wraps each data key under a new key sealed for the user, so no image is re-encrypted
+    def enroll_user(rfid_passcode, fingerprint_message, fingerprint_message_signature):
+        user_addr = Encryption.free_user_addr()
+        if user_addr is None:
+            print("# No room for another user")
+            return True
+
+        Encryption.generate_and_seal_key(user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+
+        # Unsealing the new key also checks the new user's authorization values
+        user_key = Encryption.unseal_key(user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature)
+        if not user_key:
+            return False
+
+        for drive, data_key in Encryption.enroll_keys.items():
+            drive_keyring = Keyring(drive.encrypted_image_path)
+            drive_keyring.load()
+            drive_keyring.add(user_addr, user_key, data_key)
+            drive_keyring.save()
+
+        Encryption.clear_enroll_keys()
+        print(f"# Enrolled user {Encryption.user_number(user_addr)}")
+
+        return True
+
+    # Revoke the user with these authorization values from every drive, by deleting their wrapped keys and sealed key
+    # then remove_fingerprint(user number) deletes their saved fingerprint
+    # the last user of a drive is never revoked, as nobody could use the drive again
+    def revoke_user(rfid_passcode, fingerprint_message, fingerprint_message_signature, remove_fingerprint=None):
+        for user_addr in Encryption.enrolled_users():
+            if Encryption.unseal_key(user_addr, rfid_passcode, fingerprint_message, fingerprint_message_signature):
+                break
+        else:
+            return False
+
+        keyrings = []
+        for drive in Encryption.drives:
+            drive_keyring = Keyring(drive.encrypted_image_path)
+            try:
+                if drive_keyring.load() and user_addr in drive_keyring.users():
+                    keyrings.append(drive_keyring)
+            except ValueError as e:
+                print(f"# Keyring of drive {drive.name} is corrupt ({e})")
+
+        if any(len(drive_keyring.users()) == 1 for drive_keyring in keyrings):
+            print("# Not revoking the last user of a drive")
+            return True
+
+        for drive_keyring in keyrings:
+            drive_keyring.remove(user_addr)
+            drive_keyring.save()
+        Encryption.evict_key(user_addr)
+        if remove_fingerprint is not None:
+            remove_fingerprint(Encryption.user_number(user_addr))
+        print(f"# Revoked user {Encryption.user_number(user_addr)}")
+
+        return True
+
+    # Delete a key from persistent memory within the TPM, returning False if there was none
+    def evict_key(key_addr):
+        try:
+            Encryption.tpm.evict_control(int(key_addr, 16), int(key_addr, 16))
+        except TPMError:
+            return False
+
+        print("# Evicted key: " + key_addr)
         return True
 
     # Specify the host and port for the TPM server in the shell environment variables
+    # (TPM operations go through Encryption.tpm, this lets the tpm2-tools reach the same simulator when debugging)
     def get_tpm_shell_env():
         env = os.environ.copy()
-        env["TPM2TOOLS_TCTI"] = "mssim:host=localhost,port=2321"
+        env["TPM2TOOLS_TCTI"] = f"mssim:host={tpm_client.TPM_HOST},port={tpm_client.TPM_COMMAND_PORT}"
         
         return env
 
-
+    # The storage key (the primary key that the other keys are created under), made persistent the first time it is needed
+    # so it is only generated once after the TPM is cleared, rather than for every key that is created
+    def storage_key():
+        tpm = Encryption.tpm
+        handle = int(Encryption.STORAGE_KEY_ADDR, 16)
+
+        with tpm.lock:
+            try:
+                tpm.read_public(handle)
+            except TPMError:
+                primary = tpm.create_primary(tpm_client.primary_template())
+                try:
+                    tpm.evict_control(primary, handle)
+                finally:
+                    tpm.flush_context(primary)
+
+        return handle
+
+    # Start and stop generating RSA keys for the key pool in the background
+    def start_key_pool():
+        Encryption.key_pool.start()
+
+    def stop_key_pool():
+        Encryption.key_pool.stop()
+
+    # Stop the worker processes that encrypt and decrypt chunks (they are kept running between passes)
+    def stop_workers():
+        chunk_crypto.shutdown_pools()
+
+    # Create the RSA key pairs of the Raspberry Pi and of the fingerprint sensor, and make them persistent
+    # each is taken from the key pool if it has one ready, otherwise it is generated now
+    # (the fingerprint sensor would have its own TPM and import its key in a real implementation)
     def generate_fingerprint_communication_keys():
-        stdout = utils.execute_command(["./encryption/scripts/generate_fingerprint_communcation_keys"])
-        print("# Generated encryption keys for communication with fingerprint sensor")
+        tpm = Encryption.tpm
+
+        with tpm.lock:
+            storage_key = Encryption.storage_key()
+            for key_addr in (Encryption.RASPBERRY_KEY_ADDR, Encryption.FINGERPRINT_KEY_ADDR):
+                private, public = Encryption.key_pool.take(storage_key) or tpm.create(storage_key, tpm_client.rsa_key_template())
+                key = tpm.load(storage_key, private, public)
+                try:
+                    Encryption.evict_key(key_addr)
+                    tpm.evict_control(key, int(key_addr, 16))
+                finally:
+                    tpm.flush_context(key)
+
+                if key_addr == Encryption.FINGERPRINT_KEY_ADDR:
+                    Encryption.fingerprint_key_name_cache = policy.object_name(public)
 
+        print("# Generated encryption keys for communication with fingerprint sensor")
 
     def asymm_encrypt_data(key_addr, data):
-        # Create temporary data file
-        Encryption.create_temporary_file("data", data)
-
-        stdout = utils.execute_command(["./encryption/scripts/asymm_encrypt_data", key_addr, Encryption.get_temporary_file_path("data")], False)
-
-        # Remove temporary data file
-        Encryption.delete_temporary_file("data")
-
+        ciphertext = Encryption.tpm.rsa_encrypt(int(key_addr, 16), data)
         print("# Encrypted data with key: " + key_addr)
 
-        return stdout
-
+        return ciphertext
 
     def asymm_decrypt_data(key_addr, data):
-        # Create temporary data file
-        Encryption.create_temporary_file("data", data)
-
-        stdout = utils.execute_command(["./encryption/scripts/asymm_decrypt_data", key_addr, Encryption.get_temporary_file_path("data")], False)
-
-        # Remove temporary data file
-        Encryption.delete_temporary_file("data")
-
+        plaintext = Encryption.tpm.rsa_decrypt(int(key_addr, 16), data)
         print("# Decrypted data with key: " + key_addr)
         
-        return stdout
+        return plaintext
 
+    # Sign with the key at key_addr, returning the signature (a TPMT_SIGNATURE)
+    # what is signed is the digest of an expiration of zero (4 zero bytes), which is what PolicySigned checks,
+    # so that the fingerprint sensor's signature can authorize the policy sessions of the sealed keys
+    # (the data itself is not signed)
     def create_signature(key_addr, data):
-        # Create temporary data file
-        Encryption.create_temporary_file("data", data)
+        # Prevent DA lockout by clearing the counter
+        Encryption.tpm.dictionary_attack_lock_reset()
 
-        # Create a signature from the data file
-        stdout = utils.execute_command(["./encryption/scripts/create_signature", key_addr, Encryption.get_temporary_file_path("data")], False)
+        signature = Encryption.tpm.sign(int(key_addr, 16), hashlib.sha256(bytes(4)).digest())
         print("# Created signature")
 
-        # Remove temporary data file
-        Encryption.delete_temporary_file("data")
-
-        return stdout
+        return signature
 
+    # Whether a signature made by create_signature is valid for the key at key_addr
     def verify_signature(key_addr, data, signature):
-        # Create temporary data and signature files
-        Encryption.create_temporary_file("data", data)
-        Encryption.create_temporary_file("signature", signature)
-
-        # Verify the data file against the provided signature
-        stdout = utils.execute_command(["./encryption/scripts/verify_signature", key_addr, Encryption.get_temporary_file_path("data"), Encryption.get_temporary_file_path("signature")], False)
-        print("# Verified signature")
-
-        # Remove temporary data and signature files
-        Encryption.delete_temporary_file("data")
-        Encryption.delete_temporary_file("signature")
+        valid = Encryption.tpm.verify_signature(int(key_addr, 16), hashlib.sha256(bytes(4)).digest(), signature)
+        print("# Verified signature" if valid else "# Verify signature failed")
 
-        return stdout
+        return valid
 
     def encrypt_signature(key_addr, signature):
         part_1 = Encryption.asymm_encrypt_data(key_addr, signature[:len(signature)//2])
@@ -170,17 +726,3 @@ class Encryption:
         part_2 = Encryption.asymm_decrypt_data(key_addr, encrypted_signature[len(encrypted_signature)//2:])
 
         return part_1 + part_2
-
-    # Get the path of a specific temporary file
-    def get_temporary_file_path(name):
-        return "./storage/ramdisk/{name}.temp".format(name=name)
-
-    # Writes data to a temporary file so it can be read by the script (as null bytes are not allowed)
-    def create_temporary_file(name, data):
-        f = open(Encryption.get_temporary_file_path(name), "wb")
-        f.write(data)
-        f.close()
-
-    # Remove the temporary file
-    def delete_temporary_file(name):
-        os.remove(Encryption.get_temporary_file_path(name))
\ No newline at end of file
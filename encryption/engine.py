@@ -0,0 +1,577 @@
+import concurrent.futures
+import errno
+import hashlib
+import hmac
+import os
+import time
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import config
+from encryption import image_format
+from encryption import chunk_crypto
+from encryption import exfat
+from encryption import journal
+from encryption import progress
+from encryption import pipeline
+from encryption import snapshots
+
+# AES block size in bytes
+BLOCK_SIZE = 16
+
+# Key derivation used by "openssl enc -nosalt -aes-256-cbc -md sha512 -pbkdf2"
+# (kept identical so that existing encrypted images can still be read)
+LEGACY_KDF_DIGEST = "sha512"
+LEGACY_KDF_ITERATIONS = 10000
+LEGACY_KEY_SIZE = 32
+
+# AES-256-XTS takes two AES-256 keys
+XTS_KEY_SIZE = 64
+
+# Binds keys derived for the chunked image format to that purpose
+HKDF_INFO = b"piusb chunked image key"
+
+# Derive the AES key and IV from the unsealed key, in the same way as openssl
+def derive_legacy_key(aes_key):
+    key_iv = hashlib.pbkdf2_hmac(LEGACY_KDF_DIGEST, aes_key, b"", LEGACY_KDF_ITERATIONS, LEGACY_KEY_SIZE + BLOCK_SIZE)
+
+    return key_iv[:LEGACY_KEY_SIZE], key_iv[LEGACY_KEY_SIZE:]
+
+# Derive the key that the chunks of an image are encrypted with
+def derive_chunk_key(aes_key, header):
+    key_size = XTS_KEY_SIZE if header.cipher == image_format.CIPHER_AES_256_XTS else LEGACY_KEY_SIZE
+
+    # Version 1 images use the legacy derivation, but each chunk has its own IV instead of the derived one
+    if header.version == 1:
+        return hashlib.pbkdf2_hmac(LEGACY_KDF_DIGEST, aes_key, b"", LEGACY_KDF_ITERATIONS, key_size)
+
+    # The unsealed key is 32 random bytes from the TPM (in hex), so it does not need stretching
+    # a single HKDF step is enough to derive a key of the right size for the cipher
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=key_size, salt=None, info=HKDF_INFO + bytes([header.cipher]))
+    return hkdf.derive(bytes.fromhex(bytes(aes_key).decode("utf-8")))
+
+# Value stored in the image header, used to detect a wrong key before anything is decrypted
+def key_check_value(chunk_key):
+    return hmac.new(chunk_key, b"key check", "sha256").digest()[:16]
+
+# Digest of the plaintext of a chunk, used to find the chunks that have changed since the image was decrypted
+def chunk_digest(view):
+    return hashlib.blake2b(view, digest_size=16).digest()
+
+# Fill a buffer from an unbuffered file (raw reads may be partial), returning the number of bytes read
+def read_exact(f, view):
+    total = 0
+    while total < len(view):
+        n = f.readinto(view[total:])
+        if n == 0:
+            break
+        total += n
+
+    return total
+
+# Write the whole of a buffer to an unbuffered file (raw writes may be partial)
+def write_all(f, view):
+    while len(view) > 0:
+        written = f.write(view)
+        view = view[written:]
+
+# Sync the directory holding a file, so that a file just renamed into it (e.g. by os.replace) stays there if power is lost
+def fsync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Indexes of the chunks of a sparse file that hold data (the rest are holes in the file, so they are all zeros)
+def data_chunks(path, chunk_size):
+    chunks = set()
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(f.fileno(), offset, os.SEEK_DATA)
+            except OSError as e:
+                # There is no data after offset
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+
+            end = os.lseek(f.fileno(), start, os.SEEK_HOLE)
+            chunks.update(range(start // chunk_size, (end - 1) // chunk_size + 1))
+            offset = end
+
+    return chunks
+
+# Print and return the throughput of a completed pass
+def report_throughput(action, total_bytes, elapsed):
+    bytes_per_second = total_bytes / elapsed if elapsed > 0 else float("inf")
+    print(f"# {action} {total_bytes} bytes in {elapsed:.2f}s ({bytes_per_second:.0f} bytes/s)")
+
+    return bytes_per_second
+
+class StreamEngine:
+    # throttle, if given, is called before each plaintext chunk is read (so a background pass can wait for the host to be idle)
+    def __init__(self, chunk_size=image_format.CHUNK_SIZE, workers=config.ENCRYPTION_WORKERS, exfat_aware=config.EXFAT_AWARE_ENCRYPTION, compression=config.IMAGE_COMPRESSION, throttle=None):
+        self.workers = workers
+        self.throttle = throttle
+        self.exfat_aware = exfat_aware
+        self.compression = image_format.COMPRESSIONS[compression]
+        self.allocate_buffers(chunk_size)
+
+    # Buffers are allocated once and reused for every chunk of the stream
+    # the input has room for the final padding block, the output has the extra space update_into requires
+    # (chunked images are transformed through the buffers of a Pipeline instead, these are only used for legacy images)
+    def allocate_buffers(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.in_buffer = bytearray(chunk_size + BLOCK_SIZE)
+        self.out_buffer = bytearray(chunk_size + chunk_crypto.OUTPUT_MARGIN)
+
+        # Used to find the chunks that are all zeros
+        self.zero_chunk = bytes(chunk_size)
+        self.zero_chunk_digest = chunk_digest(self.zero_chunk)
+
+    # Pipeline with buffers big enough for a chunk of the image, and the extra space update_into requires
+    def create_pipeline(self, header):
+        if header.chunk_size != self.chunk_size:
+            self.allocate_buffers(header.chunk_size)
+
+        return pipeline.Pipeline(header.chunk_size + chunk_crypto.OUTPUT_MARGIN)
+
+    # The crypto stage of the pipeline
+    # encrypt or decrypt (index, entry, data) jobs, yielding (index, entry, result) in the same order
+    # when encrypting, the flags of the entry are updated to say whether the chunk was compressed
+    # jobs with no data are holes, which are passed straight through with no result
+    # the data of each job is in a buffer from the in pool, which is returned once the chunk has been handed on,
+    # and each result is in a buffer from the out pool, which the writer returns once it has been written
+    def crypt_chunks(self, encrypt, header, chunk_key, pipe, jobs):
+        # A memoryview of part of a pool buffer still refers to the whole buffer through obj
+        def release(data):
+            pipe.in_buffers.put(data.obj)
+
+        if self.workers <= 1:
+            for index, entry, data in jobs:
+                if data is None:
+                    yield index, entry, None
+                    continue
+
+                out_view = memoryview(pipe.out_buffers.get())
+                if encrypt:
+                    flags, m = chunk_crypto.encrypt_chunk(header.cipher, chunk_key, header.compression, index, entry.iv, data, out_view)
+                    entry.flags |= flags
+                else:
+                    m = chunk_crypto.decrypt_chunk(header.cipher, chunk_key, header.compression, header.chunk_size, index, entry.iv, entry.flags, data, out_view)
+                release(data)
+
+                yield index, entry, out_view[:m]
+        else:
+            pool = chunk_crypto.shared_pool(self.workers)
+            try:
+                for index, entry, result in pool.map(encrypt, header, chunk_key, jobs, release):
+                    if result is None:
+                        yield index, entry, None
+                        continue
+
+                    # Results are moved into the out pool, so the writer handles them the same way as above
+                    out_view = memoryview(pipe.out_buffers.get())
+                    out_view[:len(result)] = result
+                    yield index, entry, out_view[:len(result)]
+            except concurrent.futures.BrokenExecutor:
+                chunk_crypto.discard_pool(pool)
+                raise
+
+    # Check whether a chunk of plaintext is all zeros (never written, or zeroed by the filesystem)
+    def is_zero(self, view):
+        zero = self.zero_chunk if len(view) == self.chunk_size else bytes(len(view))
+        return view.tobytes() == zero
+
+    # Digest of a chunk of zeros of the given length
+    def zero_digest(self, length):
+        return self.zero_chunk_digest if length == self.chunk_size else chunk_digest(bytes(length))
+
+    # Find the chunks of a plaintext image that the filesystem is using, if exFAT aware encryption is enabled
+    # returns None if every chunk should be kept
+    def allocated_chunks(self, in_path, header):
+        if not self.exfat_aware:
+            return None
+
+        return exfat.allocated_chunks(in_path, header.image_size, header.chunk_size)
+
+    # The reader stage when encrypting
+    # read the chunks of a plaintext file as (index, entry, data) jobs, each padded to the full chunk size
+    # chunks that are all zeros, or that allocated marks as unused, are stored as holes so they are returned with no data
+    # (the entry of each job is new, its length is filled in once the chunk is written)
+    # if chunk_digests is given, only the chunks whose digest differs from it are returned
+    # (a chunk with no digest was never decrypted by a LazyImage, so it cannot have changed and is not even read)
+    # the digest of every chunk that is returned is stored in new_digests
+    def read_plaintext_chunks(self, fin, header, pipe, chunk_digests=None, new_digests=None, allocated=None):
+        for index in range(header.chunk_count):
+            length = header.chunk_length(index)
+
+            if chunk_digests is not None and chunk_digests[index] is None:
+                continue
+
+            if self.throttle is not None:
+                self.throttle()
+
+            # Chunks holding only free clusters are never read, as their contents do not matter
+            if allocated is not None and not allocated[index]:
+                in_view = None
+                digest = self.zero_digest(length)
+            else:
+                in_view = memoryview(pipe.in_buffers.get())
+
+                fin.seek(index * header.chunk_size)
+                if read_exact(fin, in_view[:length]) != length:
+                    raise ValueError("image changed size while encrypting")
+
+                if self.is_zero(in_view[:length]):
+                    pipe.in_buffers.put(in_view.obj)
+                    in_view = None
+                    digest = self.zero_digest(length)
+                else:
+                    digest = chunk_digest(in_view[:length])
+
+            if chunk_digests is not None and digest == chunk_digests[index]:
+                if in_view is not None:
+                    pipe.in_buffers.put(in_view.obj)
+                continue
+            if new_digests is not None:
+                new_digests[index] = digest
+
+            if in_view is None:
+                yield index, image_format.ChunkEntry(bytes(image_format.IV_SIZE), image_format.CHUNK_HOLE, 0), None
+                continue
+
+            # The final chunk is padded with zeros up to the full chunk size
+            in_view[length:header.chunk_size] = bytes(header.chunk_size - length)
+
+            # Chunks get a fresh random IV every time they are written
+            # (XTS chunks are tweaked by their index instead, but the IV still gives every write a new table entry,
+            # which is how a key rotation finds the chunks that have changed since it re-encrypted them)
+            iv = os.urandom(image_format.IV_SIZE)
+
+            yield index, image_format.ChunkEntry(iv, 0, 0), in_view[:header.chunk_size]
+
+    # The reader stage when decrypting
+    # read the stored chunks of an image as (index, entry, data) jobs, holes are returned with no data
+    def read_encrypted_chunks(self, fin, header, entries, pipe):
+        for index, entry in enumerate(entries):
+            if entry.flags & image_format.CHUNK_HOLE:
+                yield index, entry, None
+                continue
+
+            # Compressed chunks are shorter than the chunk size, so only their stored length is read
+            if entry.length > header.chunk_size:
+                raise ValueError("corrupt chunk table")
+
+            in_view = memoryview(pipe.in_buffers.get())
+            fin.seek(header.chunk_offset(entry.slot_index(index)))
+            if read_exact(fin, in_view[:entry.length]) != entry.length:
+                raise ValueError("truncated image")
+
+            yield index, entry, in_view[:entry.length]
+
+    # Run the stages of a pipeline that records its progress, so that if it fails it can be resumed
+    # the chunks completed before the failure are committed to the progress file before the error is raised
+    def run_resumable(self, pipe, progress, fout, read, crypt, write):
+        try:
+            pipe.run(read, crypt, write)
+        except:
+            progress.commit(fout)
+            progress.close()
+            raise
+
+        progress.commit(fout)
+
+    # Decrypt a chunked image into a plaintext file
+    # holes are skipped rather than written, so they stay sparse in the plaintext file (and take no RAM on tmpfs)
+    # if a chunk_digests list is given, it is filled with the digest of each plaintext chunk
+    # (a decrypt is not resumed, as its output is on the ramdisk, which is mounted afresh for every attempt)
+    # raises a ValueError if the key is wrong or the image is corrupt
+    def decrypt_image(self, aes_key, in_path, out_path, chunk_digests=None):
+        journal.recover(in_path)
+
+        start = time.monotonic()
+        with open(in_path, "rb", buffering=0) as fin, open(out_path, "wb", buffering=0) as fout:
+            header, entries = image_format.read_header_and_table(fin)
+
+            chunk_key = derive_chunk_key(aes_key, header)
+            if not hmac.compare_digest(key_check_value(chunk_key), header.key_check):
+                raise ValueError("bad decrypt")
+
+            pipe = self.create_pipeline(header)
+            fout.truncate(header.image_size)
+
+            digests = [None] * header.chunk_count
+            stored = 0
+
+            def write(index, entry, plaintext):
+                nonlocal stored
+                length = header.chunk_length(index)
+
+                if plaintext is None:
+                    digests[index] = self.zero_digest(length)
+                    return
+
+                fout.seek(index * header.chunk_size)
+                write_all(fout, plaintext[:length])
+
+                digests[index] = chunk_digest(plaintext[:length])
+                pipe.out_buffers.put(plaintext.obj)
+                stored += 1
+
+            pipe.run(lambda: self.read_encrypted_chunks(fin, header, entries, pipe), lambda jobs: self.crypt_chunks(False, header, chunk_key, pipe, jobs), write)
+
+        if chunk_digests is not None:
+            chunk_digests[:] = digests
+
+        print(f"# {stored} of {header.chunk_count} chunks decrypted were stored, the rest are holes")
+        return report_throughput("Decrypted", header.image_size, time.monotonic() - start)
+
+    # Encrypt a plaintext file into a chunked image
+    # chunks that are all zeros are stored as holes, which take no space in the (sparse) image file
+    # if chunk_digests holds the digests recorded when the image was decrypted, only the chunks that
+    # have changed since are re-encrypted and rewritten, otherwise it is filled in for the next time
+    def encrypt_image(self, aes_key, in_path, out_path, chunk_digests=None):
+        if chunk_digests and image_format.is_chunked_image(out_path):
+            bytes_per_second = self.update_image(aes_key, in_path, out_path, chunk_digests)
+            if bytes_per_second is not None:
+                return bytes_per_second
+
+            # Chunks that were never decrypted are not in the plaintext file, so it cannot replace the image
+            if None in chunk_digests:
+                raise ValueError("image was only partly decrypted, so it cannot be rewritten in full")
+
+        return self.rewrite_image(aes_key, in_path, out_path, chunk_digests)
+
+    # Encrypt a plaintext file into a new chunked image, which replaces the old one once it is complete
+    # the new image is written next to the old one, so the old image is untouched if it is interrupted,
+    # and trying again with the same key resumes it (skipping the chunks it completed that have not changed since)
+    def rewrite_image(self, aes_key, in_path, out_path, chunk_digests=None):
+        partial_path = out_path + ".partial"
+
+        start = time.monotonic()
+        with open(in_path, "rb", buffering=0) as fin:
+            header = image_format.Header(os.fstat(fin.fileno()).st_size, self.chunk_size, compression=self.compression)
+
+            chunk_key = derive_chunk_key(aes_key, header)
+            header.key_check = key_check_value(chunk_key)
+
+            # An earlier attempt is only resumed if it was writing an image with the same layout and key
+            encrypt_progress = progress.Progress(partial_path, header.pack())
+            completed = encrypt_progress.load() if os.path.exists(partial_path) else {}
+
+            entries = [None] * header.chunk_count
+            digests = [None] * header.chunk_count
+
+            # Completed chunks are read again, and only skipped if their plaintext still matches
+            # (chunks with no earlier digest never match, so they are always encrypted)
+            resume_digests = [b""] * header.chunk_count
+            for index, (entry, digest) in completed.items():
+                entries[index] = entry
+                digests[index] = digest
+                resume_digests[index] = digest
+
+            with open(partial_path, "r+b" if completed else "wb", buffering=0) as fout:
+                pipe = self.create_pipeline(header)
+
+                # Chunks that are never written are left as holes in the file
+                fout.truncate(header.file_size())
+                encrypt_progress.begin(bool(completed))
+
+                new_digests = {}
+
+                def write(index, entry, ciphertext):
+                    entries[index] = self.write_chunk(fout, header, index, entry, ciphertext)
+                    if ciphertext is not None:
+                        pipe.out_buffers.put(ciphertext.obj)
+
+                    digests[index] = new_digests.pop(index)
+                    encrypt_progress.add(fout, index, entries[index], digests[index])
+
+                allocated = self.allocated_chunks(in_path, header)
+                self.run_resumable(pipe, encrypt_progress, fout, lambda: self.read_plaintext_chunks(fin, header, pipe, resume_digests, new_digests, allocated), lambda jobs: self.crypt_chunks(True, header, chunk_key, pipe, jobs), write)
+
+                if completed:
+                    print(f"# Resumed encrypt, {len(completed)} of {header.chunk_count} chunks had already been encrypted")
+
+                # The table is only written once every chunk is in place
+                image_format.write_header_and_table(fout, header, entries)
+                os.fsync(fout.fileno())
+
+        # A journal left from updating the old image does not apply to the new one
+        # nor do the snapshots of the old image, so they are kept with it (see snapshots.keep_previous)
+        snapshots.keep_previous(out_path)
+        journal.Journal(out_path).discard()
+
+        os.replace(partial_path, out_path)
+        fsync_directory(out_path)
+        encrypt_progress.finish()
+
+        if chunk_digests is not None:
+            chunk_digests[:] = digests
+
+        return report_throughput("Encrypted", header.image_size, time.monotonic() - start)
+
+    # Create a new chunked image of image_size bytes that is all holes
+    # if in_path is given (a sparse plaintext file, e.g. a freshly formatted filesystem), only the chunks of it that hold
+    # data are then read and encrypted into the image, so nothing of the size of the drive is written, in RAM or on the SD card
+    # an image it replaces is not kept (see snapshots.keep_previous), as a new image is only created for a new key
+    def create_image(self, aes_key, out_path, image_size, in_path=None):
+        partial_path = out_path + ".partial"
+
+        header = image_format.Header(image_size, self.chunk_size, compression=self.compression)
+        header.key_check = key_check_value(derive_chunk_key(aes_key, header))
+        entries = [image_format.ChunkEntry(bytes(image_format.IV_SIZE), image_format.CHUNK_HOLE, 0) for index in range(header.chunk_count)]
+
+        with open(partial_path, "wb", buffering=0) as fout:
+            fout.truncate(header.file_size())
+            image_format.write_header_and_table(fout, header, entries)
+            os.fsync(fout.fileno())
+
+        # Nor does anything left from rewriting the old image
+        if os.path.exists(progress.progress_path(partial_path)):
+            os.remove(progress.progress_path(partial_path))
+        snapshots.keep_previous(out_path, False)
+        journal.Journal(out_path).discard()
+
+        os.replace(partial_path, out_path)
+        fsync_directory(out_path)
+
+        print(f"# Created a blank image of {image_size} bytes")
+
+        if in_path is not None:
+            # Chunks with data are compared against zeros, so only the ones that are not all zeros are encrypted
+            data = data_chunks(in_path, header.chunk_size)
+            chunk_digests = [self.zero_digest(header.chunk_length(index)) if index in data else None for index in range(header.chunk_count)]
+            if self.update_image(aes_key, in_path, out_path, chunk_digests) is None:
+                raise ValueError("the plaintext file is not the size of the image")
+
+    # Re-encrypt only the chunks whose digest differs from chunk_digests, in an existing image
+    # the changed chunks are written to free slots, then the table is switched over to them through a journal,
+    # so the update is atomic even if power is lost part way through
+    # before_commit, if given, is called once the changed chunks are written, and abandons the update if it raises
+    # returns None without changing anything if the image does not match the plaintext file and key, or is an older version
+    def update_image(self, aes_key, in_path, out_path, chunk_digests, before_commit=None):
+        journal.recover(out_path)
+
+        start = time.monotonic()
+        with open(in_path, "rb", buffering=0) as fin, open(out_path, "r+b", buffering=0) as fout:
+            header, entries = image_format.read_header_and_table(fout)
+
+            # Images in an older version are rewritten in full, upgrading them to the current key schedule
+            if header.version != image_format.VERSION:
+                return None
+
+            chunk_key = derive_chunk_key(aes_key, header)
+            if not hmac.compare_digest(key_check_value(chunk_key), header.key_check):
+                return None
+            if header.image_size != os.fstat(fin.fileno()).st_size or len(chunk_digests) != header.chunk_count:
+                return None
+
+            pipe = self.create_pipeline(header)
+
+            new_digests = {}
+            written_digests = {}
+            changes = journal.Journal(out_path)
+            changes.begin()
+
+            # Neither the current version of a chunk nor one a snapshot still refers to is overwritten
+            allocator = snapshots.SlotAllocator(header, entries, snapshots.SnapshotStore(out_path).protected_slots())
+
+            def write(index, entry, ciphertext):
+                if ciphertext is not None:
+                    entry.slot = allocator.slot_for(index)
+                    self.write_chunk(fout, header, index, entry, ciphertext)
+                    pipe.out_buffers.put(ciphertext.obj)
+                changes.add(index, entry)
+
+                written_digests[index] = new_digests.pop(index)
+
+            allocated = self.allocated_chunks(in_path, header)
+            try:
+                pipe.run(lambda: self.read_plaintext_chunks(fin, header, pipe, chunk_digests, new_digests, allocated), lambda jobs: self.crypt_chunks(True, header, chunk_key, pipe, jobs), write)
+                if before_commit is not None:
+                    before_commit()
+            except:
+                changes.discard()
+                raise
+
+            changed = len(written_digests)
+            if changed > 0:
+                # The chunks are durable in their new slots before the table refers to them
+                os.fsync(fout.fileno())
+                changes.commit()
+                changes.apply(fout, header)
+            else:
+                changes.discard()
+
+            # The digests are only updated once the chunks have actually reached the image
+            for index, digest in written_digests.items():
+                chunk_digests[index] = digest
+
+        print(f"# Re-encrypted {changed} of {header.chunk_count} chunks")
+        return report_throughput("Checked", header.image_size, time.monotonic() - start)
+
+    # Write an encrypted chunk into its slot in the image, returning its table entry with the stored length filled in
+    # a chunk with no ciphertext becomes a hole (any old ciphertext left in its slot is no longer referenced)
+    # a compressed chunk only fills the start of its slot, so the rest of the slot is never written and stays sparse
+    def write_chunk(self, fout, header, index, entry, ciphertext):
+        if ciphertext is None:
+            return entry
+
+        fout.seek(header.chunk_offset(entry.slot_index(index)))
+        write_all(fout, memoryview(ciphertext))
+
+        entry.length = len(ciphertext)
+        return entry
+
+    # Decrypt an image produced by "openssl enc -aes-256-cbc" (the format used before chunked images)
+    # raises a ValueError if the key is wrong or the image is corrupt (openssl's "bad decrypt")
+    def decrypt_legacy_image(self, aes_key, in_path, out_path):
+        key, iv = derive_legacy_key(aes_key)
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+
+        in_view = memoryview(self.in_buffer)
+        out_view = memoryview(self.out_buffer)
+
+        start = time.monotonic()
+        with open(in_path, "rb", buffering=0) as fin, open(out_path, "wb", buffering=0) as fout:
+            total = os.fstat(fin.fileno()).st_size
+            if total == 0 or total % BLOCK_SIZE != 0:
+                raise ValueError("bad decrypt")
+
+            remaining = total
+            while remaining > 0:
+                n = fin.readinto(in_view[:min(self.chunk_size, remaining)])
+                if n == 0:
+                    raise ValueError("bad decrypt")
+                remaining -= n
+
+                m = decryptor.update_into(in_view[:n], out_view)
+
+                # Strip the PKCS#7 padding from the end of the final chunk
+                if remaining == 0:
+                    pad = out_view[m-1] if m > 0 else 0
+                    if pad < 1 or pad > BLOCK_SIZE or pad > m or out_view[m-pad:m] != bytes([pad])*pad:
+                        raise ValueError("bad decrypt")
+                    m -= pad
+
+                write_all(fout, out_view[:m])
+
+            decryptor.finalize()
+
+        return report_throughput("Decrypted", total, time.monotonic() - start)
+
+    # Decrypt an image in either the chunked or the legacy format
+    # (chunk digests are only recorded for chunked images)
+    def decrypt_any_image(self, aes_key, in_path, out_path, chunk_digests=None):
+        if image_format.is_chunked_image(in_path):
+            return self.decrypt_image(aes_key, in_path, out_path, chunk_digests)
+        else:
+            return self.decrypt_legacy_image(aes_key, in_path, out_path)
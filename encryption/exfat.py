@@ -0,0 +1,135 @@
+import struct
+
+# Name stored in the boot sector of every exFAT volume
+FILE_SYSTEM_NAME = b"EXFAT   "
+
+# Fields of the exFAT boot sector: fat offset, fat length, cluster heap offset, cluster count,
+# first cluster of the root directory, then (after the serial number and revision) the sector and cluster size shifts
+BOOT_SECTOR_FORMAT = "<IIIII8xBB"
+BOOT_SECTOR_OFFSET = 80
+
+# Directory entry types
+DIRECTORY_ENTRY_SIZE = 32
+ENTRY_END_OF_DIRECTORY = 0x00
+ENTRY_ALLOCATION_BITMAP = 0x81
+
+# FAT entries that end a cluster chain
+FAT_END_OF_CHAIN = 0xFFFFFFFF
+FIRST_CLUSTER = 2
+
+# Reads the boot sector and allocation bitmap of an exFAT volume, to find which parts of it hold live data
+class ExfatVolume:
+    def __init__(self, f):
+        self.f = f
+
+        f.seek(0)
+        boot_sector = f.read(512)
+        if len(boot_sector) < 512 or boot_sector[3:11] != FILE_SYSTEM_NAME:
+            raise ValueError("not an exFAT volume")
+
+        fat_offset, fat_length, heap_offset, self.cluster_count, self.root_cluster, sector_shift, cluster_shift = struct.unpack_from(BOOT_SECTOR_FORMAT, boot_sector, BOOT_SECTOR_OFFSET)
+
+        self.sector_size = 1 << sector_shift
+        self.cluster_size = self.sector_size << cluster_shift
+        self.fat_offset = fat_offset * self.sector_size
+        self.heap_offset = heap_offset * self.sector_size
+
+    # Byte offset of a cluster within the volume
+    def cluster_offset(self, cluster):
+        return self.heap_offset + (cluster - FIRST_CLUSTER) * self.cluster_size
+
+    # Follow the FAT to list the clusters holding length bytes starting from first_cluster
+    # (if the FAT has no chain for them, the clusters are contiguous)
+    # with no length, the chain is followed to its end
+    def cluster_chain(self, first_cluster, length=None):
+        clusters = []
+        cluster = first_cluster
+        count = self.cluster_count if length is None else (length + self.cluster_size - 1) // self.cluster_size
+
+        while len(clusters) < count:
+            if cluster < FIRST_CLUSTER or cluster >= self.cluster_count + FIRST_CLUSTER:
+                raise ValueError("cluster chain leaves the volume")
+            clusters.append(cluster)
+
+            self.f.seek(self.fat_offset + cluster * 4)
+            next_cluster = struct.unpack("<I", self.f.read(4))[0]
+            if next_cluster == 0 and length is not None:
+                # No chain in the FAT, so the rest of the clusters follow on directly
+                clusters.extend(range(cluster + 1, cluster + 1 + count - len(clusters)))
+                break
+            if next_cluster == 0 or next_cluster == FAT_END_OF_CHAIN:
+                break
+            cluster = next_cluster
+
+        return clusters
+
+    def read_clusters(self, clusters, length):
+        data = bytearray()
+        for cluster in clusters:
+            self.f.seek(self.cluster_offset(cluster))
+            data += self.f.read(self.cluster_size)
+
+        return bytes(data[:length])
+
+    # Read the allocation bitmap, where bit n is set if cluster n + 2 is in use
+    def read_allocation_bitmap(self):
+        # The root directory always has a FAT chain, so its length is not needed to follow it
+        root_clusters = self.cluster_chain(self.root_cluster)
+        root = self.read_clusters(root_clusters, len(root_clusters) * self.cluster_size)
+
+        for offset in range(0, len(root), DIRECTORY_ENTRY_SIZE):
+            entry_type = root[offset]
+
+            if entry_type == ENTRY_END_OF_DIRECTORY:
+                break
+
+            # The first bitmap is the one in use (the second only exists on TexFAT volumes)
+            if entry_type == ENTRY_ALLOCATION_BITMAP and root[offset + 1] & 0x01 == 0:
+                first_cluster, length = struct.unpack_from("<IQ", root, offset + 20)
+                bitmap = self.read_clusters(self.cluster_chain(first_cluster, length), length)
+
+                if len(bitmap) * 8 < self.cluster_count:
+                    raise ValueError("allocation bitmap is too short")
+
+                return bitmap
+
+        raise ValueError("no allocation bitmap found")
+
+    # Find which chunks of the volume hold metadata or allocated clusters
+    # returns a list with a bool for each chunk, where False means it only holds free clusters
+    def allocated_chunks(self, image_size, chunk_size):
+        chunk_count = (image_size + chunk_size - 1) // chunk_size
+        allocated = [False] * chunk_count
+
+        def mark(start, end):
+            for index in range(start // chunk_size, min((end - 1) // chunk_size + 1, chunk_count)):
+                allocated[index] = True
+
+        # Everything before the cluster heap (boot region and FATs), and anything after it, is always kept
+        heap_end = self.cluster_offset(self.cluster_count + FIRST_CLUSTER)
+        mark(0, self.heap_offset)
+        if heap_end < image_size:
+            mark(heap_end, image_size)
+
+        bitmap = self.read_allocation_bitmap()
+        for byte_index, byte in enumerate(bitmap):
+            if byte == 0:
+                continue
+
+            for bit in range(8):
+                cluster_index = byte_index * 8 + bit
+                if byte & (1 << bit) and cluster_index < self.cluster_count:
+                    start = self.cluster_offset(cluster_index + FIRST_CLUSTER)
+                    mark(start, start + self.cluster_size)
+
+        return allocated
+
+# Find which chunks of an exFAT image hold live data
+# returns None if the image cannot be parsed, in which case every chunk must be kept
+def allocated_chunks(path, image_size, chunk_size):
+    try:
+        with open(path, "rb") as f:
+            return ExfatVolume(f).allocated_chunks(image_size, chunk_size)
+    except (ValueError, struct.error) as e:
+        print(f"# Could not read exFAT allocation bitmap ({e}), keeping every chunk")
+        return None
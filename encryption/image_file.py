@@ -0,0 +1,113 @@
+import hmac
+import os
+
+from encryption import chunk_crypto
+from encryption import image_format
+from encryption import journal
+from encryption import snapshots
+from encryption.engine import BLOCK_SIZE, derive_chunk_key, key_check_value, write_all
+
+# An open chunked image, whose chunks are decrypted (and, if it is writable, encrypted in place) one at a time
+# used to serve the drive while it is mounted, rather than transforming the whole image at once
+class ImageFile:
+    def __init__(self, aes_key, path, writable=False):
+        journal.recover(path)
+
+        self.path = path
+        self.f = open(path, "r+b" if writable else "rb", buffering=0)
+        try:
+            self.header, self.entries = image_format.read_header_and_table(self.f)
+
+            self.chunk_key = derive_chunk_key(aes_key, self.header)
+            if not hmac.compare_digest(key_check_value(self.chunk_key), self.header.key_check):
+                raise ValueError("bad decrypt")
+        except:
+            self.f.close()
+            raise
+
+        # Neither the current version of a chunk nor one a snapshot still refers to is overwritten
+        if writable:
+            self.allocator = snapshots.SlotAllocator(self.header, self.entries, snapshots.SnapshotStore(path).protected_slots())
+
+        self.in_buffer = bytearray(self.header.chunk_size + BLOCK_SIZE)
+        self.out_buffer = bytearray(self.header.chunk_size + chunk_crypto.OUTPUT_MARGIN)
+
+    # Whether an image can be served a chunk at a time
+    # older versions must be rewritten in full when encrypted, so they are still decrypted in full
+    # raises a ValueError if the image is corrupt
+    def supports(path):
+        if not image_format.is_chunked_image(path):
+            return False
+
+        with open(path, "rb") as f:
+            header, entries = image_format.read_header_and_table(f)
+
+        return header.version == image_format.VERSION
+
+    # Decrypt a chunk, returning its plaintext (only valid until the next chunk is read or written)
+    # or None if it is a hole, which is all zeros
+    def read_chunk(self, index):
+        entry = self.entries[index]
+        if entry.flags & image_format.CHUNK_HOLE:
+            return None
+
+        if entry.length > self.header.chunk_size:
+            raise ValueError("corrupt chunk table")
+
+        in_view = memoryview(self.in_buffer)[:entry.length]
+        if os.preadv(self.f.fileno(), [in_view], self.header.chunk_offset(entry.slot_index(index))) != entry.length:
+            raise ValueError("truncated image")
+
+        out_view = memoryview(self.out_buffer)
+        chunk_crypto.decrypt_chunk(self.header.cipher, self.chunk_key, self.header.compression, self.header.chunk_size, index, entry.iv, entry.flags, in_view, out_view)
+
+        return out_view[:self.header.chunk_length(index)]
+
+    # Encrypt the plaintext of a chunk, returning its new table entry and ciphertext
+    # a chunk of zeros becomes a hole, which has no ciphertext
+    def encrypt_chunk(self, index, plaintext):
+        length = self.header.chunk_length(index)
+        in_view = memoryview(self.in_buffer)
+
+        in_view[:length] = plaintext
+        in_view[length:self.header.chunk_size] = bytes(self.header.chunk_size - length)
+
+        if in_view[:self.header.chunk_size].tobytes() == bytes(self.header.chunk_size):
+            return image_format.ChunkEntry(bytes(image_format.IV_SIZE), image_format.CHUNK_HOLE, 0), None
+
+        # Chunks get a fresh random IV every time they are written (XTS chunks only use it to give the write a new table entry)
+        iv = os.urandom(image_format.IV_SIZE)
+
+        out_view = memoryview(self.out_buffer)
+        flags, m = chunk_crypto.encrypt_chunk(self.header.cipher, self.chunk_key, self.header.compression, index, iv, in_view[:self.header.chunk_size], out_view)
+
+        return image_format.ChunkEntry(iv, flags, m), out_view[:m]
+
+    # Encrypt (index, plaintext) chunks into free slots in the image, then switch the table over to them
+    # the table entries go through a journal, so either all of them reach the image or (if power is lost first) none do
+    def write_chunks(self, chunks):
+        changes = journal.Journal(self.path)
+        changes.begin()
+
+        try:
+            for index, plaintext in chunks:
+                entry, ciphertext = self.encrypt_chunk(index, plaintext)
+                if ciphertext is not None:
+                    entry.slot = self.allocator.slot_for(index)
+                    self.f.seek(self.header.chunk_offset(entry.slot_index(index)))
+                    write_all(self.f, ciphertext)
+                changes.add(index, entry)
+
+            # The chunks are durable in their new slots before the table refers to them
+            os.fsync(self.f.fileno())
+        except:
+            changes.discard()
+            raise
+
+        changes.commit()
+        for index, entry in changes.apply(self.f, self.header).items():
+            self.allocator.release(index, self.entries[index])
+            self.entries[index] = entry
+
+    def close(self):
+        self.f.close()
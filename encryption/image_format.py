@@ -0,0 +1,165 @@
+import os
+import struct
+
+# Identifies a chunked encrypted image (legacy images are a raw "openssl enc" blob with no header)
+MAGIC = b"PIUSBIMG"
+
+# Version 1: the chunk key is derived from the unsealed key with the legacy PBKDF2 parameters
+# Version 2: the chunk key is derived from the unsealed key with a single HKDF step
+VERSION = 2
+VERSIONS = (1, 2)
+
+# Ciphers that the chunks of an image may be encrypted with
+# XTS needs no stored IV and leaves every chunk independent, so it is used for new images
+CIPHER_AES_256_CBC = 1
+CIPHER_AES_256_XTS = 2
+CIPHERS = (CIPHER_AES_256_CBC, CIPHER_AES_256_XTS)
+
+# Compression applied to each chunk before it is encrypted (chosen per image)
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSIONS = {"none": COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "lzma": COMPRESSION_LZMA}
+
+# Default number of plaintext bytes stored in each chunk
+CHUNK_SIZE = 256 * 1024
+
+# Size of the IV stored for each chunk (unused by XTS chunks)
+IV_SIZE = 16
+
+# Chunk data starts on a boundary of this size, so that chunks line up with filesystem blocks
+ALIGNMENT = 4096
+
+# magic, version, cipher, compression, chunk size, chunk count, image size, key check value
+HEADER_FORMAT = "<8sHBBIQQ16s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Chunk flags
+# a hole chunk is all zeros, so nothing is stored for it and it is restored as a sparse hole
+CHUNK_HOLE = 0x01
+# a compressed chunk was compressed before it was encrypted, so it is shorter than the chunk size
+CHUNK_COMPRESSED = 0x02
+
+# iv, flags, slot, number of bytes stored in the chunk
+# the slot is a 24 bit number, 0 for a chunk stored in its own slot (so images written before slots existed
+# read the same), otherwise one more than the slot it was moved to so that a snapshot could keep its old one
+ENTRY_FORMAT = "<16sB3sI"
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+MAX_SLOT = (1 << 24) - 2
+
+# Describes the layout of a chunked image
+# the header is followed by a table of chunk entries, then by the chunks themselves
+class Header:
+    def __init__(self, image_size, chunk_size=CHUNK_SIZE, cipher=CIPHER_AES_256_XTS, version=VERSION, key_check=bytes(16), compression=COMPRESSION_NONE):
+        self.version = version
+        self.cipher = cipher
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.chunk_count = (image_size + chunk_size - 1) // chunk_size
+        self.image_size = image_size
+        self.key_check = key_check
+
+    def pack(self):
+        return struct.pack(HEADER_FORMAT, MAGIC, self.version, self.cipher, self.compression, self.chunk_size, self.chunk_count, self.image_size, self.key_check)
+
+    # Parse a header, raising a ValueError if it is not one this code can read
+    def unpack(data):
+        if len(data) < HEADER_SIZE:
+            raise ValueError("truncated image header")
+
+        magic, version, cipher, compression, chunk_size, chunk_count, image_size, key_check = struct.unpack_from(HEADER_FORMAT, data)
+
+        if magic != MAGIC:
+            raise ValueError("not a chunked image")
+        if version not in VERSIONS:
+            raise ValueError(f"unsupported image version {version}")
+        if cipher not in CIPHERS:
+            raise ValueError(f"unsupported image cipher {cipher}")
+        if compression not in COMPRESSIONS.values():
+            raise ValueError(f"unsupported image compression {compression}")
+
+        header = Header(image_size, chunk_size, cipher, version, key_check, compression)
+        if header.chunk_count != chunk_count:
+            raise ValueError("image header is inconsistent")
+
+        return header
+
+    # Byte offset of the chunk table
+    def table_offset(self):
+        return HEADER_SIZE
+
+    # Byte offset of the first chunk
+    def data_offset(self):
+        table_end = HEADER_SIZE + self.chunk_count * ENTRY_SIZE
+        return (table_end + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+    # Byte offset of a specific chunk slot (the slot of a chunk is given by ChunkEntry.slot_index)
+    def chunk_offset(self, index):
+        return self.data_offset() + index * self.chunk_size
+
+    # Number of plaintext bytes of the image held in a specific chunk (the final chunk may be partial)
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.image_size - index * self.chunk_size)
+
+    # Total size of the encrypted image file
+    def file_size(self):
+        return self.chunk_offset(self.chunk_count)
+
+# The table entry describing how a single chunk is stored
+# slot is None for a chunk stored in its own slot (the slot with the same index as the chunk)
+class ChunkEntry:
+    def __init__(self, iv=bytes(IV_SIZE), flags=0, length=0, slot=None):
+        self.iv = iv
+        self.flags = flags
+        self.length = length
+        self.slot = slot
+
+    # Slot that the chunk with this entry is stored in
+    def slot_index(self, index):
+        return index if self.slot is None else self.slot
+
+    def pack(self):
+        slot = 0 if self.slot is None else self.slot + 1
+        return struct.pack(ENTRY_FORMAT, self.iv, self.flags, slot.to_bytes(3, "little"), self.length)
+
+    def unpack(data, offset=0):
+        iv, flags, slot, length = struct.unpack_from(ENTRY_FORMAT, data, offset)
+        slot = int.from_bytes(slot, "little")
+        return ChunkEntry(iv, flags, length, None if slot == 0 else slot - 1)
+
+# Read the header and chunk table from an open image file
+def read_header_and_table(f):
+    f.seek(0)
+    header = Header.unpack(f.read(HEADER_SIZE))
+
+    table = f.read(header.chunk_count * ENTRY_SIZE)
+    if len(table) != header.chunk_count * ENTRY_SIZE:
+        raise ValueError("truncated chunk table")
+
+    entries = [ChunkEntry.unpack(table, i * ENTRY_SIZE) for i in range(header.chunk_count)]
+
+    return header, entries
+
+# Write the header and chunk table to an open image file
+def write_header_and_table(f, header, entries):
+    data = memoryview(header.pack() + b"".join(entry.pack() for entry in entries))
+
+    f.seek(0)
+    while len(data) > 0:
+        data = data[f.write(data):]
+
+# Write the table entry of a single chunk, once the chunk itself has been rewritten in place
+def write_entry(f, header, index, entry):
+    data = memoryview(entry.pack())
+
+    f.seek(header.table_offset() + index * ENTRY_SIZE)
+    while len(data) > 0:
+        data = data[f.write(data):]
+
+# Check whether a file is a chunked image, rather than a legacy openssl blob
+def is_chunked_image(path):
+    if not os.path.exists(path):
+        return False
+
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import struct
+
+from encryption import image_format
+
+# Makes switching the table of an image over to new versions of its chunks atomic
+# the new chunks are written to slots that nothing refers to (see snapshots.SlotAllocator) and synced, then their
+# table entries are written to a journal next to the image and synced, then copied into place
+# if power is lost part way, the journal is replayed the next time the image is opened
+# (or discarded, if it was never completed, leaving the image as it was)
+JOURNAL_MAGIC = b"PIUSBJNL"
+
+# Each record is the index of a chunk, whether its ciphertext follows and its new table entry, then its ciphertext
+# (only journals written by older versions, which rewrote chunks in place, have records with ciphertext)
+RECORD_FORMAT = "<IB"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# The journal ends with a commit record: the number of records and a digest of everything before it
+COMMIT_MAGIC = b"COMMITED"
+COMMIT_FORMAT = "<8sI32s"
+COMMIT_SIZE = struct.calcsize(COMMIT_FORMAT)
+
+def journal_path(image_path):
+    return image_path + ".journal"
+
+def read_exact(f, length):
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError("truncated journal")
+
+    return data
+
+class Journal:
+    def __init__(self, image_path):
+        self.path = journal_path(image_path)
+        self.f = None
+
+    def begin(self):
+        self.f = open(self.path, "wb")
+        self.digest = hashlib.sha256()
+        self.count = 0
+
+        self.write(JOURNAL_MAGIC)
+
+    def write(self, data):
+        self.f.write(data)
+        self.digest.update(data)
+
+    # Add the new table entry of a chunk (whose ciphertext, if it has any, must already be synced to its slot)
+    def add(self, index, entry):
+        self.write(struct.pack(RECORD_FORMAT, index, False) + entry.pack())
+        self.count += 1
+
+    # Complete the journal and make it durable, after which the chunks in it will reach the image even if power is lost
+    def commit(self):
+        self.f.write(struct.pack(COMMIT_FORMAT, COMMIT_MAGIC, self.count, self.digest.digest()))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+
+    # Forget a journal that was not committed
+    def discard(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # Read the records of a committed journal as (index, entry, ciphertext)
+    # raises a ValueError if the journal was never completed
+    def records(self):
+        size = os.path.getsize(self.path)
+        if size < len(JOURNAL_MAGIC) + COMMIT_SIZE:
+            raise ValueError("incomplete journal")
+
+        with open(self.path, "rb") as f:
+            f.seek(size - COMMIT_SIZE)
+            magic, count, expected = struct.unpack(COMMIT_FORMAT, f.read(COMMIT_SIZE))
+            if magic != COMMIT_MAGIC:
+                raise ValueError("incomplete journal")
+
+            # The records are checked before any of them are applied
+            f.seek(0)
+            digest = hashlib.sha256()
+            remaining = size - COMMIT_SIZE
+            while remaining > 0:
+                data = read_exact(f, min(remaining, image_format.CHUNK_SIZE))
+                digest.update(data)
+                remaining -= len(data)
+
+            if digest.digest() != expected:
+                raise ValueError("corrupt journal")
+
+            f.seek(len(JOURNAL_MAGIC))
+            for i in range(count):
+                index, has_ciphertext = struct.unpack(RECORD_FORMAT, read_exact(f, RECORD_SIZE))
+                entry = image_format.ChunkEntry.unpack(read_exact(f, image_format.ENTRY_SIZE))
+
+                ciphertext = None
+                if has_ciphertext:
+                    ciphertext = read_exact(f, entry.length)
+
+                yield index, entry, ciphertext
+
+    # Copy the chunks of a committed journal into the (open, writable) image, then delete the journal
+    # returns the new table entry of each chunk by index
+    def apply(self, f, header):
+        entries = {}
+
+        for index, entry, ciphertext in self.records():
+            if index >= header.chunk_count or entry.length > header.chunk_size or entry.slot_index(index) > image_format.MAX_SLOT:
+                raise ValueError("journal does not match the image")
+
+            if ciphertext is not None:
+                f.seek(header.chunk_offset(entry.slot_index(index)))
+                view = memoryview(ciphertext)
+                while len(view) > 0:
+                    view = view[f.write(view):]
+
+            image_format.write_entry(f, header, index, entry)
+            entries[index] = entry
+
+        f.flush()
+        os.fsync(f.fileno())
+        os.remove(self.path)
+
+        return entries
+
+# Finish or undo an update to an image that was interrupted, before the image is read
+# a committed journal is replayed into the image, an incomplete one is discarded
+def recover(image_path):
+    journal = Journal(image_path)
+    if not os.path.exists(journal.path):
+        return
+
+    try:
+        with open(image_path, "r+b", buffering=0) as f:
+            header, entries = image_format.read_header_and_table(f)
+            count = len(journal.apply(f, header))
+        print(f"# Replayed {count} chunks from an interrupted update of the image")
+    except ValueError as e:
+        print(f"# Discarded an incomplete update of the image ({e})")
+        journal.discard()
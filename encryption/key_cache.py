@@ -0,0 +1,50 @@
+import threading
+
+import config
+
+# Holds the unsealed data key in memory for the mounted session
+# so that ejecting the drive does not need another TPM policy session to unseal it again
+class KeyCache:
+    def __init__(self, ttl=config.KEY_CACHE_TTL):
+        self.ttl = ttl
+        self.key = None
+        self.timer = None
+
+        # Reentrant, as clear is called from the SIGINT handler, which may interrupt get or store on the same thread
+        self.lock = threading.RLock()
+
+    # Store the key for the session, replacing any previous key
+    def store(self, key):
+        with self.lock:
+            self.zeroize()
+
+            # Kept in a bytearray, so that it can be overwritten in place when the session ends
+            self.key = bytearray(key)
+
+            # Forget the key if it has not been cleared by the time the session times out
+            self.timer = threading.Timer(self.ttl, self.clear)
+            self.timer.daemon = True
+            self.timer.start()
+
+    # Returns a copy of the cached key, or None if there is no key (or it has timed out)
+    # a copy is returned so that a timeout cannot zeroize the key part way through an operation using it
+    def get(self):
+        with self.lock:
+            if self.key is None:
+                return None
+
+            return bytes(self.key)
+
+    # Zeroize and forget the key (on eject, on timeout and when the program stops)
+    def clear(self):
+        with self.lock:
+            self.zeroize()
+
+    def zeroize(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.key is not None:
+            self.key[:] = bytes(len(self.key))
+            self.key = None
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+
+import config
+from encryption import activity
+from encryption import policy
+from encryption import tpm_client
+from encryption.tpm_client import ResponseReader, TPMError
+
+# RSA keys generated ahead of time, while the TPM is idle, so that replacing the keys for communicating with the
+# fingerprint sensor on reset only has to load them (generating an RSA key is the slowest thing the simulator does)
+# each key is parked as its key blobs (the private part is encrypted by the TPM under the storage key it was created under),
+# in a file holding the name of that storage key, then the private and public parts
+# a key whose storage key has since changed (e.g. the TPM was cleared) can no longer be loaded, and is thrown away
+KEY_SUFFIX = ".key"
+
+class KeyPool:
+    # parent() returns the handle of the storage key that the keys are created under
+    def __init__(self, tpm, parent, directory=config.KEY_POOL_PATH, depth=config.KEY_POOL_DEPTH, interval=config.KEY_POOL_REFILL_INTERVAL):
+        self.tpm = tpm
+        self.parent = parent
+        self.directory = directory
+        self.depth = depth
+        self.interval = interval
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.depth <= 0 or self.thread is not None:
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stop refilling the pool (waiting for a key being generated to be parked)
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def paths(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(KEY_SUFFIX))
+
+    # Number of keys parked (including any under a storage key that has since changed)
+    def size(self):
+        return len(self.paths())
+
+    # Generate a key and park it
+    def add(self):
+        with self.tpm.lock:
+            parent = self.parent()
+            parent_name = policy.object_name(self.tpm.read_public(parent))
+            private, public = self.tpm.create(parent, tpm_client.rsa_key_template())
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # The key only appears in the pool once it has been completely written
+        path = os.path.join(self.directory, os.urandom(8).hex() + KEY_SUFFIX)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(tpm_client.tpm2b(parent_name) + tpm_client.tpm2b(private) + tpm_client.tpm2b(public))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    # Take a key created under the storage key parent, returning its (private, public) key blobs
+    # or None if the pool has none (the caller then generates one itself)
+    # a key is only removed from the pool once it is handed out, or is known to be unusable
+    def take(self, parent):
+        parent_name = None
+
+        for path in self.paths():
+            try:
+                with open(path, "rb") as f:
+                    reader = ResponseReader(f.read())
+            except OSError:
+                continue
+
+            try:
+                key_parent_name, private, public = reader.tpm2b(), reader.tpm2b(), reader.tpm2b()
+            except ValueError:
+                # A key cut short can never be loaded
+                os.remove(path)
+                continue
+
+            if parent_name is None:
+                parent_name = policy.object_name(self.tpm.read_public(parent))
+
+            # Each key is only ever handed out once, and one under another storage key (e.g. before a reset) is stale
+            os.remove(path)
+            if key_parent_name == parent_name:
+                return private, public
+
+        return None
+
+    # Keep the pool topped up to its depth in the background, generating a key at a time
+    # only once the TPM has gone unused for the refill interval, and no drive is being encrypted, decrypted,
+    # checkpointed or rotated (see encryption.activity), so at most one key is generated every interval
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.size() >= self.depth or time.monotonic() - self.tpm.last_used < self.interval or activity.busy():
+                continue
+
+            try:
+                start = time.monotonic()
+                self.add()
+                print(f"# Generated a key for the key pool in {time.monotonic() - start:.2f}s ({self.size()} ready)")
+            except (OSError, ValueError, TPMError) as e:
+                print(f"# Could not generate a key for the key pool ({e})")
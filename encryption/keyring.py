@@ -0,0 +1,210 @@
+import os
+import struct
+
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap, InvalidUnwrap
+
+# The data key of a drive, wrapped separately under the key sealed in the TPM for each user allowed to use it
+# so enrolling or revoking a user only adds or removes one wrapped copy, and the image is never re-encrypted
+# (drives set up before keyrings have none, and their data key is the key sealed for the drive itself)
+KEYRING_MAGIC = b"PIUSBKEY"
+
+# The magic is followed by the version, then the records, each the persistent address of a user's sealed key,
+# the kind of record, the generation of the data key it holds, and the length of its data
+# (keyrings written before the version was added have none, and are read as LEGACY_VERSIONS)
+KEYRING_VERSION = 3
+VERSION_FORMAT = "<I"
+RECORD_FORMAT = "<IBIH"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# A user's entry holds the data key wrapped under the user's key (AES key wrap)
+RECORD_ENTRY = 1
+# A successor holds the data key of its generation wrapped under the data key of the generation before
+# (only written by older versions, rotating the key now leaves pending keys instead)
+RECORD_SUCCESSOR = 2
+# A pending key holds the data key of a newer generation than the user's entry, sealed in the TPM under the same policy as
+# the user's key (as the key blobs of a sealed object), so only the TPM can give it to that user once they are authorized
+RECORD_PENDING = 3
+
+# Fixed size entries of the keyrings with no version: the address, then the data key wrapped under it (version 1),
+# or the address, the generation, then the wrapped data key (version 2, which also has successors)
+LEGACY_VERSIONS = {1: "<I40s", 2: "<II40s"}
+
+# Rotating the data key (see encryption.rotation) starts a new generation, with the new data key wrapped for the user who
+# rotated it, and pending for every other user, as their keys are not available to wrap it under
+# their entry is brought up to date the next time they unlock the drive
+# (older versions instead added a successor entry at this address, wrapping the new data key under the previous one,
+# which a user whose entry is from an earlier generation still follows to the current data key)
+SUCCESSOR_ADDR = 0
+
+# Whether a persistent address could be a user's (the persistent handles of the owner hierarchy start with 0x81)
+# used to tell a keyring with no version, which starts with the address of its first entry, from one with a version
+def is_user_addr(key_addr):
+    return key_addr >> 24 == 0x81
+
+def keyring_path(image_path):
+    return image_path + ".keys"
+
+# New data keys are random, in the same form as a key unsealed from the TPM (32 bytes in hex)
+def generate_data_key():
+    return os.urandom(32).hex().encode("utf-8")
+
+def wrap_key(user_key, data_key):
+    return aes_key_wrap(bytes.fromhex(user_key.decode("utf-8")), bytes.fromhex(data_key.decode("utf-8")))
+
+# Raises a ValueError if the data key was not wrapped under this user key (or the keyring is corrupt)
+def unwrap_key(user_key, wrapped):
+    try:
+        return aes_key_unwrap(bytes.fromhex(user_key.decode("utf-8")), wrapped).hex().encode("utf-8")
+    except InvalidUnwrap:
+        raise ValueError("wrapped key does not match")
+
+class Keyring:
+    def __init__(self, image_path):
+        self.path = keyring_path(image_path)
+
+        # (generation, wrapped data key) by the address of each user's sealed key
+        self.entries = {}
+
+        # Data key of each generation after the first, wrapped under the data key of the generation before (from older versions)
+        self.successors = {}
+
+        # (generation, sealed data key) by the address of each user who has not unlocked the drive since its key was rotated
+        self.pending = {}
+
+    # Read the keyring, returning False if the drive has none
+    # raises a ValueError if it is corrupt (or from a newer version)
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        if not data.startswith(KEYRING_MAGIC) or len(data) < len(KEYRING_MAGIC) + struct.calcsize(VERSION_FORMAT):
+            raise ValueError("corrupt keyring")
+
+        self.entries = {}
+        self.successors = {}
+        self.pending = {}
+
+        version = struct.unpack_from(VERSION_FORMAT, data, len(KEYRING_MAGIC))[0]
+        if is_user_addr(version):
+            self.load_legacy(data[len(KEYRING_MAGIC):])
+            return True
+
+        if version != KEYRING_VERSION:
+            raise ValueError(f"unsupported keyring version {version}")
+
+        offset = len(KEYRING_MAGIC) + struct.calcsize(VERSION_FORMAT)
+        while offset < len(data):
+            if offset + RECORD_SIZE > len(data):
+                raise ValueError("corrupt keyring")
+
+            key_addr, kind, generation, length = struct.unpack_from(RECORD_FORMAT, data, offset)
+            offset += RECORD_SIZE
+            record = data[offset:offset + length]
+            offset += length
+            if len(record) != length:
+                raise ValueError("corrupt keyring")
+
+            if kind == RECORD_ENTRY:
+                self.entries[f"0x{key_addr:08x}"] = (generation, record)
+            elif kind == RECORD_SUCCESSOR:
+                self.successors[generation] = record
+            elif kind == RECORD_PENDING:
+                self.pending[f"0x{key_addr:08x}"] = (generation, record)
+            else:
+                raise ValueError("corrupt keyring")
+
+        return True
+
+    # Read the entries of a keyring with no version, of whichever legacy layout they fit
+    def load_legacy(self, data):
+        for version, entry_format in LEGACY_VERSIONS.items():
+            entry_size = struct.calcsize(entry_format)
+            if len(data) % entry_size != 0:
+                continue
+
+            entries = [struct.unpack_from(entry_format, data, offset) for offset in range(0, len(data), entry_size)]
+            if not all(entry[0] == SUCCESSOR_ADDR or is_user_addr(entry[0]) for entry in entries) or not is_user_addr(entries[0][0]):
+                continue
+
+            for entry in entries:
+                key_addr, generation, wrapped = entry if len(entry) == 3 else (entry[0], 0, entry[1])
+                if key_addr == SUCCESSOR_ADDR:
+                    self.successors[generation] = wrapped
+                else:
+                    self.entries[f"0x{key_addr:08x}"] = (generation, wrapped)
+            return
+
+        raise ValueError("corrupt keyring")
+
+    # Replace the keyring, which only appears once it has been completely written
+    def save(self):
+        records = [(int(key_addr, 16), RECORD_ENTRY, generation, wrapped) for key_addr, (generation, wrapped) in self.entries.items()]
+        records += [(SUCCESSOR_ADDR, RECORD_SUCCESSOR, generation, wrapped) for generation, wrapped in self.successors.items()]
+        records += [(int(key_addr, 16), RECORD_PENDING, generation, sealed) for key_addr, (generation, sealed) in self.pending.items()]
+
+        data = KEYRING_MAGIC + struct.pack(VERSION_FORMAT, KEYRING_VERSION)
+        data += b"".join(struct.pack(RECORD_FORMAT, key_addr, kind, generation, len(record)) + record for key_addr, kind, generation, record in records)
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+    # Addresses of the sealed keys of the users allowed to use the drive
+    def users(self):
+        return list(self.entries)
+
+    # Generation of the current data key
+    def generation(self):
+        generations = [generation for generation, wrapped in self.entries.values()] + list(self.successors)
+        generations += [generation for generation, sealed in self.pending.values()]
+        return max(generations, default=0)
+
+    # Wrap the current data key for a user (which brings the entry of a user with a pending key up to date)
+    def add(self, key_addr, user_key, data_key):
+        self.entries[key_addr] = (self.generation(), wrap_key(user_key, data_key))
+        self.pending.pop(key_addr, None)
+
+    def remove(self, key_addr):
+        del self.entries[key_addr]
+        self.pending.pop(key_addr, None)
+        self.prune()
+
+    # The data keys a user can reach with their own key, from the generation of their entry (oldest first)
+    # following any successors from older versions (a pending key must be unsealed by the TPM, see Encryption.unseal_keys)
+    def unwrap(self, key_addr, user_key):
+        generation, wrapped = self.entries[key_addr]
+        keys = [unwrap_key(user_key, wrapped)]
+
+        for successor in range(generation + 1, self.generation() + 1):
+            if successor not in self.successors:
+                break
+            keys.append(unwrap_key(keys[-1], self.successors[successor]))
+
+        return keys
+
+    # Record a new data key after a rotation, wrapped for the user who rotated it
+    # and sealed for each of the other users (sealed has the sealed data key by their address)
+    # nothing in the keyring is keyed by the old data key, so it gives no way to the new one
+    def rotate(self, key_addr, user_key, data_key, sealed):
+        generation = self.generation() + 1
+
+        self.entries[key_addr] = (generation, wrap_key(user_key, data_key))
+        self.pending.pop(key_addr, None)
+        for user_addr, sealed_key in sealed.items():
+            self.pending[user_addr] = (generation, sealed_key)
+
+        # The successors from older versions only led to keys older than this one
+        self.successors = {}
+
+    # Forget the successors that every user's entry is already past
+    def prune(self):
+        oldest = min((generation for generation, wrapped in self.entries.values()), default=self.generation())
+        for generation in list(self.successors):
+            if generation <= oldest:
+                del self.successors[generation]
@@ -0,0 +1,82 @@
+import os
+import threading
+
+from encryption.engine import chunk_digest
+from encryption.image_file import ImageFile
+
+# The plaintext of a chunked image, where each chunk is only decrypted the first time it is read or written
+# decrypted chunks are kept in the plaintext file (sparse on the ramdisk), so the drive can be used before
+# the whole image has been decrypted, and each chunk is still only decrypted once
+class LazyImage:
+    def __init__(self, aes_key, encrypted_path, plaintext_path):
+        self.image = ImageFile(aes_key, encrypted_path)
+        self.header = self.image.header
+
+        self.fout = open(plaintext_path, "w+b", buffering=0)
+        self.fout.truncate(self.header.image_size)
+        self.size = self.header.image_size
+
+        # Digest of each chunk as it was decrypted, which is None until the chunk is first used
+        # (so the engine knows the chunks that were never used cannot have changed, and skips them when encrypting)
+        self.chunk_digests = [None] * self.header.chunk_count
+        self.decrypted = 0
+
+        self.lock = threading.Lock()
+
+    # Indexes of the chunks holding length bytes starting at offset
+    def chunk_range(self, offset, length):
+        return range(offset // self.header.chunk_size, (offset + length - 1) // self.header.chunk_size + 1)
+
+    # Decrypt a chunk into the plaintext file, unless it has already been decrypted
+    def load_chunk(self, index):
+        if self.chunk_digests[index] is not None:
+            return
+
+        plaintext = self.image.read_chunk(index)
+
+        # Holes are already zeros in the (sparse) plaintext file
+        if plaintext is None:
+            self.chunk_digests[index] = chunk_digest(bytes(self.header.chunk_length(index)))
+            return
+
+        self.pwrite_all(plaintext, index * self.header.chunk_size)
+        self.chunk_digests[index] = chunk_digest(plaintext)
+        self.decrypted += 1
+
+    def pwrite_all(self, view, offset):
+        while len(view) > 0:
+            written = os.pwrite(self.fout.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+
+    def read(self, offset, length):
+        with self.lock:
+            for index in self.chunk_range(offset, length):
+                self.load_chunk(index)
+
+            return os.pread(self.fout.fileno(), length, offset)
+
+    def write(self, offset, data):
+        with self.lock:
+            for index in self.chunk_range(offset, len(data)):
+                start = index * self.header.chunk_size
+
+                # A chunk that is overwritten completely does not need decrypting first
+                # it is given a digest that never matches, so it is always encrypted again
+                if self.chunk_digests[index] is None and offset <= start and start + self.header.chunk_length(index) <= offset + len(data):
+                    self.chunk_digests[index] = b""
+                else:
+                    self.load_chunk(index)
+
+            self.pwrite_all(memoryview(data), offset)
+
+    # The plaintext file is on the ramdisk, so there is nothing to make durable
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.image.close()
+            self.fout.close()
+
+        print(f"# Decrypted {self.decrypted} of {self.header.chunk_count} chunks on demand")
@@ -0,0 +1,117 @@
+import queue
+import threading
+
+import config
+
+# Seconds a stage waits on a queue or buffer pool before checking whether another stage has failed
+POLL_INTERVAL = 0.1
+
+# Passed down the queues after the last job
+END = object()
+
+# Raised inside a stage when another stage has failed, so that it stops waiting and exits
+class PipelineStopped(Exception):
+    pass
+
+# A fixed set of reusable buffers, which caps the memory a pipeline uses however large the image is
+class BufferPool:
+    def __init__(self, count, size, stopped):
+        self.free = queue.Queue()
+        self.stopped = stopped
+
+        for i in range(count):
+            self.free.put(bytearray(size))
+
+    # Wait for a free buffer
+    def get(self):
+        while True:
+            try:
+                return self.free.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    raise PipelineStopped()
+
+    # Return a buffer to the pool once the stage holding it is done with it
+    def put(self, buffer):
+        self.free.put(buffer)
+
+# Transforms an image in three overlapping stages: a reader thread, the crypto stage and a writer thread
+# so the SD card is read or written while chunks are being encrypted, rather than one after the other
+# the reader fills buffers from in_buffers, the crypto stage moves each chunk into a buffer from out_buffers,
+# and the writer returns it (the two pools are separate, so a stage that is waiting can never hold up the one before it)
+class Pipeline:
+    def __init__(self, buffer_size, buffers=config.PIPELINE_BUFFERS):
+        self.stopped = threading.Event()
+        self.error = None
+
+        self.in_buffers = BufferPool(buffers, buffer_size, self.stopped)
+        self.out_buffers = BufferPool(buffers, buffer_size, self.stopped)
+
+        self.read_queue = queue.Queue(buffers)
+        self.write_queue = queue.Queue(buffers)
+
+    # Run the stages, returning once every chunk has been written
+    # read is a generator of jobs (run on the reader thread), crypt turns an iterator of jobs into an
+    # iterator of results (run on the calling thread) and write is called with each result (on the writer thread)
+    # the first error raised by any stage stops the others and is raised again here
+    def run(self, read, crypt, write):
+        reader = threading.Thread(target=self.run_stage, args=(self.read_stage, read), daemon=True)
+        writer = threading.Thread(target=self.run_stage, args=(self.write_stage, write), daemon=True)
+
+        reader.start()
+        writer.start()
+        self.run_stage(self.crypt_stage, crypt)
+        reader.join()
+        writer.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def run_stage(self, stage, function):
+        try:
+            stage(function)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            self.stopped.set()
+
+    def read_stage(self, read):
+        for job in read():
+            self.put(self.read_queue, job)
+        self.put(self.read_queue, END)
+
+    def crypt_stage(self, crypt):
+        for result in crypt(self.get_all(self.read_queue)):
+            self.put(self.write_queue, result)
+        self.put(self.write_queue, END)
+
+    def write_stage(self, write):
+        for result in self.get_all(self.write_queue):
+            write(*result)
+
+    def put(self, q, item):
+        while True:
+            if self.stopped.is_set():
+                raise PipelineStopped()
+
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    # Yield the items passed down a queue until the end is reached
+    def get_all(self, q):
+        while True:
+            try:
+                item = q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    raise PipelineStopped()
+                continue
+
+            if item is END:
+                return
+            yield item
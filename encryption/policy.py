@@ -0,0 +1,38 @@
+import hashlib
+
+from encryption import tpm_client
+
+# Computes the digests of TPM policies on the host, as the TPM computes them in a policy session (TPM 2.0 part 3, section 23)
+# so the policy that a key is sealed with is known without a trial session, and without the TPM hashing anything
+# every policy starts as a zero digest, and each assertion extends it with the hash of the command code and its arguments
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+def empty_policy():
+    return bytes(tpm_client.SHA256_SIZE)
+
+# The value of a PCR after it is extended with a digest (TPM2_PCR_Extend)
+def pcr_extend(value, digest):
+    return sha256(value + digest)
+
+# The value of a PCR reset to zero after it is extended with each of the digests in turn
+def pcr_value(digests):
+    value = empty_policy()
+    for digest in digests:
+        value = pcr_extend(value, digest)
+
+    return value
+
+# The name of an object, from its public area (a TPMT_PUBLIC), as returned by TPM2_Create or TPM2_ReadPublic
+def object_name(public):
+    return tpm_client.u16(tpm_client.TPM_ALG_SHA256) + sha256(public)
+
+# TPM2_PolicyPCR, bound to the values of a single PCR
+def policy_pcr(policy, pcr, value):
+    return sha256(policy + tpm_client.u32(tpm_client.TPM_CC_POLICY_PCR) + tpm_client.pcr_selection(pcr) + sha256(value))
+
+# TPM2_PolicySigned, satisfied by a signature from the object with this name (with no policy reference)
+def policy_signed(policy, auth_name, policy_ref=b""):
+    policy = sha256(policy + tpm_client.u32(tpm_client.TPM_CC_POLICY_SIGNED) + auth_name)
+    return sha256(policy + policy_ref)
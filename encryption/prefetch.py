@@ -0,0 +1,71 @@
+import os
+import threading
+
+import config
+from encryption import image_format
+from encryption.engine import read_exact
+
+# Reads the encrypted image into the page cache in the background, while the user is still authenticating
+# so that decrypting it afterwards reads from RAM rather than waiting on the SD card
+# only ciphertext is read, nothing is decrypted (the key is not unsealed until authentication has passed)
+class Prefetcher:
+    def __init__(self, path, limit=config.PREFETCH_SIZE):
+        self.path = path
+        self.limit = limit
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.limit <= 0 or not os.path.exists(self.path):
+            return
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stop prefetching (once decryption starts, so the two do not compete for the SD card)
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Byte ranges of the image in the order they are decrypted, skipping holes as they are never read
+    def ranges(self, f):
+        size = os.fstat(f.fileno()).st_size
+
+        if not image_format.is_chunked_image(self.path):
+            return [(0, size)]
+
+        header, entries = image_format.read_header_and_table(f)
+        return [(header.chunk_offset(entry.slot_index(index)), entry.length) for index, entry in enumerate(entries) if not entry.flags & image_format.CHUNK_HOLE]
+
+    def run(self):
+        total = 0
+
+        try:
+            with open(self.path, "rb", buffering=0) as f:
+                # The image is read in order, so the kernel can read ahead further than usual
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                buffer = memoryview(bytearray(image_format.CHUNK_SIZE))
+
+                for offset, length in self.ranges(f):
+                    while length > 0 and total < self.limit:
+                        # Stopped part way through, so none of the remaining ranges are read either
+                        if self.stopped.is_set():
+                            print(f"# Prefetch stopped after {total} bytes of the encrypted image")
+                            return
+
+                        n = min(length, len(buffer), self.limit - total)
+                        f.seek(offset)
+                        n = read_exact(f, buffer[:n])
+                        if n == 0:
+                            break
+
+                        offset += n
+                        length -= n
+                        total += n
+        except (OSError, ValueError) as e:
+            print(f"# Prefetch stopped ({e})")
+
+        print(f"# Prefetched {total} bytes of the encrypted image")
@@ -0,0 +1,96 @@
+import os
+import struct
+
+from encryption import image_format
+
+# Records the chunks that a full encrypt (or a key rotation) has completed, in a file next to its output
+# so that if it is interrupted, trying again resumes where it stopped rather than starting over
+# the file starts with an identity (e.g. the image header), and is only used to resume a transform with the same identity
+PROGRESS_MAGIC = b"PIUSBPRG"
+
+# Each record is the index of a completed chunk, its table entry and the digest of its plaintext
+RECORD_FORMAT = "<I"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT) + image_format.ENTRY_SIZE + 16
+
+# Number of chunks between commits, which each sync the output and then the progress file
+COMMIT_INTERVAL = 64
+
+def progress_path(output_path):
+    return output_path + ".progress"
+
+class Progress:
+    def __init__(self, output_path, identity):
+        self.path = progress_path(output_path)
+        self.identity = identity
+        self.f = None
+        self.pending = []
+
+    # Read the chunks completed by an earlier attempt, as a dict of (entry, digest) by index
+    # returns an empty dict (and forgets the earlier attempt) if there was none or it does not match
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        prefix = PROGRESS_MAGIC + struct.pack("<I", len(self.identity)) + self.identity
+        if not data.startswith(prefix):
+            os.remove(self.path)
+            return {}
+
+        completed = {}
+        # A record cut short by a crash is ignored
+        for offset in range(len(prefix), len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            index = struct.unpack_from(RECORD_FORMAT, data, offset)[0]
+            entry = image_format.ChunkEntry.unpack(data, offset + struct.calcsize(RECORD_FORMAT))
+            digest = data[offset + RECORD_SIZE - 16:offset + RECORD_SIZE]
+            completed[index] = (entry, digest)
+
+        return completed
+
+    # Start recording, keeping the records of an earlier attempt if resuming it
+    def begin(self, resume):
+        if resume:
+            # Any partial record left by a crash is cut off, so new records stay aligned
+            size = os.path.getsize(self.path)
+            prefix_size = len(PROGRESS_MAGIC) + 4 + len(self.identity)
+            self.f = open(self.path, "r+b")
+            self.f.truncate(size - (size - prefix_size) % RECORD_SIZE)
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(self.path, "wb")
+            self.f.write(PROGRESS_MAGIC + struct.pack("<I", len(self.identity)) + self.identity)
+
+    # Record a completed chunk, which is written at the next commit
+    # output is synced first, so a chunk is never recorded before its data is durable
+    def add(self, output, index, entry, digest):
+        self.pending.append(struct.pack(RECORD_FORMAT, index) + entry.pack() + digest)
+
+        if len(self.pending) >= COMMIT_INTERVAL:
+            self.commit(output)
+
+    def commit(self, output):
+        if not self.pending:
+            return
+
+        os.fsync(output.fileno())
+
+        self.f.write(b"".join(self.pending))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = []
+
+    # Stop recording, keeping the file so that a later attempt can resume
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        self.pending = []
+
+    # The transform has completed, so there is nothing left to resume
+    def finish(self):
+        self.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
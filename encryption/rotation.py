@@ -0,0 +1,276 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+import config
+from encryption import activity
+from encryption import chunk_crypto
+from encryption import image_format
+from encryption import journal
+from encryption import keyring
+from encryption import progress
+from encryption import snapshots
+from encryption.checkpoint import Checkpointer, CheckpointCancelled
+from encryption.engine import BLOCK_SIZE, derive_chunk_key, fsync_directory, key_check_value, write_all
+
+# Rotates the data key of a drive while it stays mounted
+# the chunks of the image are re-encrypted under a new key into a copy next to it, a chunk at a time in the background,
+# while the host keeps using the image under the old key; on eject, the chunks the host changed since they were copied
+# are re-encrypted again, the copy replaces the image and the new key is recorded in the keyring
+# the new key is kept next to the image, wrapped under the old one, so an interrupted rotation resumes on the next mount
+# (only until the rotation finishes, after which nothing wrapped under the old key leads to the new one)
+ROTATION_MAGIC = b"PIUSBROT"
+
+def rotation_path(image_path):
+    return image_path + ".rotation"
+
+def rotated_path(image_path):
+    return image_path + ".rotated"
+
+# Digest of a chunk's table entry in the image being rotated, recorded with each chunk once it is re-encrypted
+# every write gives a chunk a new entry (with a fresh IV), so a chunk whose entry has changed since must be re-encrypted again
+def entry_digest(entry):
+    return hashlib.blake2b(entry.pack(), digest_size=16).digest()
+
+# record_key(new_key) records the new key in the drive's keyring once the new image has replaced the old one
+class KeyRotation(Checkpointer):
+    def __init__(self, image_path, aes_key, last_activity, record_key, interval=config.ROTATION_INTERVAL):
+        super().__init__(self.rotate, last_activity, interval)
+
+        self.image_path = image_path
+        self.path = rotation_path(image_path)
+        self.output_path = rotated_path(image_path)
+
+        self.old_key = aes_key
+        self.new_key = None
+        self.record_key = record_key
+
+        # Layout and key of the new image, and (entry, digest of the old entry) of each chunk re-encrypted into it
+        self.header = None
+        self.completed = {}
+
+        # Whether every chunk has been re-encrypted at least once, after which the rotation can be finished
+        self.caught_up = False
+
+    # Whether an image has a rotation that has not finished
+    def pending(image_path):
+        return os.path.exists(rotation_path(image_path))
+
+    # Start a new rotation of the image, or resume the one already in progress
+    # returns False if the image is no longer under the key being rotated (a finished rotation that was never cleaned up)
+    def begin(self):
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+
+            if not data.startswith(ROTATION_MAGIC):
+                raise ValueError("corrupt key rotation")
+
+            try:
+                self.new_key = keyring.unwrap_key(self.old_key, data[len(ROTATION_MAGIC):])
+            except ValueError:
+                self.discard()
+                return False
+
+            return True
+
+        self.new_key = keyring.generate_data_key()
+
+        # The rotation only appears once it has been completely written
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(ROTATION_MAGIC + keyring.wrap_key(self.old_key, self.new_key))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+        return True
+
+    # The new key of a rotation whose image replaced the old one before its key was recorded in the keyring (if power was lost)
+    # or None if none of the keys (the ones the keyring gives, oldest first) is the one being rotated
+    def recover_key(image_path, keys):
+        if not os.path.exists(rotation_path(image_path)):
+            return None
+
+        with open(rotation_path(image_path), "rb") as f:
+            data = f.read()
+        with open(image_path, "rb") as f:
+            header, entries = image_format.read_header_and_table(f)
+
+        for aes_key in keys:
+            try:
+                new_key = keyring.unwrap_key(aes_key, data[len(ROTATION_MAGIC):])
+            except ValueError:
+                continue
+
+            if hmac.compare_digest(key_check_value(derive_chunk_key(new_key, header)), header.key_check):
+                return new_key
+
+        return None
+
+    # Percentage of the chunks re-encrypted under the new key so far
+    def percent_done(self):
+        if self.header is None or self.header.chunk_count == 0:
+            return 0
+
+        return 100 * len(self.completed) // self.header.chunk_count
+
+    # Set up the new image for the layout of the old one
+    # the chunks an earlier attempt re-encrypted are kept, unless the old image has since changed its layout
+    def prepare(self, header):
+        if header.version != image_format.VERSION:
+            raise ValueError("only images in the current version can be rotated")
+
+        old_chunk_key = derive_chunk_key(self.old_key, header)
+        if not hmac.compare_digest(key_check_value(old_chunk_key), header.key_check):
+            raise ValueError("the image is not under the key being rotated")
+
+        new_header = image_format.Header(header.image_size, header.chunk_size, header.cipher, compression=header.compression)
+        chunk_key = derive_chunk_key(self.new_key, new_header)
+        new_header.key_check = key_check_value(chunk_key)
+
+        if self.header is not None and self.header.pack() == new_header.pack():
+            return
+
+        self.header = new_header
+        self.old_chunk_key = old_chunk_key
+        self.chunk_key = chunk_key
+
+        self.progress = progress.Progress(self.output_path, new_header.pack())
+        self.completed = self.progress.load() if os.path.exists(self.output_path) else {}
+        self.resume = bool(self.completed)
+        self.caught_up = False
+
+        if not self.completed:
+            with open(self.output_path, "wb") as f:
+                f.truncate(new_header.file_size())
+
+        self.in_buffer = bytearray(header.chunk_size + BLOCK_SIZE)
+        self.plaintext_buffer = bytearray(header.chunk_size + chunk_crypto.OUTPUT_MARGIN)
+        self.out_buffer = bytearray(header.chunk_size + chunk_crypto.OUTPUT_MARGIN)
+
+    # One pass over the image, re-encrypting every chunk that has not been, or has changed since it was
+    # calling throttle before each chunk; returns the number of chunks re-encrypted
+    def rotate(self, throttle):
+        with open(self.image_path, "rb", buffering=0) as fin:
+            # The table is read without the journal being recovered, as the host may be writing to the image
+            # a chunk changed part way through the pass gets a new entry, so it is caught by the next one
+            header, entries = image_format.read_header_and_table(fin)
+            self.prepare(header)
+
+            rotated = 0
+            skipped = 0
+            with open(self.output_path, "r+b", buffering=0) as fout:
+                self.progress.begin(self.resume)
+                self.resume = True
+                try:
+                    for index, entry in enumerate(entries):
+                        digest = entry_digest(entry)
+                        if index in self.completed and self.completed[index][1] == digest:
+                            continue
+
+                        throttle()
+
+                        try:
+                            new_entry = self.rotate_chunk(fin, fout, header, index, entry)
+                        except ValueError:
+                            # The chunk may have been rewritten while it was read, it is tried again on the next pass
+                            skipped += 1
+                            continue
+
+                        self.completed[index] = (new_entry, digest)
+                        self.progress.add(fout, index, new_entry, digest)
+                        rotated += 1
+                finally:
+                    self.progress.commit(fout)
+                    self.progress.close()
+
+            self.caught_up = len(self.completed) == header.chunk_count and skipped == 0
+
+        return rotated
+
+    # Decrypt a chunk of the old image, and encrypt it into its slot in the new one, returning its new table entry
+    def rotate_chunk(self, fin, fout, header, index, entry):
+        if entry.flags & image_format.CHUNK_HOLE:
+            return image_format.ChunkEntry(bytes(image_format.IV_SIZE), image_format.CHUNK_HOLE, 0)
+
+        if entry.length > header.chunk_size:
+            raise ValueError("corrupt chunk table")
+
+        in_view = memoryview(self.in_buffer)[:entry.length]
+        if os.preadv(fin.fileno(), [in_view], header.chunk_offset(entry.slot_index(index))) != entry.length:
+            raise ValueError("truncated image")
+
+        plaintext_view = memoryview(self.plaintext_buffer)
+        chunk_crypto.decrypt_chunk(header.cipher, self.old_chunk_key, header.compression, header.chunk_size, index, entry.iv, entry.flags, in_view, plaintext_view)
+
+        iv = os.urandom(image_format.IV_SIZE)
+        out_view = memoryview(self.out_buffer)
+        flags, m = chunk_crypto.encrypt_chunk(header.cipher, self.chunk_key, header.compression, index, iv, plaintext_view[:header.chunk_size], out_view)
+
+        fout.seek(self.header.chunk_offset(index))
+        write_all(fout, out_view[:m])
+
+        return image_format.ChunkEntry(iv, flags, m)
+
+    # Re-encrypt in the background, a pass at a time, until stopped
+    # after the first pass, each one only re-encrypts the chunks the host has changed since the one before
+    def run(self):
+        # Run at the lowest CPU priority, so the drive stays responsive while the image is re-encrypted
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+
+        while True:
+            try:
+                start = time.monotonic()
+                with activity.working():
+                    rotated = self.rotate(self.throttle)
+                if rotated > 0:
+                    print(f"# Key rotation re-encrypted {rotated} chunks in {time.monotonic() - start:.2f}s ({self.percent_done()}% done)")
+            except CheckpointCancelled:
+                return
+            except (OSError, ValueError) as e:
+                print(f"# Key rotation failed ({e})")
+
+            if self.stopped.wait(self.interval):
+                return
+
+    # Finish the rotation once the image is no longer being written (after the drive is encrypted on eject)
+    # returns the new key, or None if not every chunk has been re-encrypted yet (the rotation then resumes on the next mount)
+    def finish(self):
+        self.stop()
+        if not self.caught_up:
+            return None
+
+        # The last pass re-encrypts the chunks changed since the one before, with nothing else writing to the image
+        journal.recover(self.image_path)
+        self.rotate(lambda: None)
+        if not self.caught_up:
+            raise ValueError("not every chunk could be re-encrypted")
+
+        with open(self.output_path, "r+b", buffering=0) as fout:
+            image_format.write_header_and_table(fout, self.header, [self.completed[index][0] for index in range(self.header.chunk_count)])
+            os.fsync(fout.fileno())
+
+        # Nothing of the old image applies to the new one, and it is not kept, as it is under the key being retired
+        journal.Journal(self.image_path).discard()
+        snapshots.keep_previous(self.image_path, False)
+
+        # The new image replaces the old one before the new key is recorded
+        # (if power is lost in between, unlocking the drive finds the new key with recover_key and records it then)
+        os.replace(self.output_path, self.image_path)
+        fsync_directory(self.image_path)
+        self.progress.finish()
+        self.record_key(self.new_key)
+
+        # Once the key is recorded, the rotation (the new key wrapped under the old one) is no longer needed
+        os.remove(self.path)
+
+        return self.new_key
+
+    # Forget a rotation (the new image and its progress included)
+    def discard(self):
+        for path in (self.path, self.output_path, progress.progress_path(self.output_path)):
+            if os.path.exists(path):
+                os.remove(path)
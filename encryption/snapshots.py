@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Snapshots of the encrypted drive image, one for each eject
+# usage (from the repository root, while the drive is not mounted): python3 -m encryption.snapshots [drive] [previous] [list | rollback [id] | restore]
+# (the drive is the name of a profile in config.DRIVE_PROFILES, the first one if it is not given,
+# and previous works on the image kept from before the last full rewrite, which restore puts back in place of the current one)
+
+import os
+import shutil
+import sys
+import time
+
+import config
+from encryption import image_format
+from encryption import journal
+
+SNAPSHOT_SUFFIX = ".table"
+
+def snapshot_directory(image_path):
+    return image_path + ".snapshots"
+
+# The image that the last full rewrite replaced, with its own snapshots (see keep_previous)
+def previous_path(image_path):
+    return image_path + ".previous"
+
+# Chooses the slot each changed chunk is written to, which is never one that the image's table or a snapshot refers to
+# so the new version of a chunk can be written and synced before the table is switched over to it (through the journal),
+# and a chunk is only ever written once: a changed chunk goes back to its own slot if that is free, otherwise it is moved
+# to a free slot after the image's own slots (each chunk holds at most one of those at a time, and keeping a snapshot
+# costs one slot for each chunk that has changed since, however large the image is)
+class SlotAllocator:
+    def __init__(self, header, entries, protected):
+        self.header = header
+        self.protected = protected
+        self.used = set(protected) | table_slots(entries)
+
+        self.next_slot = header.chunk_count
+
+    # Slot for the new version of a chunk (as a ChunkEntry.slot)
+    def slot_for(self, index):
+        if index not in self.used:
+            self.used.add(index)
+            return None
+
+        while self.next_slot in self.used:
+            self.next_slot += 1
+        if self.next_slot > image_format.MAX_SLOT:
+            raise ValueError("no free slots left for snapshots")
+
+        self.used.add(self.next_slot)
+        return self.next_slot
+
+    # Free the slot of the old version of a chunk, once the table refers to the new one (unless a snapshot still refers to it)
+    def release(self, index, entry):
+        if entry.flags & image_format.CHUNK_HOLE:
+            return
+
+        slot = entry.slot_index(index)
+        if slot not in self.protected:
+            self.used.discard(slot)
+            if slot >= self.header.chunk_count:
+                self.next_slot = min(self.next_slot, slot)
+
+# Slots holding the chunks of a table
+def table_slots(entries):
+    return {entry.slot_index(index) for index, entry in enumerate(entries) if not entry.flags & image_format.CHUNK_HOLE}
+
+# The snapshots of an image, each a copy of the image's header and table stored next to it
+# a snapshot shares every chunk with the image until that chunk changes, and the SlotAllocator then writes the
+# new version to another slot, so creating a snapshot only copies the table and rolling back only rewrites it
+class SnapshotStore:
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self.directory = snapshot_directory(image_path)
+
+    def path(self, snapshot_id):
+        return os.path.join(self.directory, f"{snapshot_id}{SNAPSHOT_SUFFIX}")
+
+    # Ids of the snapshots, oldest first
+    def list(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted(int(name[:-len(SNAPSHOT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SNAPSHOT_SUFFIX))
+
+    def read(self, snapshot_id):
+        with open(self.path(snapshot_id), "rb") as f:
+            return image_format.read_header_and_table(f)
+
+    # Slots that the chunks of any snapshot are stored in, which must not be overwritten
+    def protected_slots(self):
+        slots = set()
+        for snapshot_id in self.list():
+            header, entries = self.read(snapshot_id)
+            slots |= table_slots(entries)
+
+        return slots
+
+    # Record the current version of the image as a new snapshot, returning its id
+    # (if nothing has changed since the newest snapshot, that snapshot is returned instead)
+    def create(self):
+        journal.recover(self.image_path)
+
+        with open(self.image_path, "rb") as f:
+            header, entries = image_format.read_header_and_table(f)
+        table = header.pack() + b"".join(entry.pack() for entry in entries)
+
+        ids = self.list()
+        if ids:
+            with open(self.path(ids[-1]), "rb") as f:
+                if f.read() == table:
+                    return ids[-1]
+
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_id = ids[-1] + 1 if ids else 1
+
+        # The snapshot only appears once it has been completely written
+        temporary_path = self.path(snapshot_id) + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path(snapshot_id))
+
+        return snapshot_id
+
+    # Switch the image back to a snapshot by rewriting the table entries that differ from it (through the journal)
+    # with no id, the image goes back to the newest snapshot that differs from it
+    # snapshots newer than the one rolled back to are deleted, so rolling back again goes further back
+    def rollback(self, snapshot_id=None):
+        journal.recover(self.image_path)
+        ids = self.list()
+
+        with open(self.image_path, "r+b", buffering=0) as f:
+            header, entries = image_format.read_header_and_table(f)
+            table = [entry.pack() for entry in entries]
+
+            if snapshot_id is None:
+                for candidate in reversed(ids):
+                    if [entry.pack() for entry in self.read(candidate)[1]] != table:
+                        snapshot_id = candidate
+                        break
+                else:
+                    raise ValueError("there is no earlier snapshot to roll back to")
+            elif snapshot_id not in ids:
+                raise ValueError(f"there is no snapshot {snapshot_id}")
+
+            snapshot_header, snapshot_entries = self.read(snapshot_id)
+            if snapshot_header.pack() != header.pack():
+                raise ValueError("the snapshot is of a different image")
+
+            changes = journal.Journal(self.image_path)
+            changes.begin()
+            for index, entry in enumerate(snapshot_entries):
+                if entry.pack() != table[index]:
+                    changes.add(index, entry)
+            changes.commit()
+            changed = len(changes.apply(f, header))
+
+        for newer_id in ids:
+            if newer_id > snapshot_id:
+                os.remove(self.path(newer_id))
+
+        print(f"# Rolled back to snapshot {snapshot_id}, {changed} chunks changed")
+        return snapshot_id
+
+    # Delete the oldest snapshots beyond the retention, then free the slots that no table refers to any more
+    # (slots after the image's own ones are cut off the end of the file, the rest are reused as chunks change)
+    def gc(self, retention=config.SNAPSHOT_RETENTION):
+        ids = self.list()
+        for snapshot_id in ids[:max(len(ids) - retention, 0)]:
+            os.remove(self.path(snapshot_id))
+
+        journal.recover(self.image_path)
+        with open(self.image_path, "r+b", buffering=0) as f:
+            header, entries = image_format.read_header_and_table(f)
+
+            used = table_slots(entries) | self.protected_slots()
+            end = header.chunk_offset(max(used | {header.chunk_count - 1}) + 1)
+            if os.fstat(f.fileno()).st_size > end:
+                f.truncate(end)
+
+    # Delete every snapshot (once the image has been rewritten in full, its old chunks are gone)
+    def delete_all(self):
+        ids = self.list()
+        for snapshot_id in ids:
+            os.remove(self.path(snapshot_id))
+
+        return len(ids)
+
+# Called just before a full rewrite replaces an image, as the snapshots of the old image do not apply to the new one
+# if keep is set, the old image is kept with its snapshots as previous_path (replacing the one kept by the rewrite before),
+# otherwise (e.g. for a key rotation, whose old images are under the key being retired) the snapshots are deleted,
+# along with any image kept before
+def keep_previous(image_path, keep=config.KEEP_PREVIOUS_IMAGE):
+    store = SnapshotStore(image_path)
+    previous = previous_path(image_path)
+    previous_store = SnapshotStore(previous)
+
+    if os.path.exists(previous):
+        os.remove(previous)
+        if not keep:
+            print(f"# WARNING: deleted {previous}, the image kept from before the last full rewrite")
+    if os.path.isdir(previous_store.directory):
+        shutil.rmtree(previous_store.directory)
+
+    if not image_format.is_chunked_image(image_path):
+        return
+
+    if not keep:
+        deleted = store.delete_all()
+        if deleted > 0:
+            print(f"# WARNING: deleted the {deleted} snapshots of {image_path}, as it is being rewritten in full")
+        return
+
+    # The old image is kept through a second link to it, so nothing is copied, and it survives the rewrite replacing its name
+    journal.recover(image_path)
+    os.link(image_path, previous)
+    if os.path.isdir(store.directory):
+        os.replace(store.directory, previous_store.directory)
+
+    print(f"# WARNING: {image_path} is being rewritten in full, so its {len(previous_store.list())} snapshots no longer apply to it")
+    print(f"# WARNING: the old image and its snapshots are kept as {previous}")
+
+# Swap the image kept by keep_previous with the current one (which is then kept as the previous image in turn)
+def restore_previous(image_path):
+    previous = previous_path(image_path)
+    if not os.path.exists(previous):
+        raise ValueError("there is no previous image")
+
+    journal.recover(image_path)
+    journal.Journal(previous).discard()
+
+    # The current image stays reachable through a temporary link until the previous one has replaced it
+    swap_path = image_path + ".swap"
+    if os.path.exists(swap_path):
+        os.remove(swap_path)
+    os.link(image_path, swap_path)
+    os.replace(previous, image_path)
+    os.replace(swap_path, previous)
+
+    directory, previous_directory = snapshot_directory(image_path), snapshot_directory(previous)
+    if os.path.isdir(directory):
+        os.replace(directory, swap_path)
+    if os.path.isdir(previous_directory):
+        os.replace(previous_directory, directory)
+    if os.path.isdir(swap_path):
+        os.replace(swap_path, previous_directory)
+
+    print(f"# Restored the previous image of {image_path}")
+
+def main():
+    # Imported here, as encryption.encryption needs the TPM tools
+    from encryption.encryption import Encryption
+
+    args = sys.argv[1:]
+    drive = Encryption.find_drive(args.pop(0) if args and args[0] in config.DRIVE_PROFILES else None)
+    image_path = drive.encrypted_image_path
+    if args and args[0] == "previous":
+        args.pop(0)
+        image_path = previous_path(image_path)
+    store = SnapshotStore(image_path)
+
+    command = args[0] if args else "list"
+    if command == "restore":
+        restore_previous(drive.encrypted_image_path)
+    elif command == "list":
+        print("id  created              stored chunks")
+        for snapshot_id in store.list():
+            header, entries = store.read(snapshot_id)
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(store.path(snapshot_id))))
+            print(f"{snapshot_id:2}  {created}  {len(table_slots(entries)):13}")
+    elif command == "rollback":
+        store.rollback(int(args[1]) if len(args) > 1 else None)
+        store.gc()
+    else:
+        print(f"unknown command {command}")
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,211 @@
+import os
+import shutil
+import signal
+import socket
 import subprocess
 import time
 
-import utils
+import config
+from encryption.encryption import Encryption
+from encryption.tpm_client import TPMError
+
+TPM_SERVER_PATH = "./encryption/stpm/src/tpm_server"
+
+# The server's output, and the pid of the running server (so that one left running by a crash can be stopped)
+TPM_SERVER_LOG = "./tpm_server.log"
+TPM_SERVER_PID = "./tpm_server.pid"
+
+# Delays between attempts to reach a starting server, doubling from the first up to the last
+START_POLL_DELAY = 0.005
+START_POLL_MAX_DELAY = 0.1
+
+# Seconds a stopped server is given to exit before it is killed
+STOP_TIMEOUT = 2
+
+# The simulator's NV file (all of the TPM's persistent state), and a copy of it taken just after a reset
+# with the TPM cleared and its storage key provisioned
+NV_PATH = "./NVChip"
+NV_SNAPSHOT_PATH = "./NVChip.provisioned"
+
+# Raised when the TPM server does not start (e.g. it exits straight away, or never answers before the deadline)
+class TPMStartError(Exception):
+    pass
 
 class TPM:
     tpm_server_proc = None
 
-    # Start the TPM server
+    # Start the TPM server, returning once it has started the TPM
+    # the server's ports are polled (with a short backoff) until TPM2_Startup succeeds over them
+    # a server that exits or does not answer within config.TPM_START_TIMEOUT raises a TPMStartError with its output
     def start(self):
-        # Spawn the server subprocess
-        self.tpm_server_proc = subprocess.Popen(["./encryption/stpm/src/tpm_server"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.stop_stale_server()
 
-        try:
-            # The 1 second pause also gives the TPM server to start properly
-            # TODO: Replace this long pause with checks on the output of the "startup -c" command to see if there is an error
-            # if there is an error, wait and then retry till the server is ready
-            stdout, stderr = self.tpm_server_proc.communicate(timeout=1)
-        except subprocess.TimeoutExpired:
-            # This should occur if the TPM server started properly
-            # as there should be no end-of-file character yet
-            pass
-        else:
-            # There has been an error as the TPM server has already stopped
-            print("# TPM failed to start")
-            utils.log(stdout)
-
-        print("# TPM started")
+        # Another process on the server's ports would be answered instead of the server that is started here
+        if self.ports_in_use():
+            print("# TPM failed to start: its ports are used by another process")
+            raise TPMStartError("the TPM server's ports are used by another process")
+
+        start = time.monotonic()
+        with open(TPM_SERVER_LOG, "wb") as log:
+            # Spawn the server subprocess, its output going to the log rather than a pipe that nothing reads
+            self.tpm_server_proc = subprocess.Popen([TPM_SERVER_PATH], stdout=log, stderr=subprocess.STDOUT)
+        with open(TPM_SERVER_PID, "w") as f:
+            f.write(str(self.tpm_server_proc.pid))
+
+        delay = START_POLL_DELAY
+        while True:
+            if self.tpm_server_proc.poll() is not None:
+                self.start_failed(f"the TPM server exited with code {self.tpm_server_proc.returncode}")
+
+            try:
+                # Connecting powers the TPM on and starts it, so the connection is ready for the first command
+                Encryption.tpm.connect()
+                break
+            except (OSError, TPMError) as e:
+                if time.monotonic() - start + delay > config.TPM_START_TIMEOUT:
+                    self.start_failed(f"the TPM server did not start within {config.TPM_START_TIMEOUT}s ({e})")
+
+            time.sleep(delay)
+            delay = min(delay * 2, START_POLL_MAX_DELAY)
+
+        print(f"# TPM started in {time.monotonic() - start:.3f}s")
+
+    # Report why the server did not start, with the end of its output, then stop it
+    def start_failed(self, reason):
+        print(f"# TPM failed to start: {reason}")
+        with open(TPM_SERVER_LOG, "rb") as f:
+            for line in f.read().decode("utf-8", "replace").splitlines()[-20:]:
+                print(f"#   {line}")
+
+        self.stop()
+        raise TPMStartError(reason)
 
     # Stop the TPM server
     def stop(self):
-        # Kill the current TPM server process
-        if self.tpm_server_proc:
-            self.tpm_server_proc.kill()
+        # The connection is opened again by the first command after the server restarts
+        Encryption.tpm.close()
+
+        # Ask the server to exit, killing it if it does not
+        if self.tpm_server_proc is not None:
+            self.tpm_server_proc.terminate()
+            try:
+                self.tpm_server_proc.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.tpm_server_proc.kill()
+                self.tpm_server_proc.wait()
+
+            self.tpm_server_proc = None
+            if os.path.exists(TPM_SERVER_PID):
+                os.remove(TPM_SERVER_PID)
 
-        # Make sure any other TPM server processes are also killed (sometimes they can be left running if program crashes)
-        subprocess.run("pkill -f tpm_server", shell=True)
         print("# TPM stopped")
 
+    # Stop a server left running by an earlier run of the program that crashed before stopping it (it would hold the ports)
+    # it is found through its pid file, and only killed if that pid is still a TPM server, as pids are reused
+    def stop_stale_server(self):
+        try:
+            with open(TPM_SERVER_PID) as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            return
+
+        try:
+            stale = os.path.basename(os.readlink(f"/proc/{pid}/exe")) == os.path.basename(TPM_SERVER_PATH)
+        except OSError:
+            stale = False
+
+        if stale:
+            os.kill(pid, signal.SIGKILL)
+
+            # It is not a child of this process, so it is waited for by polling until it has gone
+            deadline = time.monotonic() + STOP_TIMEOUT
+            while os.path.exists(f"/proc/{pid}") and time.monotonic() < deadline:
+                time.sleep(START_POLL_DELAY)
+            print(f"# Stopped a TPM server left running (pid {pid})")
+
+        os.remove(TPM_SERVER_PID)
+
+    # Whether anything is listening on the TPM server's ports
+    def ports_in_use(self):
+        for port in (Encryption.tpm.command_port, Encryption.tpm.platform_port):
+            try:
+                socket.create_connection((Encryption.tpm.host, port), timeout=START_POLL_MAX_DELAY).close()
+                return True
+            except OSError:
+                pass
+
+        return False
+
     # Reboots the TPM server
     def restart(self):
         self.stop()
         self.start()
-        
-    # Reset the TPM to a blank state
+
+    # Copy the NV file while the TPM is powered off, so that the copy is of a consistent state
+    # the copy only appears once it has been completely written
+    def copy_nv(self, source, destination):
+        with Encryption.tpm.lock:
+            Encryption.tpm.power_off()
+            try:
+                temporary_path = destination + ".tmp"
+                shutil.copyfile(source, temporary_path)
+                with open(temporary_path, "rb") as f:
+                    os.fsync(f.fileno())
+                os.replace(temporary_path, destination)
+            finally:
+                Encryption.tpm.power_on()
+
+    # Snapshot the TPM's current state, which reset then returns it to
+    def snapshot(self):
+        self.copy_nv(NV_PATH, NV_SNAPSHOT_PATH)
+        print("# Snapshotted the TPM's NV state")
+
+    # Return the TPM to the state of the snapshot, returning False if there is none
+    # the simulator reloads its NV file when it is powered back on, so it does not have to be restarted
+    def restore(self):
+        if not os.path.exists(NV_SNAPSHOT_PATH):
+            return False
+
+        # A snapshot the simulator could not load leaves it blank (or stops it), so it is checked before and after it is loaded
+        try:
+            if os.path.getsize(NV_SNAPSHOT_PATH) != os.path.getsize(NV_PATH):
+                raise ValueError("it is not the size of the NV file")
+
+            self.copy_nv(NV_SNAPSHOT_PATH, NV_PATH)
+            Encryption.fingerprint_key_name_cache = None
+            Encryption.tpm.read_public(int(Encryption.STORAGE_KEY_ADDR, 16))
+        except (OSError, ValueError, TPMError) as e:
+            print(f"# The TPM's NV snapshot is unusable, deleting it ({e})")
+            os.remove(NV_SNAPSHOT_PATH)
+
+            # The server starts again from a blank NV file, as it may not be able to load the one restored
+            if os.path.exists(NV_PATH):
+                os.remove(NV_PATH)
+            self.restart()
+            return False
+
+        print("# Restored the TPM's NV state from its snapshot")
+        return True
+
+    # Reset the TPM to a blank state, with new keys for communicating with the fingerprint sensor
+    # (if config.TPM_RESET_SNAPSHOT is set, by restoring a snapshot of the state it was in after the first reset)
     def reset(self):
-        stdout = utils.execute_command(["./encryption/scripts/reset_tpm"])
+        if not (config.TPM_RESET_SNAPSHOT and self.restore()):
+            # Delete the NV RAM chip backing file, then clear the TPM
+            if os.path.exists(NV_PATH):
+                os.remove(NV_PATH)
+            Encryption.tpm.clear()
+            Encryption.fingerprint_key_name_cache = None
+
+            # Restart the TPM to reload the NVRAM
+            self.restart()
+
+            if config.TPM_RESET_SNAPSHOT:
+                # The snapshot is of the cleared TPM with its storage key, so later resets do not generate it again
+                Encryption.storage_key()
+                self.snapshot()
 
-        # Restart the TPM to reload the NVRAM
-        self.restart()
+        # Generate encryption keys for communicating with fingerprint sensor (or take them from the key pool)
+        Encryption.generate_fingerprint_communication_keys()
 
         print("# TPM has been reset")
@@ -0,0 +1,422 @@
+import os
+import socket
+import struct
+import threading
+import time
+
+# Talks to the TPM simulator (encryption/stpm) over its TCP interface, the same one the tpm2-tools reach through
+# TPM2TOOLS_TCTI=mssim, but in process and over one connection that stays open
+# every command is sent to the command port, wrapped as TPM_SEND_COMMAND, while the platform port takes the simulator's
+# own signals (power, NV); all of the interface's integers are big endian
+TPM_HOST = "localhost"
+TPM_COMMAND_PORT = 2321
+TPM_PLATFORM_PORT = 2322
+
+# Commands of the simulator's TCP interface
+TPM_SIGNAL_POWER_ON = 1
+TPM_SIGNAL_POWER_OFF = 2
+TPM_SEND_COMMAND = 8
+TPM_SIGNAL_NV_ON = 11
+TPM_SIGNAL_NV_OFF = 12
+TPM_SESSION_END = 20
+
+# Command tags, and the command codes used
+TPM_ST_NO_SESSIONS = 0x8001
+TPM_ST_SESSIONS = 0x8002
+TPM_ST_HASHCHECK = 0x8024
+
+TPM_CC_EVICT_CONTROL = 0x120
+TPM_CC_CLEAR = 0x126
+TPM_CC_CREATE_PRIMARY = 0x131
+TPM_CC_DICTIONARY_ATTACK_LOCK_RESET = 0x139
+TPM_CC_PCR_RESET = 0x13D
+TPM_CC_STARTUP = 0x144
+TPM_CC_SHUTDOWN = 0x145
+TPM_CC_CREATE = 0x153
+TPM_CC_LOAD = 0x157
+TPM_CC_RSA_DECRYPT = 0x159
+TPM_CC_SIGN = 0x15D
+TPM_CC_UNSEAL = 0x15E
+TPM_CC_POLICY_SIGNED = 0x160
+TPM_CC_FLUSH_CONTEXT = 0x165
+TPM_CC_READ_PUBLIC = 0x173
+TPM_CC_RSA_ENCRYPT = 0x174
+TPM_CC_START_AUTH_SESSION = 0x176
+TPM_CC_VERIFY_SIGNATURE = 0x177
+TPM_CC_GET_CAPABILITY = 0x17A
+TPM_CC_GET_RANDOM = 0x17B
+TPM_CC_POLICY_PCR = 0x17F
+TPM_CC_PCR_EXTEND = 0x182
+
+# Response codes that are handled rather than raised
+TPM_RC_SUCCESS = 0x000
+TPM_RC_INITIALIZE = 0x100
+
+# Permanent handles, and the first handle of each range
+TPM_RH_OWNER = 0x40000001
+TPM_RH_NULL = 0x40000007
+TPM_RS_PW = 0x40000009
+TPM_RH_LOCKOUT = 0x4000000A
+TRANSIENT_FIRST = 0x80000000
+
+TPM_SU_CLEAR = 0x0000
+TPM_CAP_HANDLES = 0x00000001
+
+# Session types
+TPM_SE_POLICY = 0x01
+
+# Algorithms
+TPM_ALG_RSA = 0x0001
+TPM_ALG_SHA256 = 0x000B
+TPM_ALG_AES = 0x0006
+TPM_ALG_KEYEDHASH = 0x0008
+TPM_ALG_NULL = 0x0010
+TPM_ALG_RSASSA = 0x0014
+TPM_ALG_RSAES = 0x0015
+TPM_ALG_CFB = 0x0043
+
+SHA256_SIZE = 32
+
+# Object attributes
+FIXED_TPM = 0x00000002
+FIXED_PARENT = 0x00000010
+SENSITIVE_DATA_ORIGIN = 0x00000020
+USER_WITH_AUTH = 0x00000040
+RESTRICTED = 0x00010000
+DECRYPT = 0x00020000
+SIGN = 0x00040000
+
+def u8(value):
+    return struct.pack(">B", value)
+
+def u16(value):
+    return struct.pack(">H", value)
+
+def u32(value):
+    return struct.pack(">I", value)
+
+# A sized buffer (TPM2B), the size first
+def tpm2b(data=b""):
+    return u16(len(data)) + data
+
+# A selection of a single sha256 PCR (TPML_PCR_SELECTION), or of none
+def pcr_selection(pcr=None):
+    if pcr is None:
+        return u32(0)
+
+    select = bytearray(3)
+    select[pcr // 8] |= 1 << (pcr % 8)
+    return u32(1) + u16(TPM_ALG_SHA256) + u8(len(select)) + bytes(select)
+
+# Templates (TPM2B_PUBLIC contents) of the objects that are created, with the same defaults as the tpm2-tools
+# the storage primary key that other objects are created under (tpm2_createprimary -G rsa)
+def primary_template():
+    attributes = FIXED_TPM | FIXED_PARENT | SENSITIVE_DATA_ORIGIN | USER_WITH_AUTH | RESTRICTED | DECRYPT
+    parameters = u16(TPM_ALG_AES) + u16(128) + u16(TPM_ALG_CFB) + u16(TPM_ALG_NULL) + u16(2048) + u32(0)
+
+    return u16(TPM_ALG_RSA) + u16(TPM_ALG_SHA256) + u32(attributes) + tpm2b() + parameters + tpm2b()
+
+# An RSA key pair for signing and encrypting (tpm2_create with no options)
+def rsa_key_template():
+    attributes = FIXED_TPM | FIXED_PARENT | SENSITIVE_DATA_ORIGIN | USER_WITH_AUTH | DECRYPT | SIGN
+    parameters = u16(TPM_ALG_NULL) + u16(TPM_ALG_NULL) + u16(2048) + u32(0)
+
+    return u16(TPM_ALG_RSA) + u16(TPM_ALG_SHA256) + u32(attributes) + tpm2b() + parameters + tpm2b()
+
+# A sealed data object, which can only be unsealed by satisfying its policy (tpm2_create -L policy -i data)
+def sealed_data_template(policy):
+    attributes = FIXED_TPM | FIXED_PARENT
+
+    return u16(TPM_ALG_KEYEDHASH) + u16(TPM_ALG_SHA256) + u32(attributes) + tpm2b(policy) + u16(TPM_ALG_NULL) + tpm2b()
+
+# The policy digest of an object, from its public area (a TPMT_PUBLIC: type, name algorithm, attributes, then the policy)
+def auth_policy(public):
+    reader = ResponseReader(public)
+    reader.read(8)
+    return reader.tpm2b()
+
+# Raised when the TPM returns an error for a command
+class TPMError(Exception):
+    def __init__(self, command_code, response_code):
+        super().__init__(f"TPM command 0x{command_code:03x} failed with response code 0x{response_code:03x}")
+        self.command_code = command_code
+        self.response_code = response_code
+
+# Reads the fields of a response in order
+class ResponseReader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, length):
+        if self.offset + length > len(self.data):
+            raise ValueError("truncated TPM response")
+
+        data = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return data
+
+    def u8(self):
+        return struct.unpack(">B", self.read(1))[0]
+
+    def u16(self):
+        return struct.unpack(">H", self.read(2))[0]
+
+    def u32(self):
+        return struct.unpack(">I", self.read(4))[0]
+
+    def tpm2b(self):
+        return self.read(self.u16())
+
+    # Everything left, e.g. a structure that is passed back to the TPM as it is
+    def rest(self):
+        return self.read(len(self.data) - self.offset)
+
+class TPMClient:
+    def __init__(self, host=TPM_HOST, command_port=TPM_COMMAND_PORT, platform_port=TPM_PLATFORM_PORT):
+        self.host = host
+        self.command_port = command_port
+        self.platform_port = platform_port
+
+        self.command_socket = None
+        self.platform_socket = None
+
+        # Commands may come from several threads, but only one can be in flight on the connection
+        self.lock = threading.RLock()
+
+        # When the last command was sent (the key pool only generates keys while the TPM is otherwise unused)
+        self.last_used = 0
+
+    # Connect to the simulator (if not already connected), power it on and start the TPM
+    # transient objects left behind by an earlier connection are flushed, as they would fill the TPM's object slots
+    def connect(self):
+        with self.lock:
+            if self.command_socket is not None:
+                return
+
+            try:
+                self.command_socket = socket.create_connection((self.host, self.command_port))
+                self.platform_socket = socket.create_connection((self.host, self.platform_port))
+
+                # Each command is a single small write waiting on its response, which Nagle's algorithm would hold back
+                for connection in (self.command_socket, self.platform_socket):
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                self.power_on()
+                self.flush_transient()
+            except:
+                self.close()
+                raise
+
+    # Close the connection (e.g. before the simulator is stopped), ending the simulator's session politely if it is still there
+    def close(self):
+        with self.lock:
+            for connection in (self.command_socket, self.platform_socket):
+                if connection is None:
+                    continue
+
+                try:
+                    connection.sendall(u32(TPM_SESSION_END))
+                except OSError:
+                    pass
+                connection.close()
+
+            self.command_socket = None
+            self.platform_socket = None
+
+    def receive(self, connection, length):
+        data = bytearray()
+        while len(data) < length:
+            received = connection.recv(length - len(data))
+            if not received:
+                raise ConnectionError("the TPM simulator closed the connection")
+            data += received
+
+            # The simulator writes each response in several small pieces, and (with Nagle's algorithm) only sends the next
+            # once the last has been acknowledged, so acknowledgements are sent straight away rather than delayed by up to 40ms
+            # (the kernel clears the option again after a while, so it is set after every read)
+            if hasattr(socket, "TCP_QUICKACK"):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+        return bytes(data)
+
+    # Send a signal to the simulator's platform port, which acknowledges it with a zero
+    def platform_command(self, command):
+        self.platform_socket.sendall(u32(command))
+        if struct.unpack(">I", self.receive(self.platform_socket, 4))[0] != 0:
+            raise ConnectionError(f"the TPM simulator refused platform command {command}")
+
+    # Send a command to the TPM and return its response code and the response after the header
+    # (connecting under the same lock, so another thread cannot close the connection between connecting and sending)
+    def transmit(self, command):
+        with self.lock:
+            self.connect()
+
+            self.last_used = time.monotonic()
+            try:
+                self.command_socket.sendall(u32(TPM_SEND_COMMAND) + u8(0) + u32(len(command)) + command)
+                length = struct.unpack(">I", self.receive(self.command_socket, 4))[0]
+                response = self.receive(self.command_socket, length)
+
+                # Each response is followed by a zero acknowledgement
+                self.receive(self.command_socket, 4)
+            except OSError:
+                # The connection is no use after a partial exchange, the next command opens a new one
+                self.close()
+                raise
+
+        tag, size, response_code = struct.unpack_from(">HII", response)
+        return response_code, response[10:]
+
+    # Run a command, returning a reader positioned at its response parameters, and its response handles
+    # sessions is a list of (session handle, attributes, hmac) for the handles that need authorization
+    # (TPM_RS_PW with an empty password for the owner hierarchy and the objects created here, which have none)
+    def command(self, command_code, handles=(), parameters=b"", sessions=(), response_handles=0, allowed=(TPM_RC_SUCCESS,)):
+        body = b"".join(u32(handle) for handle in handles)
+        if sessions:
+            auth = b"".join(u32(handle) + tpm2b() + u8(attributes) + tpm2b(hmac) for handle, attributes, hmac in sessions)
+            body += u32(len(auth)) + auth
+        body += parameters
+
+        tag = TPM_ST_SESSIONS if sessions else TPM_ST_NO_SESSIONS
+        response_code, response = self.transmit(u16(tag) + u32(10 + len(body)) + u32(command_code) + body)
+        if response_code not in allowed:
+            raise TPMError(command_code, response_code)
+
+        reader = ResponseReader(response)
+        if response_code != TPM_RC_SUCCESS:
+            return reader, []
+
+        handles = [reader.u32() for i in range(response_handles)]
+
+        # With sessions, the parameters are sized, and followed by the session responses
+        if sessions:
+            reader = ResponseReader(reader.read(reader.u32()))
+
+        return reader, handles
+
+    # The password session for an entity with an empty password
+    def password_session(self):
+        return [(TPM_RS_PW, 0, b"")]
+
+    def startup(self):
+        # The TPM is only started once per power cycle, after which it reports that it is already initialized
+        self.command(TPM_CC_STARTUP, parameters=u16(TPM_SU_CLEAR), allowed=(TPM_RC_SUCCESS, TPM_RC_INITIALIZE))
+
+    # An orderly shutdown, so the next startup does not count as a power loss (which the dictionary attack protection counts as a failure)
+    def shutdown(self):
+        self.command(TPM_CC_SHUTDOWN, parameters=u16(TPM_SU_CLEAR))
+
+    # Power the TPM off, after which the simulator has closed its NV file, until power_on
+    def power_off(self):
+        with self.lock:
+            self.connect()
+
+            self.shutdown()
+            self.platform_command(TPM_SIGNAL_NV_OFF)
+            self.platform_command(TPM_SIGNAL_POWER_OFF)
+
+    # Power the TPM back on, which makes the simulator load its NV file again, and start it
+    def power_on(self):
+        with self.lock:
+            self.platform_command(TPM_SIGNAL_POWER_ON)
+            self.platform_command(TPM_SIGNAL_NV_ON)
+            self.startup()
+
+    def flush_context(self, handle):
+        self.command(TPM_CC_FLUSH_CONTEXT, parameters=u32(handle))
+
+    # Flush every transient object (tpm2_flushcontext -t)
+    def flush_transient(self):
+        reader, handles = self.command(TPM_CC_GET_CAPABILITY, parameters=u32(TPM_CAP_HANDLES) + u32(TRANSIENT_FIRST) + u32(64))
+        more_data, capability = reader.u8(), reader.u32()
+
+        for i in range(reader.u32()):
+            self.flush_context(reader.u32())
+
+    def get_random(self, length):
+        reader, handles = self.command(TPM_CC_GET_RANDOM, parameters=u16(length))
+        return reader.tpm2b()
+
+    def pcr_extend(self, pcr, digest):
+        self.command(TPM_CC_PCR_EXTEND, [pcr], u32(1) + u16(TPM_ALG_SHA256) + digest, self.password_session())
+
+    def pcr_reset(self, pcr):
+        self.command(TPM_CC_PCR_RESET, [pcr], sessions=self.password_session())
+
+    # Start an unbound, unsalted policy session, returning its handle
+    def start_auth_session(self, session_type):
+        parameters = tpm2b(os.urandom(SHA256_SIZE)) + tpm2b() + u8(session_type) + u16(TPM_ALG_NULL) + u16(TPM_ALG_SHA256)
+        reader, handles = self.command(TPM_CC_START_AUTH_SESSION, [TPM_RH_NULL, TPM_RH_NULL], parameters, response_handles=1)
+        return handles[0]
+
+    # Bind the session's policy to the current value of a PCR
+    def policy_pcr(self, session, pcr):
+        self.command(TPM_CC_POLICY_PCR, [session], tpm2b() + pcr_selection(pcr))
+
+    # Bind the session's policy to a signature from auth_object (a TPMT_SIGNATURE, as returned by sign)
+    # with no nonce, expiration or cpHash, the signature is over the digest of an expiration of zero
+    def policy_signed(self, session, auth_object, signature):
+        self.command(TPM_CC_POLICY_SIGNED, [auth_object, session], tpm2b() + tpm2b() + tpm2b() + u32(0) + signature)
+
+    # Create a primary key in the owner hierarchy, returning its (transient) handle
+    def create_primary(self, template):
+        parameters = tpm2b(u16(0) + u16(0)) + tpm2b(template) + tpm2b() + pcr_selection()
+        reader, handles = self.command(TPM_CC_CREATE_PRIMARY, [TPM_RH_OWNER], parameters, self.password_session(), response_handles=1)
+        return handles[0]
+
+    # Create an object under a parent key, with data to seal in it if given
+    # returns its private and public parts (the key blobs of tpm2_create), which must be loaded before it is used
+    def create(self, parent, template, data=b""):
+        parameters = tpm2b(tpm2b() + tpm2b(data)) + tpm2b(template) + tpm2b() + pcr_selection()
+        reader, handles = self.command(TPM_CC_CREATE, [parent], parameters, self.password_session())
+        return reader.tpm2b(), reader.tpm2b()
+
+    def load(self, parent, private, public):
+        reader, handles = self.command(TPM_CC_LOAD, [parent], tpm2b(private) + tpm2b(public), self.password_session(), response_handles=1)
+        return handles[0]
+
+    # The public area (a TPMT_PUBLIC) of a loaded or persistent object
+    def read_public(self, handle):
+        reader, handles = self.command(TPM_CC_READ_PUBLIC, [handle])
+        return reader.tpm2b()
+
+    # Make a transient object persistent at persistent_handle, or evict a persistent object (when both handles are the same)
+    def evict_control(self, handle, persistent_handle):
+        self.command(TPM_CC_EVICT_CONTROL, [TPM_RH_OWNER, handle], u32(persistent_handle), self.password_session())
+
+    # Unseal the data in a sealed object, authorized by a policy session (which is closed by the command)
+    def unseal(self, handle, session):
+        reader, handles = self.command(TPM_CC_UNSEAL, [handle], sessions=[(session, 0, b"")])
+        return reader.tpm2b()
+
+    # Sign a sha256 digest with RSASSA, returning the TPMT_SIGNATURE (the signature file of tpm2_sign)
+    def sign(self, handle, digest):
+        validation = u16(TPM_ST_HASHCHECK) + u32(TPM_RH_NULL) + tpm2b()
+        reader, handles = self.command(TPM_CC_SIGN, [handle], tpm2b(digest) + u16(TPM_ALG_RSASSA) + u16(TPM_ALG_SHA256) + validation, self.password_session())
+        return reader.rest()
+
+    # Whether a TPMT_SIGNATURE is a valid signature of a sha256 digest
+    def verify_signature(self, handle, digest, signature):
+        try:
+            self.command(TPM_CC_VERIFY_SIGNATURE, [handle], tpm2b(digest) + signature)
+        except TPMError:
+            return False
+
+        return True
+
+    def rsa_encrypt(self, handle, message):
+        reader, handles = self.command(TPM_CC_RSA_ENCRYPT, [handle], tpm2b(message) + u16(TPM_ALG_RSAES) + tpm2b())
+        return reader.tpm2b()
+
+    def rsa_decrypt(self, handle, ciphertext):
+        reader, handles = self.command(TPM_CC_RSA_DECRYPT, [handle], tpm2b(ciphertext) + u16(TPM_ALG_RSAES) + tpm2b(), self.password_session())
+        return reader.tpm2b()
+
+    # Reset the dictionary attack counter, so that failed authorizations do not lock the TPM out
+    def dictionary_attack_lock_reset(self):
+        self.command(TPM_CC_DICTIONARY_ATTACK_LOCK_RESET, [TPM_RH_LOCKOUT], sessions=self.password_session())
+
+    # Remove every object from the owner hierarchy (tpm2_clear)
+    def clear(self):
+        self.command(TPM_CC_CLEAR, [TPM_RH_LOCKOUT], sessions=self.password_session())
@@ -24,9 +24,14 @@ class Fingerprint:
         # Close the connection
         self.phy.close()
 
-    def enroll(self, display):
+    # Enroll the fingerprint of a user, saved with their user number as its id
+    # wipe removes every other saved fingerprint (only when the device is reset)
+    def enroll(self, display, template_id=0, wipe=False):
         # Remove any old saved fingerprints
-        self.bep_interface.template_remove_all_flash()
+        if wipe:
+            self.bep_interface.template_remove_all_flash()
+        else:
+            self.remove(template_id)
 
         # Enroll the fingerprint
         self.bep_interface.enroll_start()
@@ -39,11 +44,16 @@ class Fingerprint:
 
         self.bep_interface.enroll_finish()
 
-        # Save the fingerprint as id 0
-        self.bep_interface.template_save(0)
+        # Save the fingerprint with the user's id
+        self.bep_interface.template_save(template_id)
 
         self.bep_interface.template_remove_ram()
 
+    # Remove the saved fingerprint with this id, if there is one (e.g. of a revoked user)
+    def remove(self, template_id):
+        if template_id in self.bep_interface.template_get_ids():
+            self.bep_interface.template_remove_flash(template_id)
+
     def identify(self):
         # Capture and identify the fingerprint
         self.bep_interface.capture()
@@ -35,9 +35,6 @@ class ComSecure(fingerprint.bep.communication.Com):
 
         # Only encrypt communications if configuration flag is set
         if config.SECURE_FINGERPRINT_COMMS:
-            encryption.Encryption.create_temporary_file("data", data)
-            encryption.Encryption.create_temporary_file("signature", data_sig)
-
             # Asymmetrically encrypt the data and signature using the RECEIVER'S PUBLIC KEY
             data_encrypted = encryption.Encryption.asymm_encrypt_data(receivers_key_address, data)
             data_sig_encrypted = encryption.Encryption.encrypt_signature(receivers_key_address, data_sig)
@@ -55,10 +52,10 @@ class ComSecure(fingerprint.bep.communication.Com):
             data_sig = encryption.Encryption.decrypt_signature(receivers_key_address, data_sig_encrypted)
 
             # Check the signature against the SENDER'S PUBLIC KEY
-            stdout = encryption.Encryption.verify_signature(senders_key_address, data, data_sig)
+            valid = encryption.Encryption.verify_signature(senders_key_address, data, data_sig)
 
             # If the signature is invalid do not run the command
-            if b"Verify signature failed" in stdout:
+            if not valid:
                 print("damn....")
                 return None
 
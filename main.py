@@ -18,6 +18,11 @@ class Main:
             "Mount": self.mount,
             "Eject": self.eject,
             "Reset": self.reset,
+            "Add user": self.add_user,
+            "Remove user": self.remove_user,
+            "Rotate key": self.rotate_key,
+            "Save image": self.save_image,
+            "Restore image": self.restore_image,
             "Poweroff": self.poweroff
         }
 
@@ -28,7 +33,9 @@ class Main:
         # logs are not shown because it will display error messages, during normal functionality
         # (ie. it will attempt to delete files that already exist)
         storage.remove_usb_gadget(False)
-        storage.delete_fs_image(False)
+        storage.stop_nbd(False)
+        for drive in encryption.Encryption.drives:
+            storage.delete_fs_image(drive.image_path, False)
         storage.unmount_tmpfs(False)
         
         # Runs the "stop" function when the program closes (e.g. if user presses ctrl+c)
@@ -36,6 +43,9 @@ class Main:
 
         self.tpm = encryption.TPM()
         self.tpm.restart()
+
+        # RSA keys are generated in the background while the TPM is idle, ready for the next reset
+        encryption.Encryption.start_key_pool()
         
         self.fingerprint = fingerprint.Fingerprint()
 
@@ -53,13 +63,24 @@ class Main:
 
     # Safely stop running processes and clean up temporary data
     def stop(self):
+        encryption.Encryption.stop_checkpoints()
+        encryption.Encryption.stop_rotations()
+        # Zeroize the drive keys if they are still cached
+        encryption.Encryption.clear_keys()
+        encryption.Encryption.stop_prefetch()
+
         storage.remove_usb_gadget(False)
-        storage.delete_fs_image(False)
+        storage.stop_nbd(False)
+        encryption.Encryption.close_drives()
+        for drive in encryption.Encryption.drives:
+            storage.delete_fs_image(drive.image_path, False)
         storage.unmount_tmpfs(False)
 
         if config.GUI:
             self.display.stop()
 
+        encryption.Encryption.stop_key_pool()
+        encryption.Encryption.stop_workers()
         self.tpm.stop()
 
     def reset_auth_details(self):
@@ -115,46 +136,84 @@ class Main:
             self.display.draw_message("Already mounted!")
             print("# Already mounted!")
         else:
+            # Start reading the encrypted images from the SD card while the user is still authenticating
+            encryption.Encryption.start_prefetch()
+
             storage.mount_tmpfs()
 
-            # Authorize and decrypt the drive
+            # Authorize and decrypt every drive the user is authorized for
             self.authorize("Decrypting...", encryption.Encryption.decrypt)
+            encryption.Encryption.stop_prefetch()
 
             if config.AUTH_ON_EJECT:
                 # Clear the authentication variables
                 self.reset_auth_details()
 
-            # Unmounts help drive if required
-            storage.remove_usb_gadget(False)
-
-            # The new USB gadget files are then created
-            storage.create_usb_gadget()
-
+            self.attach_drives()
             self.mounted = True
 
             self.display.draw_message("Drive mounted!")
             print("# Drive mounted!")
         time.sleep(1)
 
+    # Give the mounted drives to the host, each as a LUN of the USB gadget (in place of the help drive)
+    def attach_drives(self):
+        for drive in encryption.Encryption.mounted_drives:
+            if drive.lazy_image is not None:
+                # The drive is decrypted as the host reads it, through an nbd device
+                storage.start_nbd(drive.lazy_image, drive.nbd_device)
+        storage.set_usb_gadget_files([drive.gadget_file() for drive in encryption.Encryption.mounted_drives])
+
+        # Changes are encrypted back to the SD card in the background while the drive is mounted
+        encryption.Encryption.start_checkpoints()
+
+        # A key rotation interrupted by the last eject carries on where it stopped
+        encryption.Encryption.resume_rotations()
+
     # Eject the storage drive from the host computer
     def eject(self):
         if not self.mounted:
             self.display.draw_message("Not mounted!")
             print("# Not mounted!")
         else:
+            # Eject encrypts whatever the last checkpoint had not, then finishes any key rotation that has re-encrypted every chunk
+            encryption.Encryption.stop_checkpoints()
+            encryption.Encryption.stop_rotations()
+
+            lazy = any(drive.lazy_image is not None for drive in encryption.Encryption.mounted_drives)
+            if lazy:
+                # Lazily mounted drives are detached before they are encrypted, so every write the host made has reached the image
+                storage.set_usb_gadget_files([])
+                storage.stop_nbd()
+
             if config.AUTH_ON_EJECT:
-                # Authorize and encrypt the drive
+                # Authorize and encrypt the drives
                 self.authorize("Encrypting...", encryption.Encryption.encrypt)
             else:
-                # Encrypt the drive using authorization values used to mount it
+                # Encrypt the drives using the keys cached when they were mounted
+                # (falling back to the authorization values used to mount them if a cache has timed out)
                 self.display.draw_message("Encrypting...")
-                encryption.Encryption.encrypt(self.rfid_passcode, self.fingerprint_message, self.fingerprint_message_signature)
+                if not encryption.Encryption.encrypt(self.rfid_passcode, self.fingerprint_message, self.fingerprint_message_signature, True):
+                    # The plaintext is kept (e.g. if the SD card is full), so nothing the host wrote is lost and eject can be tried again
+                    # lazily mounted drives were detached to be encrypted, so they are given back to the host
+                    if lazy:
+                        self.attach_drives()
+                    else:
+                        encryption.Encryption.start_checkpoints()
+                        encryption.Encryption.resume_rotations()
+                    self.display.draw_message("Encrypt failed!\nStill mounted")
+                    print("# Encrypt failed, the drive is still mounted")
+                    time.sleep(1)
+                    return
 
-            # Clear the authentication variables
+            # Clear the authentication variables and the cached keys
             self.reset_auth_details()
+            encryption.Encryption.clear_keys()
+            encryption.Encryption.close_drives()
 
-            # The new USB gadget files are deleted
-            storage.remove_usb_gadget()
+            # The drives are ejected from the host (the gadget itself is kept for the next mount)
+            if not lazy:
+                storage.set_usb_gadget_files([])
             
             storage.unmount_tmpfs()
 
@@ -164,6 +223,125 @@ class Main:
             print("# Drive ejected!")
         time.sleep(1)
 
+    # Enroll another user for every drive, authorized by an existing user
+    # (the new user's key only wraps the data keys of the drives, so nothing is re-encrypted)
+    def add_user(self):
+        if self.mounted:
+            self.display.draw_message("Eject first!")
+            print("# Eject first!")
+        elif encryption.Encryption.free_user_addr() is None:
+            self.display.draw_message("No room for\nmore users")
+            print("# No room for more users")
+        else:
+            storage.mount_tmpfs()
+
+            # The unlocked data keys are forgotten however enrolling ends
+            try:
+                # An existing user unlocks the drives
+                self.authorize("Unlocking...", encryption.Encryption.unlock_for_enroll)
+
+                # (giving drives set up before keyrings a keyring may have used the last free address)
+                user_addr = encryption.Encryption.free_user_addr()
+                if user_addr is None:
+                    self.display.draw_message("No room for\nmore users")
+                    print("# No room for more users")
+                    time.sleep(1)
+                    return
+
+                # Then the new user gets a card and enrolls their fingerprint
+                self.display.draw_message("Tap new card")
+                rfid.reset_card_passcode()
+                self.display.draw_message("Card reset")
+                time.sleep(1)
+
+                self.fingerprint.enroll(self.display, encryption.Encryption.user_number(user_addr))
+                self.display.draw_message("Enrollment\ncomplete")
+                time.sleep(1)
+
+                self.authorize("Adding user...", encryption.Encryption.enroll_user)
+            finally:
+                encryption.Encryption.clear_enroll_keys()
+                self.reset_auth_details()
+                storage.unmount_tmpfs()
+
+            self.display.draw_message("User added!")
+            print("# User added!")
+        time.sleep(1)
+
+    # Revoke the user who authorizes this from every drive
+    def remove_user(self):
+        if self.mounted:
+            self.display.draw_message("Eject first!")
+            print("# Eject first!")
+        else:
+            storage.mount_tmpfs()
+
+            # The revoked user's saved fingerprint is removed too, so their id can be given to a new user
+            self.authorize("Removing user...", lambda *auth: encryption.Encryption.revoke_user(*auth, self.fingerprint.remove))
+            self.reset_auth_details()
+
+            storage.unmount_tmpfs()
+
+            self.display.draw_message("User removed!")
+            print("# User removed!")
+        time.sleep(1)
+
+    # Rotate the data keys of the mounted drives, re-encrypting them in the background while they stay mounted
+    # once started, this shows how far the rotation has got (it is finished on eject)
+    def rotate_key(self):
+        if not self.mounted:
+            self.display.draw_message("Mount first!")
+            print("# Mount first!")
+        elif encryption.Encryption.rotation_progress():
+            percent = min(encryption.Encryption.rotation_progress().values())
+            self.display.draw_message(f"Rotating key\n{percent}% done")
+            print(f"# Rotating key, {percent}% done")
+        else:
+            self.authorize("Rotating key...", encryption.Encryption.rotate_key)
+            if config.AUTH_ON_EJECT:
+                self.reset_auth_details()
+
+            self.display.draw_message("Key rotation\nstarted")
+            print("# Key rotation started")
+        time.sleep(1)
+
+    # Save the encrypted image of every drive in the chunk store, to be restored later
+    def save_image(self):
+        if self.mounted:
+            self.display.draw_message("Eject first!")
+            print("# Eject first!")
+        else:
+            self.authorize("Saving...", encryption.Encryption.save_images)
+            self.reset_auth_details()
+
+            if encryption.Encryption.failed_drives:
+                self.display.draw_message("Save failed:\n" + "\n".join(encryption.Encryption.failed_drives))
+                print(f"# Could not save the images of {', '.join(encryption.Encryption.failed_drives)}")
+            else:
+                self.display.draw_message("Image saved!")
+                print("# Image saved!")
+        time.sleep(1)
+
+    # Put back the newest saved image of every drive that has one
+    def restore_image(self):
+        if self.mounted:
+            self.display.draw_message("Eject first!")
+            print("# Eject first!")
+        elif not any(encryption.Encryption.saved_images(drive) for drive in encryption.Encryption.drives):
+            self.display.draw_message("No saved image")
+            print("# No saved image")
+        else:
+            self.authorize("Restoring...", encryption.Encryption.restore_images)
+            self.reset_auth_details()
+
+            if encryption.Encryption.failed_drives:
+                self.display.draw_message("Restore failed:\n" + "\n".join(encryption.Encryption.failed_drives))
+                print(f"# Could not restore the images of {', '.join(encryption.Encryption.failed_drives)}")
+            else:
+                self.display.draw_message("Image restored!")
+                print("# Image restored!")
+        time.sleep(1)
+
     # Power off the device safely
     def poweroff(self):
         self.stop()
@@ -180,39 +358,49 @@ class Main:
 
         # Remove any existing USB drives before resetting (this forces the host to eject)
         storage.remove_usb_gadget(False)
+        encryption.Encryption.stop_checkpoints()
+        encryption.Encryption.stop_rotations()
+        storage.stop_nbd(False)
+        encryption.Encryption.close_drives()
         
         self.mounted = False
+
+        # The keys of the drives being replaced are no longer needed
+        encryption.Encryption.clear_keys()
         
-        # Reset the TPM to blank
+        # Reset the TPM to blank, with new keys for communicating with the fingerprint sensor
+        # (the key pool is paused, as the TPM is restarted or powered off while it is reset)
+        encryption.Encryption.stop_key_pool()
         self.tpm.reset()
-
-        # Generate encrytion keys for communicating with fingerprint sensor
-        encryption.Encryption.generate_fingerprint_communication_keys()
-
-        storage.mount_tmpfs()
-
-        # Create a new file system image
-        storage.create_fs_image()
+        encryption.Encryption.start_key_pool()
 
         self.display.draw_message("Tap card")
         rfid.reset_card_passcode()
         self.display.draw_message("Card reset")
         time.sleep(1)
 
-        # Enroll the new fingerprint
-        self.fingerprint.enroll(self.display)
+        # Enroll the new fingerprint, removing every other saved fingerprint
+        self.fingerprint.enroll(self.display, wipe=True)
         self.display.draw_message("Enrollment\ncomplete")
         time.sleep(1)
 
-        # Authorize and decrypt the drive
-        self.authorize("Generating key\n and encrypting...", encryption.Encryption.encrypt_new)
+        storage.mount_tmpfs()
+
+        # Create a new (sparse) file system image for each drive
+        for drive in encryption.Encryption.drives:
+            storage.create_fs_image(drive.image_path)
+
+        # Authorize, then generate a key for each drive and create its image under it
+        # (only the chunks of the file system image holding metadata are encrypted, the rest of the image is holes)
+        self.authorize("Generating key\n and creating...", encryption.Encryption.encrypt_new)
 
         if config.AUTH_ON_EJECT:
             # Clear the authentication variables
             self.reset_auth_details()
 
-        # Delete the plaintext file system image
-        storage.delete_fs_image()
+        # Delete the plaintext file system images
+        for drive in encryption.Encryption.drives:
+            storage.delete_fs_image(drive.image_path)
 
         self.display.draw_message("Reset complete!")
         print("# Reset complete!")
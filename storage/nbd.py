@@ -0,0 +1,231 @@
+import os
+import socket
+import struct
+import threading
+
+# Network block device protocol (fixed newstyle handshake), as spoken by nbd-client and the kernel nbd driver
+# see https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
+NBD_MAGIC = b"NBDMAGIC"
+IHAVEOPT = 0x49484156454F5054
+OPTION_REPLY_MAGIC = 0x3E889045565A9
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY_MAGIC = 0x67446698
+
+# Handshake flags (sent by the server) and client flags
+FLAG_FIXED_NEWSTYLE = 1 << 0
+FLAG_NO_ZEROES = 1 << 1
+
+# Transmission flags
+FLAG_HAS_FLAGS = 1 << 0
+FLAG_SEND_FLUSH = 1 << 2
+FLAG_SEND_FUA = 1 << 3
+CMD_FLAG_FUA = 1 << 0
+
+# Options
+OPT_EXPORT_NAME = 1
+OPT_ABORT = 2
+OPT_INFO = 6
+OPT_GO = 7
+
+# Option replies
+REP_ACK = 1
+REP_INFO = 3
+REP_ERR_UNSUP = (1 << 31) + 1
+INFO_EXPORT = 0
+
+# Commands
+CMD_READ = 0
+CMD_WRITE = 1
+CMD_DISC = 2
+CMD_FLUSH = 3
+
+# Errors returned for failed commands (these are the usual errno values)
+EIO = 5
+EINVAL = 22
+
+REQUEST_FORMAT = ">IHHQQI"
+REQUEST_SIZE = struct.calcsize(REQUEST_FORMAT)
+
+# Read exactly length bytes from a socket, raising ConnectionError if it closes first
+def receive_exact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        received = sock.recv(length - len(data))
+        if not received:
+            raise ConnectionError("connection closed")
+        data += received
+
+    return bytes(data)
+
+# Serves a block device backend over NBD on a Unix socket, so the kernel can attach it as /dev/nbdX
+# the backend has a size, and read(offset, length), write(offset, data) and flush() methods
+class NbdServer:
+    def __init__(self, backend, socket_path):
+        self.backend = backend
+        self.socket_path = socket_path
+        self.listener = None
+        self.connection = None
+        self.thread = None
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(1)
+
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Closing the sockets wakes the server thread up, so it can exit
+        for sock in (self.listener, self.connection):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    # Serve one client at a time until the server is stopped
+    def serve(self):
+        while True:
+            try:
+                self.connection, address = self.listener.accept()
+            except OSError:
+                return
+
+            try:
+                if self.handshake(self.connection):
+                    self.transmission(self.connection)
+            except (ConnectionError, OSError) as e:
+                print(f"# NBD connection closed ({e})")
+            finally:
+                self.connection.close()
+                self.connection = None
+
+    # Negotiate the export, returning True once the client is ready to send commands
+    def handshake(self, sock):
+        sock.sendall(NBD_MAGIC + struct.pack(">QH", IHAVEOPT, FLAG_FIXED_NEWSTYLE | FLAG_NO_ZEROES))
+        client_flags = struct.unpack(">I", receive_exact(sock, 4))[0]
+
+        transmission_flags = FLAG_HAS_FLAGS | FLAG_SEND_FLUSH | FLAG_SEND_FUA
+
+        while True:
+            magic, option, length = struct.unpack(">QII", receive_exact(sock, 16))
+            if magic != IHAVEOPT:
+                raise ConnectionError("bad option magic")
+            data = receive_exact(sock, length)
+
+            if option == OPT_EXPORT_NAME:
+                # There is only one export, so the name is ignored
+                reply = struct.pack(">QH", self.backend.size, transmission_flags)
+                if not client_flags & FLAG_NO_ZEROES:
+                    reply += bytes(124)
+                sock.sendall(reply)
+                return True
+            elif option == OPT_INFO or option == OPT_GO:
+                self.send_option_reply(sock, option, REP_INFO, struct.pack(">HQH", INFO_EXPORT, self.backend.size, transmission_flags))
+                self.send_option_reply(sock, option, REP_ACK)
+                if option == OPT_GO:
+                    return True
+            elif option == OPT_ABORT:
+                self.send_option_reply(sock, option, REP_ACK)
+                return False
+            else:
+                self.send_option_reply(sock, option, REP_ERR_UNSUP)
+
+    def send_option_reply(self, sock, option, reply_type, data=b""):
+        sock.sendall(struct.pack(">QIII", OPTION_REPLY_MAGIC, option, reply_type, len(data)) + data)
+
+    # Handle commands until the client disconnects
+    def transmission(self, sock):
+        while True:
+            magic, flags, command, handle, offset, length = struct.unpack(REQUEST_FORMAT, receive_exact(sock, REQUEST_SIZE))
+            if magic != REQUEST_MAGIC:
+                raise ConnectionError("bad request magic")
+
+            data = receive_exact(sock, length) if command == CMD_WRITE else None
+
+            if command == CMD_DISC:
+                return
+
+            error = 0
+            reply_data = b""
+            try:
+                if command in (CMD_READ, CMD_WRITE) and offset + length > self.backend.size:
+                    error = EINVAL
+                elif command == CMD_READ:
+                    reply_data = self.backend.read(offset, length)
+                elif command == CMD_WRITE:
+                    self.backend.write(offset, data)
+                    if flags & CMD_FLAG_FUA:
+                        self.backend.flush()
+                elif command == CMD_FLUSH:
+                    self.backend.flush()
+                else:
+                    error = EINVAL
+            except (OSError, ValueError) as e:
+                print(f"# NBD command {command} at {offset} failed ({e})")
+                error = EIO
+                reply_data = b""
+
+            sock.sendall(struct.pack(">IIQ", SIMPLE_REPLY_MAGIC, error, handle) + reply_data)
+
+# A minimal NBD client, which can stand in for the kernel (e.g. to check a server without attaching /dev/nbdX)
+class NbdClient:
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.handle = 0
+
+        magic, option_magic, handshake_flags = struct.unpack(">8sQH", receive_exact(self.sock, 18))
+        if magic != NBD_MAGIC or option_magic != IHAVEOPT:
+            raise ConnectionError("not an NBD server")
+        self.sock.sendall(struct.pack(">I", FLAG_FIXED_NEWSTYLE | FLAG_NO_ZEROES))
+
+        # Ask for the default export
+        self.sock.sendall(struct.pack(">QIIIH", IHAVEOPT, OPT_GO, 6, 0, 0))
+        while True:
+            magic, option, reply_type, length = struct.unpack(">QIII", receive_exact(self.sock, 20))
+            data = receive_exact(self.sock, length)
+
+            if reply_type == REP_INFO:
+                info_type, self.size, self.flags = struct.unpack(">HQH", data)
+            elif reply_type == REP_ACK:
+                break
+            else:
+                raise ConnectionError(f"export refused ({reply_type})")
+
+    def request(self, command, offset=0, length=0, data=b"", flags=0):
+        self.handle += 1
+        self.sock.sendall(struct.pack(REQUEST_FORMAT, REQUEST_MAGIC, flags, command, self.handle, offset, length) + data)
+
+        magic, error, handle = struct.unpack(">IIQ", receive_exact(self.sock, 16))
+        if magic != SIMPLE_REPLY_MAGIC or handle != self.handle:
+            raise ConnectionError("bad reply")
+        if error != 0:
+            raise OSError(error, os.strerror(error))
+
+        return receive_exact(self.sock, length) if command == CMD_READ else b""
+
+    def read(self, offset, length):
+        return self.request(CMD_READ, offset, length)
+
+    def write(self, offset, data, fua=False):
+        self.request(CMD_WRITE, offset, len(data), data, CMD_FLAG_FUA if fua else 0)
+
+    def flush(self):
+        self.request(CMD_FLUSH)
+
+    def disconnect(self):
+        self.sock.sendall(struct.pack(REQUEST_FORMAT, REQUEST_MAGIC, 0, CMD_DISC, 0, 0, 0))
+        self.sock.close()
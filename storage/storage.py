@@ -1,24 +1,36 @@
+import os
+
 import utils
 import encryption
+import config
+from storage.nbd import NbdServer
+
+# Unix socket that the nbd server of a device listens on while its drive is mounted lazily
+def nbd_socket_path(device):
+    return f"./storage/{os.path.basename(device)}.sock"
+
+# The server for each lazily mounted drive, by nbd device
+nbd_servers = {}
 
-# Creates an image file containing the file system of the specified size
-# Max size 1024M (defined below as ramdisk size)
-def create_fs_image(block_size="1M", count="64", show_log=True):
+# Creates a sparse image file formatted as exFAT, of the given size, for the drive whose plaintext is at image_path
+# only the filesystem's metadata is written, so it takes little of the ramdisk however large the drive is
+# (the drive is then created from it, see encryption.Drive.create, and it is deleted)
+def create_fs_image(image_path, size=config.DRIVE_SIZE, show_log=True):
     print("# STARTED create fs image")
-    stdout = utils.execute_command(["./storage/scripts/create_fs_image", block_size, count], show_log)
+    stdout = utils.execute_command(["./storage/scripts/create_fs_image", "1", str(size), image_path], show_log)
     print("# FINISHED create fs image")
 
-# Delete the file system image (used during reset)
-def delete_fs_image(show_log=True):
-    stdout = utils.execute_command(["./storage/scripts/delete_fs_image"], show_log)
+# Delete the plaintext file system image of a drive (used during reset)
+def delete_fs_image(image_path, show_log=True):
+    stdout = utils.execute_command(["./storage/scripts/delete_fs_image", image_path], show_log)
     print("# Deleted fs image")
 
 # Create a temporary ramdisk for storing the file system while it is mounted
-# Size of 1024M (limited by onboard RAM size, otherwise may rely on insecure swap files)
+# Size of config.RAMDISK_SIZE (limited by onboard RAM size, otherwise may rely on insecure swap files)
 def mount_tmpfs(show_log=True):
-    remove_usb_gadget(False)
+    set_usb_gadget_files([], False)
     unmount_tmpfs(False)
-    stdout = utils.execute_command(["./storage/scripts/mount_tpmfs","1024M"], show_log)
+    stdout = utils.execute_command(["./storage/scripts/mount_tpmfs", config.RAMDISK_SIZE], show_log)
     print("# Mounted tmpfs")
 
 # Delete the ramdisk
@@ -26,15 +38,63 @@ def unmount_tmpfs(show_log=True):
     stdout = utils.execute_command(["./storage/scripts/unmount_tpmfs"], show_log)
     print("# Unmounted tmpfs")
 
-# Create a linux kernel gadget for a USB storage device in the /sys/ folder
-def create_usb_gadget(show_log=True):
-    stdout  = utils.execute_command(["./storage/scripts/create_usb_gadget","/home/pi/piusb/storage/ramdisk/fs.img"], show_log)
-    print("# Created USB gadget for storage drive")
+# Serve a block device backend (e.g. an encryption.LazyImage) through a kernel nbd device
+# so that it can be used as the file of a LUN of the USB gadget
+def start_nbd(backend, device, show_log=True):
+    server = NbdServer(backend, nbd_socket_path(device))
+    server.start()
+    nbd_servers[device] = server
+
+    stdout = utils.execute_command(["./storage/scripts/attach_nbd", nbd_socket_path(device), device], show_log)
+    print(f"# Attached nbd device {device}")
+
+# Whether an nbd device is attached to a server (the kernel only has a pid for a device while it is connected)
+# which may be one left attached by an earlier run of the program that crashed
+def nbd_attached(device):
+    return os.path.exists(f"/sys/block/{os.path.basename(device)}/pid")
+
+# Detach the nbd devices that are attached, and stop their servers
+# the kernel flushes the writes it is still holding for a device before it disconnects
+def stop_nbd(show_log=True):
+    for drive in encryption.Encryption.drives:
+        server = nbd_servers.pop(drive.nbd_device, None)
+        if server is None and not nbd_attached(drive.nbd_device):
+            continue
+
+        stdout = utils.execute_command(["./storage/scripts/detach_nbd", drive.nbd_device], show_log)
+        if server is not None:
+            server.stop()
+        print(f"# Detached nbd device {drive.nbd_device}")
+
+# The mass storage function of the gadget, which only exists while the gadget does
+GADGET_FUNCTION_PATH = "/sys/kernel/config/usb_gadget/piusb/functions/mass_storage.usb0"
+
+# The files of every LUN of the gadget, one for each drive profile (LUNs cannot be added once the gadget is enabled)
+# the LUNs after the given files have no medium
+def gadget_luns(files):
+    return files + [""] * (max(len(config.DRIVE_PROFILES), 1) - len(files))
+
+# Create a linux kernel gadget for a USB storage device in the /sys/ folder, with a LUN for each file
+# each backed by the plaintext image of a drive in the ramdisk, or by its nbd device when it is mounted lazily
+def create_usb_gadget(files, show_log=True):
+    stdout  = utils.execute_command(["./storage/scripts/create_usb_gadget"] + gadget_luns(files), show_log)
+    print(f"# Created USB gadget for {len(files)} storage drives")
+
+# Replace the files backing the LUNs of the gadget (with no files, every drive is ejected from the host)
+# so mounting and ejecting drives only swaps the media of the gadget, rather than tearing it down and rebuilding it
+# the gadget is created if it does not exist yet
+def set_usb_gadget_files(files, show_log=True):
+    if not os.path.isdir(GADGET_FUNCTION_PATH):
+        if files:
+            create_usb_gadget(files, show_log)
+        return
+
+    stdout = utils.execute_command(["./storage/scripts/set_usb_gadget_files"] + gadget_luns(files), show_log)
+    print(f"# Set the USB gadget to {len(files)} storage drives")
 
 # Create a linux kernel gadget for a USB help drive device in the /sys/ folder
 def create_usb_gadget_help(show_log=True):
-    stdout  = utils.execute_command(["./storage/scripts/create_usb_gadget","/home/pi/piusb/storage/images/help.img"], show_log)
-    print("# Created USB gadget for help drive")
+    create_usb_gadget(["/home/pi/piusb/storage/images/help.img"], show_log)
 
 # Delete the linux kernel gadget for a USB storage device
 def remove_usb_gadget(show_log=True):
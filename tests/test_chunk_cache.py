@@ -0,0 +1,52 @@
+import os
+
+from encryption import image_format
+from encryption import keyring
+from encryption.chunk_cache import ChunkCache
+from encryption.engine import StreamEngine
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+
+def encrypted_image(tmp_path, aes_key, plaintext):
+    (tmp_path / "plain.img").write_bytes(plaintext)
+    StreamEngine(workers=1).encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+
+def decrypt(tmp_path, aes_key):
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    return (tmp_path / "out.img").read_bytes()
+
+def test_changes_are_written_back_on_eviction_and_close(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext = bytearray(os.urandom(CHUNK_SIZE * 3))
+    encrypted_image(tmp_path, aes_key, plaintext)
+
+    # The cache holds one chunk, so every request for another chunk evicts it
+    cache = ChunkCache(aes_key, str(tmp_path / "fs.img.encrypted"), CHUNK_SIZE)
+    assert cache.read(CHUNK_SIZE - 4, 8) == plaintext[CHUNK_SIZE - 4:CHUNK_SIZE + 4]
+
+    cache.write(10, b"first")
+    assert cache.read(CHUNK_SIZE * 2, 4) == plaintext[CHUNK_SIZE * 2:CHUNK_SIZE * 2 + 4]
+    assert cache.write_backs == 1
+    plaintext[10:15] = b"first"
+    assert decrypt(tmp_path, aes_key) == plaintext
+
+    # A write across a chunk boundary changes both chunks, and the one still cached is written back on close
+    cache.write(CHUNK_SIZE * 2 - 3, b"second")
+    assert cache.read(CHUNK_SIZE * 2 - 3, 6) == b"second"
+    cache.close()
+    plaintext[CHUNK_SIZE * 2 - 3:CHUNK_SIZE * 2 + 3] = b"second"
+    assert decrypt(tmp_path, aes_key) == plaintext
+
+# A chunk that is overwritten completely is not decrypted first
+def test_whole_chunk_write_is_not_read(tmp_path, monkeypatch):
+    aes_key = keyring.generate_data_key()
+    encrypted_image(tmp_path, aes_key, os.urandom(CHUNK_SIZE * 2))
+
+    cache = ChunkCache(aes_key, str(tmp_path / "fs.img.encrypted"), CHUNK_SIZE * 2)
+    monkeypatch.setattr(cache.image, "read_chunk", None)
+    changed = os.urandom(CHUNK_SIZE)
+    cache.write(CHUNK_SIZE, changed)
+    assert cache.read(CHUNK_SIZE, CHUNK_SIZE) == changed
+    cache.close()
+
+    assert decrypt(tmp_path, aes_key)[CHUNK_SIZE:] == changed
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from encryption import image_format
+from encryption import keyring
+from encryption.chunk_store import ChunkStore
+from encryption.engine import StreamEngine
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+
+def encrypt(tmp_path, aes_key, plaintext):
+    (tmp_path / "plain.img").write_bytes(plaintext)
+    StreamEngine(workers=1).encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+
+def decrypt(tmp_path, aes_key):
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    return (tmp_path / "out.img").read_bytes()
+
+def stored_chunks(store):
+    return sum(len(names) for directory, subdirectories, names in os.walk(store.objects_directory))
+
+def test_save_and_restore(tmp_path):
+    aes_key = keyring.generate_data_key()
+    store = ChunkStore(str(tmp_path / "chunks"))
+
+    # Two versions of the drive that share a chunk, with a hole that is not stored
+    first = os.urandom(CHUNK_SIZE) + bytes(CHUNK_SIZE) + os.urandom(CHUNK_SIZE)
+    second = first[:CHUNK_SIZE * 2] + os.urandom(CHUNK_SIZE)
+
+    encrypt(tmp_path, aes_key, first)
+    store.save_image(aes_key, str(tmp_path / "fs.img.encrypted"), "first")
+    encrypt(tmp_path, aes_key, second)
+    store.save_image(aes_key, str(tmp_path / "fs.img.encrypted"), "second")
+    assert store.list() == ["first", "second"]
+    assert stored_chunks(store) == 3
+
+    store.restore_image(aes_key, "first", str(tmp_path / "fs.img.encrypted"))
+    assert decrypt(tmp_path, aes_key) == first
+
+    with pytest.raises(ValueError):
+        store.restore_image(keyring.generate_data_key(), "second", str(tmp_path / "fs.img.encrypted"))
+
+# A saved image is never replaced, so saving twice under one name fails
+def test_save_does_not_overwrite(tmp_path):
+    aes_key = keyring.generate_data_key()
+    store = ChunkStore(str(tmp_path / "chunks"))
+    encrypt(tmp_path, aes_key, os.urandom(CHUNK_SIZE))
+
+    store.save_image(aes_key, str(tmp_path / "fs.img.encrypted"), "saved")
+    with pytest.raises(ValueError):
+        store.save_image(aes_key, str(tmp_path / "fs.img.encrypted"), "saved")
+
+def test_chunks_are_freed_once_unreferenced(tmp_path):
+    aes_key = keyring.generate_data_key()
+    store = ChunkStore(str(tmp_path / "chunks"))
+    plaintext = os.urandom(CHUNK_SIZE * 2)
+    encrypt(tmp_path, aes_key, plaintext)
+
+    store.save_image(aes_key, str(tmp_path / "fs.img.encrypted"), "saved")
+    store.copy_image("saved", "copy")
+    assert store.reference_counts().most_common(1)[0][1] == 2
+
+    store.delete_image("saved")
+    assert store.gc() == 0
+    assert stored_chunks(store) == 2
+
+    store.restore_image(aes_key, "copy", str(tmp_path / "fs.img.encrypted"))
+    assert decrypt(tmp_path, aes_key) == plaintext
+
+    store.delete_image("copy")
+    assert store.gc() > 0
+    assert stored_chunks(store) == 0
@@ -0,0 +1,245 @@
+import os
+
+import pytest
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from encryption import chunk_crypto
+from encryption import image_format
+from encryption import journal
+from encryption import keyring
+from encryption.engine import StreamEngine, derive_chunk_key, derive_legacy_key
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+
+# Chunks of random data, text that compresses, zeros (a hole) and a short last chunk
+def sample_plaintext():
+    text = b"the quick brown fox jumps over the lazy dog\n" * (CHUNK_SIZE // 44 + 1)
+    return os.urandom(CHUNK_SIZE) + text[:CHUNK_SIZE] + bytes(CHUNK_SIZE) + os.urandom(CHUNK_SIZE // 2)
+
+def read_table(path):
+    with open(path, "rb") as f:
+        return image_format.read_header_and_table(f)
+
+# The chunk workers are kept running between passes, so they are stopped once the tests are done with them
+@pytest.fixture(autouse=True)
+def stop_workers():
+    yield
+    chunk_crypto.shutdown_pools()
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "lzma"])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_round_trip(tmp_path, compression, workers):
+    aes_key = keyring.generate_data_key()
+    plaintext = sample_plaintext()
+    (tmp_path / "plain.img").write_bytes(plaintext)
+
+    engine = StreamEngine(workers=workers, compression=compression)
+    engine.encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+    engine.decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == plaintext
+
+    header, entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    assert image_format.is_chunked_image(str(tmp_path / "fs.img.encrypted"))
+    assert header.image_size == len(plaintext)
+    assert len(entries) == header.chunk_count == 4
+    assert [bool(entry.flags & image_format.CHUNK_HOLE) for entry in entries] == [False, False, True, False]
+
+    # Random data does not get smaller when it is compressed, but the text does, as does the short last chunk
+    # (which is padded to a whole chunk with zeros)
+    compressed = [bool(entry.flags & image_format.CHUNK_COMPRESSED) for entry in entries]
+    assert compressed == [False, compression != "none", False, compression != "none"]
+
+def test_wrong_key_fails(tmp_path):
+    (tmp_path / "plain.img").write_bytes(sample_plaintext())
+    StreamEngine(workers=1).encrypt_image(keyring.generate_data_key(), str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+
+    with pytest.raises(ValueError):
+        StreamEngine(workers=1).decrypt_image(keyring.generate_data_key(), str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+
+# Version 1 images keep the PBKDF2 derivation of the legacy format, newer ones derive the chunk key with one HKDF step
+def test_chunk_key_derivation():
+    aes_key = keyring.generate_data_key()
+
+    legacy_key, legacy_iv = derive_legacy_key(aes_key)
+    version_1 = derive_chunk_key(aes_key, image_format.Header(CHUNK_SIZE, version=1, cipher=image_format.CIPHER_AES_256_CBC))
+    assert version_1 == legacy_key
+
+    version_2 = derive_chunk_key(aes_key, image_format.Header(CHUNK_SIZE, cipher=image_format.CIPHER_AES_256_CBC))
+    assert len(version_2) == len(version_1) and version_2 != version_1
+
+# An image encrypted by openssl enc -aes-256-cbc -md sha512 -pbkdf2 -nosalt, as drives were before the chunked format
+def test_legacy_image(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext = sample_plaintext()
+
+    key, iv = derive_legacy_key(aes_key)
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    (tmp_path / "fs.img.encrypted").write_bytes(encryptor.update(padder.update(plaintext) + padder.finalize()) + encryptor.finalize())
+    assert not image_format.is_chunked_image(str(tmp_path / "fs.img.encrypted"))
+
+    StreamEngine(workers=1).decrypt_any_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == plaintext
+
+# Encrypt the test plaintext, then decrypt it again to record the digests of its chunks
+def encrypt_with_digests(tmp_path, aes_key):
+    plaintext = sample_plaintext()
+    (tmp_path / "plain.img").write_bytes(plaintext)
+
+    engine = StreamEngine(workers=1)
+    engine.encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+    digests = []
+    engine.decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "ramdisk.img"), digests)
+
+    return plaintext, digests
+
+def write_chunk(path, index, data):
+    with open(path, "r+b") as f:
+        f.seek(index * CHUNK_SIZE)
+        f.write(data)
+
+def test_update_rewrites_only_changed_chunks(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypt_with_digests(tmp_path, aes_key)
+    header, old_entries = read_table(str(tmp_path / "fs.img.encrypted"))
+
+    changed = os.urandom(CHUNK_SIZE)
+    write_chunk(str(tmp_path / "ramdisk.img"), 1, changed)
+    StreamEngine(workers=1).encrypt_image(aes_key, str(tmp_path / "ramdisk.img"), str(tmp_path / "fs.img.encrypted"), digests)
+
+    # Only the changed chunk has a new entry, the others were left as they were
+    header, entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    assert [entry.pack() for entry in entries[:1] + entries[2:]] == [entry.pack() for entry in old_entries[:1] + old_entries[2:]]
+    assert entries[1].pack() != old_entries[1].pack()
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == plaintext[:CHUNK_SIZE] + changed + plaintext[CHUNK_SIZE * 2:]
+
+class PowerLost(Exception):
+    pass
+
+def test_abandoned_update_leaves_image_unchanged(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypt_with_digests(tmp_path, aes_key)
+    write_chunk(str(tmp_path / "ramdisk.img"), 0, os.urandom(CHUNK_SIZE))
+
+    def before_commit():
+        raise PowerLost()
+
+    with pytest.raises(PowerLost):
+        StreamEngine(workers=1).update_image(aes_key, str(tmp_path / "ramdisk.img"), str(tmp_path / "fs.img.encrypted"), list(digests), before_commit)
+    assert not os.path.exists(journal.journal_path(str(tmp_path / "fs.img.encrypted")))
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == plaintext
+
+# Update the image, losing power once the journal is committed but before it has been applied to the table
+def interrupted_update(tmp_path, monkeypatch, aes_key, digests, changed):
+    write_chunk(str(tmp_path / "ramdisk.img"), 0, changed)
+
+    def apply(self, f, header):
+        raise PowerLost()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(journal.Journal, "apply", apply)
+        with pytest.raises(PowerLost):
+            StreamEngine(workers=1).update_image(aes_key, str(tmp_path / "ramdisk.img"), str(tmp_path / "fs.img.encrypted"), digests)
+
+    return journal.journal_path(str(tmp_path / "fs.img.encrypted"))
+
+def test_committed_journal_is_replayed(tmp_path, monkeypatch):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypt_with_digests(tmp_path, aes_key)
+    changed = os.urandom(CHUNK_SIZE)
+    path = interrupted_update(tmp_path, monkeypatch, aes_key, digests, changed)
+    assert os.path.exists(path)
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == changed + plaintext[CHUNK_SIZE:]
+    assert not os.path.exists(path)
+
+@pytest.mark.parametrize("damage", ["truncate", "corrupt"])
+def test_incomplete_journal_is_discarded(tmp_path, monkeypatch, damage):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypt_with_digests(tmp_path, aes_key)
+    path = interrupted_update(tmp_path, monkeypatch, aes_key, digests, os.urandom(CHUNK_SIZE))
+
+    # A journal cut short before its commit record, or whose records do not match it, is never applied
+    data = bytearray(open(path, "rb").read())
+    if damage == "truncate":
+        del data[-1:]
+    else:
+        data[len(journal.JOURNAL_MAGIC)] ^= 1
+    open(path, "wb").write(data)
+
+    journal.recover(str(tmp_path / "fs.img.encrypted"))
+    assert not os.path.exists(path)
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == plaintext
+
+# A full encrypt that is interrupted leaves the old image in place, and trying again only encrypts the chunks it had not done
+def test_interrupted_rewrite_is_resumed(tmp_path, monkeypatch):
+    aes_key = keyring.generate_data_key()
+    old_plaintext, digests = encrypt_with_digests(tmp_path, aes_key)
+    plaintext = sample_plaintext()
+    (tmp_path / "plain.img").write_bytes(plaintext)
+
+    write_chunk = StreamEngine.write_chunk
+
+    def lose_power_at_chunk_2(self, fout, header, index, entry, ciphertext):
+        if index == 2:
+            raise PowerLost()
+        return write_chunk(self, fout, header, index, entry, ciphertext)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(StreamEngine, "write_chunk", lose_power_at_chunk_2)
+        with pytest.raises(PowerLost):
+            StreamEngine(workers=1).rewrite_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == old_plaintext
+
+    written = []
+
+    def record(self, fout, header, index, entry, ciphertext):
+        written.append(index)
+        return write_chunk(self, fout, header, index, entry, ciphertext)
+
+    monkeypatch.setattr(StreamEngine, "write_chunk", record)
+    StreamEngine(workers=1).rewrite_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+    assert written == [2, 3]
+    assert not os.path.exists(str(tmp_path / "fs.img.encrypted.partial"))
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == plaintext
+
+def test_blank_image_is_all_holes(tmp_path):
+    aes_key = keyring.generate_data_key()
+    StreamEngine(workers=1).create_image(aes_key, str(tmp_path / "fs.img.encrypted"), CHUNK_SIZE * 4)
+
+    header, entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    assert all(entry.flags & image_format.CHUNK_HOLE for entry in entries)
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == bytes(CHUNK_SIZE * 4)
+
+# A new drive is created from a sparse, freshly formatted filesystem, of which only the chunks holding data are encrypted
+def test_image_created_from_sparse_file(tmp_path):
+    aes_key = keyring.generate_data_key()
+    metadata = os.urandom(CHUNK_SIZE // 2)
+    with open(tmp_path / "plain.img", "wb") as f:
+        f.truncate(CHUNK_SIZE * 8)
+        f.write(metadata)
+        f.seek(CHUNK_SIZE * 6)
+        f.write(bytes(CHUNK_SIZE) + metadata)
+
+    StreamEngine(workers=1).create_image(aes_key, str(tmp_path / "fs.img.encrypted"), CHUNK_SIZE * 8, str(tmp_path / "plain.img"))
+
+    # The chunk that was written with zeros is a hole too
+    header, entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    assert [not entry.flags & image_format.CHUNK_HOLE for entry in entries] == [True, False, False, False, False, False, False, True]
+
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == (tmp_path / "plain.img").read_bytes()
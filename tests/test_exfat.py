@@ -0,0 +1,64 @@
+import os
+import struct
+
+from encryption import exfat
+from encryption import image_format
+from encryption import keyring
+from encryption.engine import StreamEngine
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+SECTOR_SIZE = 512
+CLUSTER_SIZE = 4096
+
+# A volume of four chunks: the boot region and FAT fill the first, and the cluster heap the other three
+# the root directory and the allocation bitmap are in the first two clusters, and one more cluster in the last chunk is in use
+# every free cluster is filled with data, which is left over from deleted files so it need not be kept
+def exfat_volume(path):
+    heap_offset = CHUNK_SIZE
+    cluster_count = CHUNK_SIZE * 3 // CLUSTER_SIZE
+    used_cluster = cluster_count - 1
+    bitmap_length = (cluster_count + 7) // 8
+
+    volume = bytearray(os.urandom(CHUNK_SIZE * 4))
+    volume[:CHUNK_SIZE] = bytes(CHUNK_SIZE)
+
+    volume[3:11] = exfat.FILE_SYSTEM_NAME
+    struct.pack_into(exfat.BOOT_SECTOR_FORMAT, volume, exfat.BOOT_SECTOR_OFFSET, 1, 1, heap_offset // SECTOR_SIZE, cluster_count, 2, 9, 3)
+
+    # The root directory is a chain of one cluster, the bitmap has no chain as its clusters are contiguous
+    struct.pack_into("<I", volume, SECTOR_SIZE + 2 * 4, exfat.FAT_END_OF_CHAIN)
+    struct.pack_into("<I", volume, SECTOR_SIZE + 3 * 4, 0)
+
+    root = bytearray(CLUSTER_SIZE)
+    root[0] = exfat.ENTRY_ALLOCATION_BITMAP
+    struct.pack_into("<IQ", root, 20, 3, bitmap_length)
+    volume[heap_offset:heap_offset + CLUSTER_SIZE] = root
+
+    bitmap = bytearray(CLUSTER_SIZE)
+    for cluster_index in (0, 1, used_cluster):
+        bitmap[cluster_index // 8] |= 1 << cluster_index % 8
+    volume[heap_offset + CLUSTER_SIZE:heap_offset + CLUSTER_SIZE * 2] = bitmap
+
+    with open(path, "wb") as f:
+        f.write(volume)
+
+    return bytes(volume)
+
+def test_allocated_chunks(tmp_path):
+    exfat_volume(str(tmp_path / "plain.img"))
+    assert exfat.allocated_chunks(str(tmp_path / "plain.img"), CHUNK_SIZE * 4, CHUNK_SIZE) == [True, True, False, True]
+
+def test_not_an_exfat_volume(tmp_path):
+    (tmp_path / "plain.img").write_bytes(os.urandom(CHUNK_SIZE))
+    assert exfat.allocated_chunks(str(tmp_path / "plain.img"), CHUNK_SIZE, CHUNK_SIZE) is None
+
+# A chunk holding only free clusters is stored as a hole, so it decrypts to zeros
+def test_free_clusters_are_not_encrypted(tmp_path):
+    aes_key = keyring.generate_data_key()
+    volume = exfat_volume(str(tmp_path / "plain.img"))
+
+    engine = StreamEngine(workers=1, exfat_aware=True)
+    engine.encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+    engine.decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+
+    assert (tmp_path / "out.img").read_bytes() == volume[:CHUNK_SIZE * 2] + bytes(CHUNK_SIZE) + volume[CHUNK_SIZE * 3:]
@@ -0,0 +1,33 @@
+import config
+import utils
+from storage import storage
+
+def test_a_lun_for_each_drive_profile(monkeypatch):
+    monkeypatch.setattr(config, "DRIVE_PROFILES", {"fs": "0x81010001", "work": "0x81010004", "photos": "0x81010005"})
+    assert storage.gadget_luns(["fs.img"]) == ["fs.img", "", ""]
+    assert storage.gadget_luns([]) == ["", "", ""]
+
+def run_commands(monkeypatch, tmp_path, gadget_exists):
+    commands = []
+    monkeypatch.setattr(utils, "execute_command", lambda command, show_log: commands.append(command))
+    monkeypatch.setattr(config, "DRIVE_PROFILES", {"fs": "0x81010001", "work": "0x81010004"})
+    monkeypatch.setattr(storage, "GADGET_FUNCTION_PATH", str(tmp_path if gadget_exists else tmp_path / "missing"))
+
+    return commands
+
+# Once the gadget exists, mounting and ejecting only swaps the files of its LUNs
+def test_files_are_swapped_on_the_existing_gadget(monkeypatch, tmp_path):
+    commands = run_commands(monkeypatch, tmp_path, True)
+    storage.set_usb_gadget_files(["fs.img"], False)
+    storage.set_usb_gadget_files([], False)
+
+    assert commands == [["./storage/scripts/set_usb_gadget_files", "fs.img", ""], ["./storage/scripts/set_usb_gadget_files", "", ""]]
+
+def test_gadget_is_created_on_first_mount(monkeypatch, tmp_path):
+    commands = run_commands(monkeypatch, tmp_path, False)
+
+    # Ejecting with no gadget has nothing to do
+    storage.set_usb_gadget_files([], False)
+    storage.set_usb_gadget_files(["fs.img", "work.img"], False)
+
+    assert commands == [["./storage/scripts/create_usb_gadget", "fs.img", "work.img"]]
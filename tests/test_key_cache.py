@@ -0,0 +1,22 @@
+import time
+
+from encryption.key_cache import KeyCache
+
+def test_key_is_kept_until_cleared():
+    cache = KeyCache(ttl=60)
+    assert cache.get() is None
+
+    cache.store(b"\x01" * 32)
+    assert cache.get() == b"\x01" * 32
+
+    # The key is overwritten in place, so no copy of it is left in the cache
+    key = cache.key
+    cache.clear()
+    assert cache.get() is None
+    assert key == bytes(32)
+
+def test_key_times_out():
+    cache = KeyCache(ttl=0.05)
+    cache.store(b"\x01" * 32)
+    time.sleep(0.5)
+    assert cache.get() is None
@@ -0,0 +1,51 @@
+import os
+import threading
+
+from encryption import activity
+from encryption.key_pool import KeyPool
+
+# A TPM whose storage keys each have their own public area, and which creates a new key each time it is asked
+class FakeTPM:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.last_used = 0
+        self.created = 0
+
+    def read_public(self, handle):
+        return b"public area of storage key %d" % handle
+
+    def create(self, parent, template):
+        self.created += 1
+        return b"private %d" % self.created, b"public %d" % self.created
+
+def key_pool(tmp_path, parent):
+    return KeyPool(FakeTPM(), lambda: parent, str(tmp_path / "key_pool"), depth=2)
+
+def test_each_key_is_taken_once(tmp_path):
+    pool = key_pool(tmp_path, 1)
+    pool.add()
+    pool.add()
+    assert pool.size() == 2
+
+    keys = [pool.take(1), pool.take(1)]
+    assert sorted(keys) == [(b"private 1", b"public 1"), (b"private 2", b"public 2")]
+    assert pool.take(1) is None
+    assert pool.size() == 0
+
+# Keys created under another storage key (e.g. before the TPM was cleared) can no longer be loaded, so they are thrown away
+def test_stale_and_truncated_keys_are_discarded(tmp_path):
+    pool = key_pool(tmp_path, 1)
+    pool.add()
+    with open(os.path.join(pool.directory, "truncated.key"), "wb") as f:
+        f.write(b"\x00\x40")
+
+    assert pool.take(2) is None
+    assert pool.size() == 0
+
+def test_activity():
+    assert not activity.busy()
+    with activity.working():
+        with activity.working():
+            assert activity.busy()
+        assert activity.busy()
+    assert not activity.busy()
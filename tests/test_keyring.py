@@ -0,0 +1,146 @@
+import struct
+
+import pytest
+
+from encryption import keyring
+from encryption.encryption import Encryption
+from encryption.keyring import Keyring
+
+ALICE = "0x81010010"
+BOB = "0x81010011"
+CAROL = "0x81010012"
+
+def test_wrap_and_unwrap():
+    user_key = keyring.generate_data_key()
+    data_key = keyring.generate_data_key()
+
+    wrapped = keyring.wrap_key(user_key, data_key)
+    assert keyring.unwrap_key(user_key, wrapped) == data_key
+
+    with pytest.raises(ValueError):
+        keyring.unwrap_key(keyring.generate_data_key(), wrapped)
+
+def test_save_and_load(tmp_path):
+    alice_key, bob_key, data_key = (keyring.generate_data_key() for i in range(3))
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    assert not ring.load()
+    ring.add(ALICE, alice_key, data_key)
+    ring.add(BOB, bob_key, data_key)
+    ring.save()
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    assert ring.load()
+    assert sorted(ring.users()) == [ALICE, BOB]
+    assert ring.unwrap(ALICE, alice_key) == [data_key]
+    assert ring.unwrap(BOB, bob_key) == [data_key]
+
+    with pytest.raises(ValueError):
+        ring.unwrap(BOB, alice_key)
+
+# Removing a user only drops their entry, the data key and the other users' entries are unchanged
+def test_remove_user(tmp_path):
+    alice_key, bob_key, data_key = (keyring.generate_data_key() for i in range(3))
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    ring.add(ALICE, alice_key, data_key)
+    ring.add(BOB, bob_key, data_key)
+    ring.remove(BOB)
+    ring.save()
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    ring.load()
+    assert ring.users() == [ALICE]
+    assert ring.unwrap(ALICE, alice_key) == [data_key]
+
+# The data keys unlocked for enrolling a user are forgotten with the other cached keys (e.g. on SIGINT or when the cache times out)
+def test_enroll_keys_are_cleared(monkeypatch):
+    monkeypatch.setattr(Encryption, "enroll_keys", {"fs": keyring.generate_data_key()})
+    Encryption.clear_keys()
+    assert Encryption.enroll_keys == {}
+
+def test_rotate_leaves_pending_keys(tmp_path):
+    alice_key, bob_key, carol_key, old_key, new_key = (keyring.generate_data_key() for i in range(5))
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    for user_addr, user_key in ((ALICE, alice_key), (BOB, bob_key), (CAROL, carol_key)):
+        ring.add(user_addr, user_key, old_key)
+    ring.rotate(ALICE, alice_key, new_key, {BOB: b"sealed for bob", CAROL: b"sealed for carol"})
+    ring.save()
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    ring.load()
+    assert ring.generation() == 1
+
+    # The user who rotated the key has it straight away, the others only have it sealed for them
+    assert ring.unwrap(ALICE, alice_key) == [new_key]
+    assert ring.pending == {BOB: (1, b"sealed for bob"), CAROL: (1, b"sealed for carol")}
+
+    # Nothing wrapped under the old key leads to the new one
+    assert ring.unwrap(BOB, bob_key) == [old_key]
+    assert ring.successors == {}
+
+    # Once a user unlocks with the pending key, their entry is brought up to date
+    ring.add(BOB, bob_key, new_key)
+    assert BOB not in ring.pending
+    assert ring.unwrap(BOB, bob_key) == [new_key]
+
+    # A removed user loses their pending key along with their entry
+    ring.remove(CAROL)
+    assert ring.pending == {}
+    assert ring.users() == [ALICE, BOB]
+
+# A keyring written before pending keys, with a successor from an older rotation
+def legacy_keyring(path, alice_key, bob_key, old_key, new_key):
+    data = keyring.KEYRING_MAGIC
+    data += struct.pack(keyring.LEGACY_VERSIONS[2], int(ALICE, 16), 1, keyring.wrap_key(alice_key, new_key))
+    data += struct.pack(keyring.LEGACY_VERSIONS[2], int(BOB, 16), 0, keyring.wrap_key(bob_key, old_key))
+    data += struct.pack(keyring.LEGACY_VERSIONS[2], keyring.SUCCESSOR_ADDR, 1, keyring.wrap_key(old_key, new_key))
+
+    with open(keyring.keyring_path(path), "wb") as f:
+        f.write(data)
+
+def test_legacy_successors_are_followed_and_pruned(tmp_path):
+    alice_key, bob_key, old_key, new_key = (keyring.generate_data_key() for i in range(4))
+    legacy_keyring(str(tmp_path / "fs.img.encrypted"), alice_key, bob_key, old_key, new_key)
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    ring.load()
+    assert ring.generation() == 1
+    assert ring.unwrap(BOB, bob_key) == [old_key, new_key]
+
+    # The successor is kept until every entry is past it
+    ring.prune()
+    assert list(ring.successors) == [1]
+    ring.add(BOB, bob_key, new_key)
+    ring.prune()
+    assert ring.successors == {}
+
+    # The keyring is written back in the current version
+    ring.save()
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    ring.load()
+    assert ring.unwrap(BOB, bob_key) == [new_key]
+
+def test_legacy_keyring_with_no_generations(tmp_path):
+    alice_key, data_key = keyring.generate_data_key(), keyring.generate_data_key()
+    with open(keyring.keyring_path(str(tmp_path / "fs.img.encrypted")), "wb") as f:
+        f.write(keyring.KEYRING_MAGIC + struct.pack(keyring.LEGACY_VERSIONS[1], int(ALICE, 16), keyring.wrap_key(alice_key, data_key)))
+
+    ring = Keyring(str(tmp_path / "fs.img.encrypted"))
+    ring.load()
+    assert ring.unwrap(ALICE, alice_key) == [data_key]
+    assert ring.generation() == 0
+
+@pytest.mark.parametrize("data", [
+    b"NOTAKEYRING",
+    keyring.KEYRING_MAGIC + struct.pack(keyring.VERSION_FORMAT, keyring.KEYRING_VERSION + 1),
+    keyring.KEYRING_MAGIC + struct.pack(keyring.VERSION_FORMAT, keyring.KEYRING_VERSION) + struct.pack(keyring.RECORD_FORMAT, int(ALICE, 16), keyring.RECORD_ENTRY, 0, 40),
+    keyring.KEYRING_MAGIC + struct.pack(keyring.VERSION_FORMAT, keyring.KEYRING_VERSION) + struct.pack(keyring.RECORD_FORMAT, int(ALICE, 16), 9, 0, 0),
+])
+def test_corrupt_keyring_fails(tmp_path, data):
+    with open(keyring.keyring_path(str(tmp_path / "fs.img.encrypted")), "wb") as f:
+        f.write(data)
+
+    with pytest.raises(ValueError):
+        Keyring(str(tmp_path / "fs.img.encrypted")).load()
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from encryption import image_format
+from encryption import keyring
+from encryption.engine import StreamEngine
+from encryption.lazy_image import LazyImage
+from storage.nbd import NbdClient, NbdServer
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+
+# A lazily decrypted image served over NBD, as the kernel would see it, with a client connected
+def serve(tmp_path, plaintext):
+    aes_key = keyring.generate_data_key()
+    (tmp_path / "plain.img").write_bytes(plaintext)
+    StreamEngine(workers=1).encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+
+    image = LazyImage(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "ramdisk.img"))
+    server = NbdServer(image, str(tmp_path / "nbd.sock"))
+    server.start()
+
+    return aes_key, image, server, NbdClient(str(tmp_path / "nbd.sock"))
+
+def test_read_write_round_trip(tmp_path):
+    plaintext = os.urandom(CHUNK_SIZE * 3) + bytes(CHUNK_SIZE)
+    aes_key, image, server, client = serve(tmp_path, plaintext)
+    try:
+        assert client.size == len(plaintext)
+
+        # Reads are decrypted on demand, across chunk boundaries and from holes
+        assert client.read(CHUNK_SIZE - 100, 200) == plaintext[CHUNK_SIZE - 100:CHUNK_SIZE + 100]
+        assert client.read(CHUNK_SIZE * 3, 4096) == bytes(4096)
+
+        client.write(CHUNK_SIZE * 2 - 10, b"x" * 20, fua=True)
+        client.write(CHUNK_SIZE * 3 + 512, b"y" * 512)
+        client.flush()
+        assert client.read(CHUNK_SIZE * 2 - 10, 20) == b"x" * 20
+        assert client.read(CHUNK_SIZE * 3 + 512, 512) == b"y" * 512
+    finally:
+        client.disconnect()
+        server.stop()
+        image.close()
+
+    expected = bytearray(plaintext)
+    expected[CHUNK_SIZE * 2 - 10:CHUNK_SIZE * 2 + 10] = b"x" * 20
+    expected[CHUNK_SIZE * 3 + 512:CHUNK_SIZE * 3 + 1024] = b"y" * 512
+
+    # Only the chunks the host used are encrypted back, and the image then holds every write
+    StreamEngine(workers=1).encrypt_image(aes_key, str(tmp_path / "ramdisk.img"), str(tmp_path / "fs.img.encrypted"), image.chunk_digests)
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == bytes(expected)
+
+def test_out_of_range_request_fails(tmp_path):
+    aes_key, image, server, client = serve(tmp_path, os.urandom(CHUNK_SIZE))
+    try:
+        with pytest.raises(OSError) as error:
+            client.read(CHUNK_SIZE - 10, 20)
+        assert error.value.errno == 22
+
+        # The connection is still usable after a failed command
+        assert len(client.read(0, 512)) == 512
+    finally:
+        client.disconnect()
+        server.stop()
+        image.close()
@@ -0,0 +1,39 @@
+import pytest
+
+from encryption.pipeline import Pipeline
+
+class Failed(Exception):
+    pass
+
+def test_jobs_are_written_in_order():
+    pipe = Pipeline(16, buffers=2)
+    written = []
+
+    pipe.run(lambda: iter(range(100)), lambda jobs: ((job, job * 2) for job in jobs), lambda job, result: written.append((job, result)))
+    assert written == [(job, job * 2) for job in range(100)]
+
+# A failing stage stops the others, even when they are waiting on a full queue or on a free buffer
+@pytest.mark.parametrize("stage", ["read", "crypt", "write"])
+def test_error_in_any_stage_is_raised(stage):
+    pipe = Pipeline(16, buffers=2)
+
+    def read():
+        for job in range(100):
+            if stage == "read" and job == 50:
+                raise Failed()
+            pipe.in_buffers.get()
+            yield job
+
+    def crypt(jobs):
+        for job in jobs:
+            if stage == "crypt" and job == 50:
+                raise Failed()
+            pipe.in_buffers.put(bytearray(16))
+            yield job, job
+
+    def write(job, result):
+        if stage == "write" and job == 50:
+            raise Failed()
+
+    with pytest.raises(Failed):
+        pipe.run(read, crypt, write)
@@ -0,0 +1,35 @@
+import os
+
+from encryption import image_format
+from encryption import keyring
+from encryption.engine import StreamEngine
+from encryption.prefetch import Prefetcher
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+
+# Only the chunks that are decrypted are read, so holes are skipped
+def test_ranges_skip_holes(tmp_path):
+    (tmp_path / "plain.img").write_bytes(os.urandom(CHUNK_SIZE) + bytes(CHUNK_SIZE) + os.urandom(CHUNK_SIZE))
+    StreamEngine(workers=1).encrypt_image(keyring.generate_data_key(), str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+
+    with open(tmp_path / "fs.img.encrypted", "rb") as f:
+        header, entries = image_format.read_header_and_table(f)
+        ranges = Prefetcher(str(tmp_path / "fs.img.encrypted")).ranges(f)
+
+    assert ranges == [(header.chunk_offset(0), entries[0].length), (header.chunk_offset(2), entries[2].length)]
+
+def test_prefetch_stops_at_the_limit(tmp_path, capsys):
+    (tmp_path / "fs.img.encrypted").write_bytes(os.urandom(CHUNK_SIZE * 3))
+
+    prefetcher = Prefetcher(str(tmp_path / "fs.img.encrypted"), CHUNK_SIZE + 100)
+    prefetcher.start()
+    prefetcher.thread.join()
+    prefetcher.stop()
+
+    assert f"Prefetched {CHUNK_SIZE + 100} bytes" in capsys.readouterr().out
+
+def test_nothing_to_prefetch(tmp_path):
+    prefetcher = Prefetcher(str(tmp_path / "fs.img.encrypted"))
+    prefetcher.start()
+    assert prefetcher.thread is None
+    prefetcher.stop()
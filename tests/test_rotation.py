@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from encryption import image_format
+from encryption import keyring
+from encryption.engine import StreamEngine
+from encryption.rotation import KeyRotation, rotation_path
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+
+class PowerLost(Exception):
+    pass
+
+# An image of a few chunks (one a hole) under a new key, decrypted to a ramdisk with the digests of its chunks
+def encrypted_image(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext = os.urandom(CHUNK_SIZE * 2) + bytes(CHUNK_SIZE) + os.urandom(CHUNK_SIZE)
+    (tmp_path / "plain.img").write_bytes(plaintext)
+
+    engine = StreamEngine(workers=1)
+    engine.encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+    digests = []
+    engine.decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "ramdisk.img"), digests)
+
+    return aes_key, plaintext, digests
+
+def decrypt(tmp_path, aes_key):
+    StreamEngine(workers=1).decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img"))
+    return (tmp_path / "out.img").read_bytes()
+
+def test_rotation(tmp_path):
+    old_key, plaintext, digests = encrypted_image(tmp_path)
+    recorded = []
+
+    rotation = KeyRotation(str(tmp_path / "fs.img.encrypted"), old_key, lambda: 0, recorded.append)
+    assert rotation.begin()
+    rotation.rotate(lambda: None)
+    assert rotation.percent_done() == 100
+
+    # The host writes to the drive after its chunk was re-encrypted, so it is re-encrypted again when the rotation finishes
+    changed = bytearray(plaintext)
+    changed[10:20] = b"x" * 10
+    (tmp_path / "ramdisk.img").write_bytes(changed)
+    StreamEngine(workers=1).encrypt_image(old_key, str(tmp_path / "ramdisk.img"), str(tmp_path / "fs.img.encrypted"), digests)
+
+    new_key = rotation.finish()
+    assert recorded == [new_key]
+    assert not os.path.exists(rotation_path(str(tmp_path / "fs.img.encrypted")))
+
+    assert decrypt(tmp_path, new_key) == bytes(changed)
+    with pytest.raises(ValueError):
+        decrypt(tmp_path, old_key)
+
+def test_interrupted_rotation_resumes_with_the_same_key(tmp_path):
+    old_key, plaintext, digests = encrypted_image(tmp_path)
+
+    rotation = KeyRotation(str(tmp_path / "fs.img.encrypted"), old_key, lambda: 0, None)
+    rotation.begin()
+    rotation.rotate(lambda: None)
+
+    resumed = KeyRotation(str(tmp_path / "fs.img.encrypted"), old_key, lambda: 0, None)
+    assert resumed.begin()
+    assert resumed.new_key == rotation.new_key
+
+    # A rotation that is not under the key being rotated is a leftover, and is forgotten
+    other = KeyRotation(str(tmp_path / "fs.img.encrypted"), keyring.generate_data_key(), lambda: 0, None)
+    assert not other.begin()
+    assert not os.path.exists(rotation_path(str(tmp_path / "fs.img.encrypted")))
+
+def test_key_is_recovered_if_power_is_lost_before_it_is_recorded(tmp_path):
+    old_key, plaintext, digests = encrypted_image(tmp_path)
+
+    def record_key(new_key):
+        raise PowerLost()
+
+    rotation = KeyRotation(str(tmp_path / "fs.img.encrypted"), old_key, lambda: 0, record_key)
+    rotation.begin()
+    rotation.rotate(lambda: None)
+    with pytest.raises(PowerLost):
+        rotation.finish()
+
+    # The image is already under the new key, which only the old key leads to
+    other_key = keyring.generate_data_key()
+    assert KeyRotation.recover_key(str(tmp_path / "fs.img.encrypted"), [other_key, old_key]) == rotation.new_key
+    assert KeyRotation.recover_key(str(tmp_path / "fs.img.encrypted"), [other_key]) is None
+    assert decrypt(tmp_path, rotation.new_key) == plaintext
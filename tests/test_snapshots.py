@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from encryption import image_format
+from encryption import keyring
+from encryption import snapshots
+from encryption.engine import StreamEngine
+from encryption.snapshots import SnapshotStore
+
+CHUNK_SIZE = image_format.CHUNK_SIZE
+
+def read_table(path):
+    with open(path, "rb") as f:
+        return image_format.read_header_and_table(f)
+
+def decrypt(aes_key, path, out_path):
+    StreamEngine(workers=1).decrypt_image(aes_key, path, out_path)
+    with open(out_path, "rb") as f:
+        return f.read()
+
+# An image of a few chunks, decrypted to a ramdisk with the digests of its chunks
+def encrypted_image(tmp_path, aes_key):
+    plaintext = os.urandom(CHUNK_SIZE * 3)
+    (tmp_path / "plain.img").write_bytes(plaintext)
+
+    engine = StreamEngine(workers=1)
+    engine.encrypt_image(aes_key, str(tmp_path / "plain.img"), str(tmp_path / "fs.img.encrypted"))
+    digests = []
+    engine.decrypt_image(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "ramdisk.img"), digests)
+
+    return plaintext, digests
+
+# Change a chunk on the ramdisk and write it into the image, returning the new plaintext
+def update(tmp_path, aes_key, digests, index):
+    with open(tmp_path / "ramdisk.img", "r+b") as f:
+        f.seek(index * CHUNK_SIZE)
+        f.write(os.urandom(CHUNK_SIZE))
+
+    StreamEngine(workers=1).encrypt_image(aes_key, str(tmp_path / "ramdisk.img"), str(tmp_path / "fs.img.encrypted"), digests)
+    return (tmp_path / "ramdisk.img").read_bytes()
+
+def test_changed_chunk_is_never_overwritten_in_place(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypted_image(tmp_path, aes_key)
+
+    # With no snapshot, the first change goes back to the chunk's own slot, and the next one to another slot
+    update(tmp_path, aes_key, digests, 1)
+    header, entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    update(tmp_path, aes_key, digests, 1)
+    header, new_entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    assert new_entries[1].slot_index(1) != entries[1].slot_index(1)
+
+def test_rollback(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypted_image(tmp_path, aes_key)
+    store = SnapshotStore(str(tmp_path / "fs.img.encrypted"))
+
+    first = store.create()
+    changed = update(tmp_path, aes_key, digests, 0)
+    second = store.create()
+    update(tmp_path, aes_key, digests, 2)
+
+    third = store.create()
+
+    # Nothing has changed since the newest snapshot, so no new one is taken
+    assert store.create() == third
+
+    assert store.rollback(second) == second
+    assert decrypt(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img")) == changed
+    assert store.list() == [first, second]
+
+    # With no id, the image goes back to the newest snapshot that differs from it
+    assert store.rollback() == first
+    assert decrypt(aes_key, str(tmp_path / "fs.img.encrypted"), str(tmp_path / "out.img")) == plaintext
+
+    with pytest.raises(ValueError):
+        store.rollback()
+
+# The slots that only deleted snapshots referred to are reused, and cut off the end of the image once nothing is in them
+def test_gc_frees_slots(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypted_image(tmp_path, aes_key)
+    store = SnapshotStore(str(tmp_path / "fs.img.encrypted"))
+
+    store.create()
+    update(tmp_path, aes_key, digests, 0)
+    header, entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    assert entries[0].slot_index(0) >= header.chunk_count
+    size = os.path.getsize(tmp_path / "fs.img.encrypted")
+
+    store.gc(0)
+    assert store.list() == []
+
+    update(tmp_path, aes_key, digests, 0)
+    header, entries = read_table(str(tmp_path / "fs.img.encrypted"))
+    assert entries[0].slot_index(0) == 0
+
+    store.gc(0)
+    assert os.path.getsize(tmp_path / "fs.img.encrypted") < size
+
+# A full rewrite keeps the old image and its snapshots, which can be put back in place of the new one
+def test_previous_image_is_kept(tmp_path):
+    aes_key = keyring.generate_data_key()
+    plaintext, digests = encrypted_image(tmp_path, aes_key)
+    path = str(tmp_path / "fs.img.encrypted")
+    SnapshotStore(path).create()
+
+    new_plaintext = os.urandom(CHUNK_SIZE * 2)
+    (tmp_path / "plain.img").write_bytes(new_plaintext)
+    StreamEngine(workers=1).rewrite_image(aes_key, str(tmp_path / "plain.img"), path)
+
+    assert SnapshotStore(path).list() == []
+    assert SnapshotStore(snapshots.previous_path(path)).list() == [1]
+    assert decrypt(aes_key, snapshots.previous_path(path), str(tmp_path / "out.img")) == plaintext
+
+    snapshots.restore_previous(path)
+    assert decrypt(aes_key, path, str(tmp_path / "out.img")) == plaintext
+    assert decrypt(aes_key, snapshots.previous_path(path), str(tmp_path / "out.img")) == new_plaintext
+    assert SnapshotStore(path).list() == [1]
@@ -0,0 +1,123 @@
+import hashlib
+import socket
+import struct
+import threading
+
+import pytest
+
+from encryption import policy
+from encryption import tpm_client
+from encryption.tpm_client import ResponseReader, TPMClient, TPMError
+
+# Policy digests computed by the TPM simulator in a trial session, for PCR 23 extended with the hashes of b"passcode"
+# then b"fingerprint", followed by a signature from the key with this name
+TPM_PCR = 23
+TPM_PCR_POLICY = bytes.fromhex("646ade96af233d8e7725f4a89200645f8b29ac5f03e8f5eca8e4c6c7d3d94c69")
+TPM_AUTH_NAME = bytes.fromhex("000bba6f11f045291957293066c335249d432635328ab0aa5fff9e44972dc9a7658c")
+TPM_SIGNED_POLICY = bytes.fromhex("e0d518283223f0109b636e57b67737a03e9f8762466f4c39c33967b34f6ce0f9")
+
+def test_policy_digests_match_the_tpm():
+    pcr_value = policy.pcr_value([hashlib.sha256(b"passcode").digest(), hashlib.sha256(b"fingerprint").digest()])
+
+    digest = policy.policy_pcr(policy.empty_policy(), TPM_PCR, pcr_value)
+    assert digest == TPM_PCR_POLICY
+    assert policy.policy_signed(digest, TPM_AUTH_NAME) == TPM_SIGNED_POLICY
+
+def test_pcr_value():
+    assert policy.pcr_value([]) == bytes(32)
+    assert policy.pcr_value([b"\x01" * 32]) == hashlib.sha256(bytes(32) + b"\x01" * 32).digest()
+
+def test_object_name():
+    public = tpm_client.rsa_key_template()
+    assert policy.object_name(public) == b"\x00\x0b" + hashlib.sha256(public).digest()
+
+def test_auth_policy_of_sealed_object():
+    digest = bytes(range(32))
+    assert tpm_client.auth_policy(tpm_client.sealed_data_template(digest)) == digest
+
+def test_tpm2b_and_pcr_selection():
+    assert tpm_client.tpm2b(b"abc") == b"\x00\x03abc"
+    assert tpm_client.tpm2b() == b"\x00\x00"
+    assert tpm_client.pcr_selection() == b"\x00\x00\x00\x00"
+    assert tpm_client.pcr_selection(23) == b"\x00\x00\x00\x01\x00\x0b\x03\x00\x00\x80"
+
+def test_response_reader():
+    reader = ResponseReader(b"\x01\x00\x02\x00\x00\x00\x03" + tpm_client.tpm2b(b"xyz") + b"rest")
+    assert (reader.u8(), reader.u16(), reader.u32(), reader.tpm2b(), reader.rest()) == (1, 2, 3, b"xyz", b"rest")
+
+    with pytest.raises(ValueError):
+        ResponseReader(b"\x00\x05abc").tpm2b()
+
+# A client connected over TCP (as to the simulator's command port), and a thread on the other end answering each command
+# with the next response, as the simulator does: the response is sized, then followed by a zero acknowledgement
+def fake_simulator(monkeypatch, responses):
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        client = TPMClient()
+        client.command_socket = socket.create_connection(server.getsockname())
+        simulator, address = server.accept()
+    monkeypatch.setattr(client, "connect", lambda: None)
+
+    commands = []
+
+    def serve():
+        for response in responses:
+            send_command, locality, length = struct.unpack(">IBI", simulator.recv(9, socket.MSG_WAITALL))
+            assert send_command == tpm_client.TPM_SEND_COMMAND
+            commands.append(simulator.recv(length, socket.MSG_WAITALL))
+            simulator.sendall(struct.pack(">I", len(response)) + response + bytes(4))
+        simulator.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    return client, commands, thread
+
+def response(response_code, body=b""):
+    return struct.pack(">HII", tpm_client.TPM_ST_NO_SESSIONS, 10 + len(body), response_code) + body
+
+def test_command_framing(monkeypatch):
+    client, commands, thread = fake_simulator(monkeypatch, [response(tpm_client.TPM_RC_SUCCESS, tpm_client.tpm2b(b"random"))])
+    assert client.get_random(6) == b"random"
+    thread.join()
+
+    assert commands == [struct.pack(">HIIH", tpm_client.TPM_ST_NO_SESSIONS, 12, tpm_client.TPM_CC_GET_RANDOM, 6)]
+
+def test_command_with_session(monkeypatch):
+    client, commands, thread = fake_simulator(monkeypatch, [response(tpm_client.TPM_RC_SUCCESS, struct.pack(">I", 0))])
+    client.pcr_reset(TPM_PCR)
+    thread.join()
+
+    auth = struct.pack(">IHBH", tpm_client.TPM_RS_PW, 0, 0, 0)
+    body = struct.pack(">II", TPM_PCR, len(auth)) + auth
+    assert commands == [struct.pack(">HII", tpm_client.TPM_ST_SESSIONS, 10 + len(body), tpm_client.TPM_CC_PCR_RESET) + body]
+
+def test_error_response(monkeypatch):
+    client, commands, thread = fake_simulator(monkeypatch, [response(0x98e)])
+    with pytest.raises(TPMError) as error:
+        client.get_random(6)
+    thread.join()
+
+    assert error.value.command_code == tpm_client.TPM_CC_GET_RANDOM
+    assert error.value.response_code == 0x98e
+
+# Another thread cannot close the connection between connecting and sending the command
+def test_connect_is_under_the_lock(monkeypatch):
+    client, commands, thread = fake_simulator(monkeypatch, [response(tpm_client.TPM_RC_SUCCESS, tpm_client.tpm2b(b"random"))])
+    held = []
+
+    def try_lock():
+        acquired = client.lock.acquire(blocking=False)
+        if acquired:
+            client.lock.release()
+        held.append(not acquired)
+
+    def connect():
+        other = threading.Thread(target=try_lock)
+        other.start()
+        other.join()
+
+    monkeypatch.setattr(client, "connect", connect)
+    assert client.get_random(6) == b"random"
+    thread.join()
+
+    assert held == [True]
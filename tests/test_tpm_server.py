@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import config
+from encryption import tpm
+from encryption.encryption import Encryption
+from encryption.tpm import TPM, TPMStartError
+
+# Run a script in place of the TPM server, in a directory of its own for the server's log and pid files
+# connect fails until it has been called failures times, as it does while a real server is starting
+def fake_server(monkeypatch, tmp_path, script, failures=0):
+    (tmp_path / "tpm_server").write_text("#!/bin/sh\n" + script)
+    os.chmod(tmp_path / "tpm_server", 0o755)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tpm, "TPM_SERVER_PATH", str(tmp_path / "tpm_server"))
+    monkeypatch.setattr(TPM, "ports_in_use", lambda self: False)
+    monkeypatch.setattr(config, "TPM_START_TIMEOUT", 1)
+
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) <= failures:
+            raise ConnectionRefusedError()
+
+    monkeypatch.setattr(Encryption.tpm, "connect", connect)
+    monkeypatch.setattr(Encryption.tpm, "close", lambda: None)
+
+    return attempts
+
+def test_start_waits_until_the_server_answers(monkeypatch, tmp_path):
+    attempts = fake_server(monkeypatch, tmp_path, "exec sleep 30\n", failures=3)
+
+    server = TPM()
+    server.start()
+    assert len(attempts) == 4
+    assert os.path.exists(tpm.TPM_SERVER_PID)
+
+    server.stop()
+    assert not os.path.exists(tpm.TPM_SERVER_PID)
+
+def test_server_that_exits_fails_to_start(monkeypatch, tmp_path, capsys):
+    fake_server(monkeypatch, tmp_path, "echo no NV file\nexit 3\n", failures=1000)
+
+    with pytest.raises(TPMStartError, match="exited with code 3"):
+        TPM().start()
+    assert "no NV file" in capsys.readouterr().out
+
+def test_server_that_never_answers_times_out(monkeypatch, tmp_path):
+    fake_server(monkeypatch, tmp_path, "exec sleep 30\n", failures=1000)
+    monkeypatch.setattr(config, "TPM_START_TIMEOUT", 0.3)
+
+    with pytest.raises(TPMStartError, match="did not start within"):
+        TPM().start()
+    assert not os.path.exists(tpm.TPM_SERVER_PID)
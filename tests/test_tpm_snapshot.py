@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from encryption import tpm
+from encryption.encryption import Encryption
+from encryption.tpm import TPM
+
+# A TPM whose NV file is in a directory of its own, recording when it is powered off and on
+@pytest.fixture
+def calls(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+
+    calls = []
+    monkeypatch.setattr(Encryption.tpm, "power_off", lambda: calls.append(("off", os.path.exists(tpm.NV_SNAPSHOT_PATH))))
+    monkeypatch.setattr(Encryption.tpm, "power_on", lambda: calls.append(("on", os.path.exists(tpm.NV_SNAPSHOT_PATH))))
+    monkeypatch.setattr(Encryption.tpm, "read_public", lambda handle: calls.append(("read_public", handle)))
+    monkeypatch.setattr(TPM, "restart", lambda self: calls.append(("restart",)))
+
+    return calls
+
+# The NV file is only copied while the TPM is powered off
+def test_snapshot(calls):
+    with open(tpm.NV_PATH, "wb") as f:
+        f.write(b"provisioned")
+
+    TPM().snapshot()
+    assert calls == [("off", False), ("on", True)]
+    assert open(tpm.NV_SNAPSHOT_PATH, "rb").read() == b"provisioned"
+
+def test_restore(calls):
+    assert not TPM().restore()
+
+    with open(tpm.NV_SNAPSHOT_PATH, "wb") as f:
+        f.write(b"provisioned")
+    with open(tpm.NV_PATH, "wb") as f:
+        f.write(b"used by now")
+
+    assert TPM().restore()
+    assert open(tpm.NV_PATH, "rb").read() == b"provisioned"
+
+    # The storage key is read back, to check that the simulator loaded the snapshot
+    assert calls[-1] == ("read_public", int(Encryption.STORAGE_KEY_ADDR, 16))
+
+# A snapshot that is not a whole NV file is deleted, and the TPM starts again from a blank one
+def test_unusable_snapshot_is_deleted(calls):
+    with open(tpm.NV_SNAPSHOT_PATH, "wb") as f:
+        f.write(b"short")
+    with open(tpm.NV_PATH, "wb") as f:
+        f.write(b"used by now")
+
+    assert not TPM().restore()
+    assert not os.path.exists(tpm.NV_SNAPSHOT_PATH)
+    assert not os.path.exists(tpm.NV_PATH)
+    assert calls == [("restart",)]